@@ -5,9 +5,16 @@ from .config import Config
 
 db = SQLAlchemy()
 
-def create_app():
+# Tables preload() requires, with what would go wrong without them
+REQUIRED_TABLES = {
+    'kb_version': 'workers would serve stale knowledge bases after a write',
+    'worker_id_leases': 'workers could not allocate consultation ids',
+    'rollup_state': 'consultations could not update the analytics rollups'
+}
+
+def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
     CORS(app)
     db.init_app(app)
     
@@ -15,6 +22,79 @@ def create_app():
         # Import and register routes
         from .routes import init_routes
         init_routes(app)  # Pass app to routes for registration
-        db.create_all()  # Create tables
+        from .analytics import register_commands
+        register_commands(app)
+        from .cli import register_commands as register_kb_commands
+        register_kb_commands(app)
+        from .instrumentation import init_instrumentation
+        init_instrumentation(app)
+        if app.config.get('AUTO_CREATE_TABLES', True):
+            db.create_all()  # Create tables
+        from .ids import init_id_allocator
+        init_id_allocator(app)
+        from .analytics import init_rollups
+        init_rollups(app)
+        from .writebehind import init_write_behind
+        init_write_behind(app)
         
-    return app
\ No newline at end of file
+    return app
+
+def preload(app):
+    """
+    Prepares a preloaded app before gunicorn forks workers from it (wsgi.py
+    and asgi.py). It fails when the database lacks one of REQUIRED_TABLES,
+    such as kb_version, through which workers notice each other's
+    knowledge-base writes. The knowledge base is compiled once here and shared copy-on-write; if the
+    database is unreachable, workers compile it on first use instead.
+    Forks with an empty pool, so workers open their own connections.
+    """
+    import logging
+    from sqlalchemy import inspect
+    from sqlalchemy.exc import SQLAlchemyError
+    from .routes import expert_system
+
+    with app.app_context():
+        try:
+            inspector = inspect(db.engine)
+            for table, consequence in REQUIRED_TABLES.items():
+                if not inspector.has_table(table):
+                    raise RuntimeError(
+                        f'The database has no {table} table, so {consequence}; run flask init-db first'
+                    )
+            expert_system.knowledge_base()
+        except SQLAlchemyError:
+            logging.getLogger(__name__).exception('Could not preload the knowledge base')
+
+    # The session has released its connection by now
+    with app.app_context():
+        db.engine.dispose()
+
+def after_fork(app):
+    """
+    Resets per-process state in a worker forked from a preloaded app.
+    Pooled connections inherited from the parent, including the ASGI
+    mode's async engine, are discarded without being closed (the parent
+    still owns the sockets). The worker leases its own consultation-id
+    worker id, failing if every one is taken. The rollup buffer and the
+    write-behind writer, whose threads do not survive fork, are started
+    again.
+    """
+    import logging
+    from sqlalchemy.exc import SQLAlchemyError
+    from .analytics import init_rollups
+    from .ids import init_id_allocator
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    if 'async_engine' in app.extensions:
+        app.extensions['async_engine'].sync_engine.dispose(close=False)
+    try:
+        init_id_allocator(app).lease()
+    except SQLAlchemyError:
+        # Database unreachable; the first consultation leases instead
+        logging.getLogger(__name__).exception('Could not lease a consultation worker id')
+    init_rollups(app)
+    if 'consultation_writer' in app.extensions:
+        from .writebehind import init_write_behind
+        init_write_behind(app)
@@ -0,0 +1,201 @@
+"""
+Static analysis of the rule set.
+
+Because diagnose() returns the first rule that fires, some rule-set
+problems make the result depend on row order:
+- duplicate rules (same antecedent, same damage);
+- conflicting rules (same antecedent, different damages);
+- rules subsumed by a rule with a strict subset of their antecedent;
+- catalogue entries that no rule uses.
+
+Rules are only compared with rules of the same scope. A model or brand
+rule sharing a generic rule's antecedent is an override, not a conflict.
+"""
+from collections import defaultdict
+from itertools import combinations, islice
+import heapq
+import json
+import click
+from sqlalchemy import select
+from . import db
+from .cli import kb_cli
+from .expert_system import DamageFact, _positions
+from .models import Symptom, Damage
+
+# Subsuming rules listed per subsumed rule; the count is always complete
+MAX_LISTED = 10
+# Antecedents up to this size enumerate their subsets (2^n lookups);
+# larger ones query the column index instead
+MAX_ENUMERATED = 10
+
+def _antecedent(key):
+    scope, facts = key
+    antecedent = {
+        'symptom_ids': sorted(f for f in facts if not isinstance(f, DamageFact)),
+        'premise_damage_ids': sorted(f.damage_id for f in facts if isinstance(f, DamageFact))
+    }
+    if isinstance(scope, int):
+        antecedent['motorcycle_id'] = scope
+    elif scope is not None:
+        antecedent['brand'] = scope
+    return antecedent
+
+def analyze(kb, symptoms=(), damages=()):
+    """
+    Analyzes a compiled KnowledgeBase.
+
+    Antecedents are hashed as (scope, frozenset) keys, which finds
+    duplicates and conflicts in one pass. For subsumption, each distinct antecedent looks
+    up its proper subsets in the same hash. Large antecedents instead take
+    the rules that match it from the engine's bitset index. No pair of
+    rules is ever compared directly.
+
+    Args:
+        kb (KnowledgeBase): Compiled knowledge base
+        symptoms (iterable): (id, code) of every symptom, for unused ones
+        damages (iterable): (id, code) of every damage, for unconcluded ones
+
+    Returns:
+        dict: duplicates, conflicts, subsumed, unconditional, unreachable,
+        unused_symptoms, unconcluded_damages and a summary of counts
+    """
+    rule_ids = kb.rule_ids
+    rule_damages = kb.rule_damages
+
+    groups = defaultdict(list)
+    key_of = []
+    for position, (facts, scope) in enumerate(zip(kb.rule_facts, kb.rule_scopes)):
+        key = (scope, frozenset(facts))
+        groups[key].append(position)
+        key_of.append(key)
+
+    duplicates = []
+    conflicts = []
+    for key, positions in groups.items():
+        if len(positions) < 2:
+            continue
+        by_damage = defaultdict(list)
+        for position in positions:
+            by_damage[rule_damages[position]].append(rule_ids[position])
+        for damage_id, ids in by_damage.items():
+            if len(ids) > 1:
+                duplicates.append(dict(_antecedent(key), damage_id=damage_id, rule_ids=ids))
+        if len(by_damage) > 1:
+            conflicts.append(dict(
+                _antecedent(key),
+                rules=[{'rule_id': rule_ids[p], 'damage_id': rule_damages[p]} for p in positions],
+                # first match wins, so the lowest position decides the diagnosis
+                effective_rule_id=rule_ids[positions[0]]
+            ))
+
+    # One summary per distinct antecedent: its rules (ascending positions),
+    # their damages, and the first rule concluding something other than the
+    # first rule's damage. That answers the redundant/shadowed questions
+    # below without looking at individual subsuming rules.
+    summaries = {}
+    for key, positions in groups.items():
+        first_damage = rule_damages[positions[0]]
+        other = next((p for p in positions if rule_damages[p] != first_damage), None)
+        summaries[key] = (positions, {rule_damages[p] for p in positions}, first_damage, other)
+
+    subsumed = []
+    unconditional = []
+    for key, positions in groups.items():
+        scope, facts = key
+        if not facts:
+            # An empty antecedent subsumes every rule; reported on its own
+            unconditional.extend(rule_ids[p] for p in positions)
+            continue
+        if len(facts) <= MAX_ENUMERATED:
+            # Walk the subset lattice below the antecedent
+            subsets = [
+                (scope, frozenset(subset))
+                for size in range(1, len(facts))
+                for subset in combinations(facts, size)
+            ]
+            found = [subset for subset in subsets if subset in groups]
+        else:
+            # Rules of the same scope whose antecedent fits inside this one, from the column index
+            found = {key_of[p] for p in _positions(kb.match_bits(facts) & kb.scope_masks[scope])}
+            found = [subset for subset in found if subset[1] and subset != key]
+        if not found:
+            continue
+
+        by = heapq.merge(*(summaries[subset][0] for subset in found))
+        listed = [rule_ids[p] for p in islice(by, MAX_LISTED)]
+        count = sum(len(summaries[subset][0]) for subset in found)
+        for position in positions:
+            damage_id = rule_damages[position]
+            shadowed = False
+            for subset in found:
+                subset_positions, _, first_damage, other = summaries[subset]
+                earliest = subset_positions[0] if first_damage != damage_id else other
+                if earliest is not None and earliest < position:
+                    shadowed = True
+                    break
+            subsumed.append({
+                'rule_id': rule_ids[position],
+                'damage_id': damage_id,
+                'subsumed_by': listed,
+                'subsumed_by_count': count,
+                # A more general rule with the same conclusion makes this one redundant
+                'redundant': any(damage_id in summaries[subset][1] for subset in found),
+                # An earlier, more general rule with another conclusion always fires first
+                'shadowed': shadowed,
+                '_position': position
+            })
+    subsumed.sort(key=lambda entry: entry.pop('_position'))
+
+    concluded = set(rule_damages)
+    unreachable = [
+        {'rule_id': rule_ids[position], 'missing_premise_damage_ids': sorted(premises - concluded)}
+        for position, premises in sorted(kb.rule_premises.items())
+        if not premises <= concluded
+    ]
+
+    referenced = set(kb.postings)
+    unused_symptoms = [
+        {'id': symptom_id, 'code': code} for symptom_id, code in symptoms if symptom_id not in referenced
+    ]
+    unconcluded_damages = [
+        {'id': damage_id, 'code': code} for damage_id, code in damages if damage_id not in concluded
+    ]
+
+    return {
+        'summary': {
+            'rules': len(rule_ids),
+            'duplicates': len(duplicates),
+            'conflicts': len(conflicts),
+            'subsumed': len(subsumed),
+            'shadowed': sum(1 for s in subsumed if s['shadowed']),
+            'unconditional': len(unconditional),
+            'unreachable': len(unreachable),
+            'unused_symptoms': len(unused_symptoms),
+            'unconcluded_damages': len(unconcluded_damages)
+        },
+        'duplicates': duplicates,
+        'conflicts': conflicts,
+        'subsumed': subsumed,
+        'unconditional': unconditional,
+        'unreachable': unreachable,
+        'unused_symptoms': unused_symptoms,
+        'unconcluded_damages': unconcluded_damages
+    }
+
+def analyze_knowledge_base(kb):
+    """Runs analyze() with the symptom and damage catalogue from the database (two queries)."""
+    symptoms = db.session.execute(select(Symptom.id, Symptom.code).order_by(Symptom.id)).all()
+    damages = db.session.execute(select(Damage.id, Damage.code).order_by(Damage.id)).all()
+    return analyze(kb, symptoms, damages)
+
+@kb_cli.command('analyze')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON.')
+def analyze_command(as_json):
+    """Report duplicate, conflicting, subsumed and unused rules and catalogue entries."""
+    from .routes import expert_system
+    report = analyze_knowledge_base(expert_system.knowledge_base())
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    for name, count in report['summary'].items():
+        click.echo(f'{name}: {count}')
@@ -0,0 +1,393 @@
+from collections import Counter, defaultdict
+from itertools import combinations
+import atexit
+import logging
+import threading
+import click
+from sqlalchemy import event, select, func, delete, insert
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+from . import db
+from .models import (
+    Motorcycle, Damage, Consultation, ConsultationSymptom,
+    DailyDamageStat, DailyOutcomeStat, SymptomPairStat, RollupState
+)
+
+logger = logging.getLogger(__name__)
+
+UPSERT_CHUNK_SIZE = 1000
+
+def _upsert_increment(model, keys, counters, rows, session=None):
+    """
+    Adds the counter columns of rows onto existing rollup rows, inserting
+    the ones that do not exist yet, with one statement per chunk.
+    """
+    session = session or db.session
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+
+    for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        chunk = rows[start:start + UPSERT_CHUNK_SIZE]
+
+        if dialect == 'mysql':
+            stmt = mysql.insert(table).values(chunk)
+            stmt = stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in counters})
+        elif dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            stmt = insert(table).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_={c: table.c[c] + stmt.excluded[c] for c in counters}
+            )
+        else:
+            for row in chunk:
+                existing = session.get(model, tuple(row[k] for k in keys))
+                if existing is None:
+                    session.add(model(**row))
+                else:
+                    for c in counters:
+                        setattr(existing, c, getattr(existing, c) + row[c])
+            continue
+
+        session.execute(stmt)
+
+class RollupBatch:
+    """
+    Accumulates rollup increments in memory so any number of consultations
+    is written with one upsert per rollup table.
+    """
+    def __init__(self):
+        self.damages = Counter()
+        self.outcomes = defaultdict(lambda: [0, 0])
+        self.pairs = Counter()
+
+    def add(self, consultation_date, motorcycle_id, damage_id, symptom_ids):
+        day = consultation_date.date()
+        if damage_id:
+            self.damages[(day, motorcycle_id, damage_id)] += 1
+            self.outcomes[day][0] += 1
+        else:
+            self.outcomes[day][1] += 1
+
+        symptoms = sorted(set(symptom_ids))
+        for symptom_id in symptoms:
+            self.pairs[(symptom_id, symptom_id)] += 1
+        for pair in combinations(symptoms, 2):
+            self.pairs[pair] += 1
+
+    def merge(self, other):
+        self.damages.update(other.damages)
+        for day, (hits, misses) in other.outcomes.items():
+            self.outcomes[day][0] += hits
+            self.outcomes[day][1] += misses
+        self.pairs.update(other.pairs)
+
+    def flush(self, session=None):
+        """Writes the accumulated increments in the current transaction."""
+        if self.damages:
+            _upsert_increment(DailyDamageStat, ['day', 'motorcycle_id', 'damage_id'], ['count'], [
+                {'day': day, 'motorcycle_id': motorcycle_id, 'damage_id': damage_id, 'count': count}
+                for (day, motorcycle_id, damage_id), count in self.damages.items()
+            ], session)
+        if self.outcomes:
+            _upsert_increment(DailyOutcomeStat, ['day'], ['hits', 'misses'], [
+                {'day': day, 'hits': hits, 'misses': misses}
+                for day, (hits, misses) in self.outcomes.items()
+            ], session)
+        if self.pairs:
+            _upsert_increment(SymptomPairStat, ['symptom_a', 'symptom_b'], ['count'], [
+                {'symptom_a': a, 'symptom_b': b, 'count': count}
+                for (a, b), count in self.pairs.items()
+            ], session)
+        self.__init__()
+
+def _rollup_state(session, exclusive=False):
+    """
+    Reads the rollup state row, locked until the transaction ends: shared
+    for live increments, exclusive for backfill steps, so the two take turns.
+    """
+    query = select(RollupState).where(RollupState.id == 1).with_for_update(read=not exclusive)
+    state = session.execute(query).scalar_one_or_none()
+    if state is None:
+        # Tables created without create_all have no row yet
+        session.execute(insert(RollupState).values(id=1, epoch=0, watermark=0, rebuilt_through=0))
+        state = session.execute(query).scalar_one()
+    return state
+
+class ConsultationRollups:
+    """
+    Rollup increments for consultations inserted in the current
+    transaction. flush() must run after the inserts. It leaves out the
+    consultations a running backfill will count itself (ids up to its
+    watermark that it has not passed yet), then either writes the rest at
+    once or, with a RollupBuffer, hands them to the buffer when the
+    transaction commits.
+    """
+    def __init__(self, buffer=None):
+        self.buffer = buffer
+        self.consultations = []
+
+    def add(self, consultation_id, consultation_date, motorcycle_id, damage_id, symptom_ids):
+        self.consultations.append((consultation_id, consultation_date, motorcycle_id, damage_id, symptom_ids))
+
+    def flush(self, session=None):
+        session = session or db.session
+        state = _rollup_state(session)
+        batch = RollupBatch()
+        for consultation_id, *consultation in self.consultations:
+            if consultation_id > state.watermark or consultation_id <= state.rebuilt_through:
+                batch.add(*consultation)
+        self.consultations = []
+
+        if self.buffer is None:
+            batch.flush(session)
+        else:
+            session.info.setdefault('rollups', []).append((self.buffer, state.epoch, batch))
+
+@event.listens_for(Session, 'after_commit')
+def _buffer_committed_rollups(session):
+    for buffer, epoch, batch in session.info.pop('rollups', ()):
+        buffer.add(epoch, batch)
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_rolled_back_rollups(session):
+    session.info.pop('rollups', None)
+
+class RollupBuffer:
+    """
+    Rollup increments of this process's committed consultations, written
+    by a background thread every flush_interval seconds. Diagnoses then
+    no longer take turns on the row of the current day in every
+    transaction; dashboards lag by up to flush_interval instead.
+
+    Increments buffered before a backfill started are dropped: the
+    backfill counts those consultations. Increments still buffered when
+    the process is killed are lost until the next backfill.
+    """
+    def __init__(self, app, flush_interval=1.0):
+        self.app = app
+        self.flush_interval = flush_interval
+        self._pending = {}  # rollup epoch -> RollupBatch
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='rollup-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def shutdown(self, timeout=10):
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self.flush()
+
+    def add(self, epoch, batch):
+        with self._lock:
+            self._pending.setdefault(epoch, RollupBatch()).merge(batch)
+
+    def flush(self):
+        """Writes the buffered increments in one transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        with self.app.app_context():
+            try:
+                state = _rollup_state(db.session)
+                if state.epoch in pending:
+                    # Write a copy: flush() empties its batch, and a failed commit re-buffers these
+                    batch = RollupBatch()
+                    batch.merge(pending[state.epoch])
+                    batch.flush(db.session)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                for epoch, batch in pending.items():
+                    self.add(epoch, batch)
+                raise
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Rollup flush failed; keeping the increments for the next one')
+
+def init_rollups(app):
+    """Starts the process's RollupBuffer unless ROLLUP_FLUSH_INTERVAL is 0."""
+    interval = app.config.get('ROLLUP_FLUSH_INTERVAL')
+    if not interval:
+        app.extensions.pop('rollup_buffer', None)
+        return None
+    buffer = RollupBuffer(app, interval)
+    buffer.start()
+    app.extensions['rollup_buffer'] = buffer
+    return buffer
+
+def record_consultation(consultation, symptom_ids, session=None, buffer=None):
+    """Updates the rollups for one flushed consultation, inside the caller's transaction."""
+    rollups = ConsultationRollups(buffer)
+    rollups.add(consultation.id, consultation.consultation_date, consultation.motorcycle_id,
+                consultation.damage_id, symptom_ids)
+    rollups.flush(session)
+
+def damage_frequency(date_from=None, date_to=None, motorcycle_id=None):
+    """Diagnoses per motorcycle model and damage, read from the daily rollup."""
+    query = (
+        select(
+            DailyDamageStat.motorcycle_id, Motorcycle.brand, Motorcycle.model,
+            DailyDamageStat.damage_id, Damage.code, Damage.name,
+            func.sum(DailyDamageStat.count).label('count')
+        )
+        .join(Motorcycle, Motorcycle.id == DailyDamageStat.motorcycle_id)
+        .join(Damage, Damage.id == DailyDamageStat.damage_id)
+        .group_by(
+            DailyDamageStat.motorcycle_id, Motorcycle.brand, Motorcycle.model,
+            DailyDamageStat.damage_id, Damage.code, Damage.name
+        )
+        .order_by(func.sum(DailyDamageStat.count).desc())
+    )
+    if date_from:
+        query = query.where(DailyDamageStat.day >= date_from)
+    if date_to:
+        query = query.where(DailyDamageStat.day <= date_to)
+    if motorcycle_id:
+        query = query.where(DailyDamageStat.motorcycle_id == motorcycle_id)
+
+    return [
+        {
+            'motorcycle_id': row.motorcycle_id,
+            'motorcycle': f'{row.brand} {row.model}',
+            'damage_id': row.damage_id,
+            'damage_code': row.code,
+            'damage_name': row.name,
+            'count': int(row.count)
+        }
+        for row in db.session.execute(query)
+    ]
+
+def symptom_pairs(limit=20):
+    """Most frequent symptom pairs, with each symptom's own count for computing lift."""
+    pairs = db.session.execute(
+        select(SymptomPairStat)
+        .where(SymptomPairStat.symptom_a < SymptomPairStat.symptom_b)
+        .order_by(SymptomPairStat.count.desc())
+        .limit(limit)
+    ).scalars().all()
+
+    symptom_ids = {p.symptom_a for p in pairs} | {p.symptom_b for p in pairs}
+    singles = dict(db.session.execute(
+        select(SymptomPairStat.symptom_a, SymptomPairStat.count)
+        .where(SymptomPairStat.symptom_a == SymptomPairStat.symptom_b)
+        .where(SymptomPairStat.symptom_a.in_(symptom_ids))
+    ).all()) if symptom_ids else {}
+
+    return [
+        {
+            'symptom_ids': [p.symptom_a, p.symptom_b],
+            'count': p.count,
+            'symptom_counts': [singles.get(p.symptom_a, 0), singles.get(p.symptom_b, 0)]
+        }
+        for p in pairs
+    ]
+
+def hit_rate(date_from=None, date_to=None):
+    """Daily diagnosis hit/miss counts and the overall hit rate for the range."""
+    query = select(DailyOutcomeStat).order_by(DailyOutcomeStat.day)
+    if date_from:
+        query = query.where(DailyOutcomeStat.day >= date_from)
+    if date_to:
+        query = query.where(DailyOutcomeStat.day <= date_to)
+
+    days = db.session.execute(query).scalars().all()
+    hits = sum(d.hits for d in days)
+    total = hits + sum(d.misses for d in days)
+    return {
+        'hit_rate': hits / total if total else None,
+        'days': [
+            {
+                'day': d.day.isoformat(),
+                'hits': d.hits,
+                'misses': d.misses,
+                'hit_rate': d.hits / (d.hits + d.misses) if d.hits + d.misses else None
+            }
+            for d in days
+        ]
+    }
+
+def backfill(chunk_size=5000, echo=print):
+    """
+    Rebuilds every rollup from consultation history, reading consultations
+    by id range in chunks and committing after each chunk.
+
+    Diagnoses can keep running. The rebuild covers consultation ids up to
+    the highest one when it starts (the watermark) and records how far it
+    has got in RollupState, so each consultation is counted once: by the
+    rebuild if it is committed before the rebuild reaches its id, by the
+    live increments otherwise.
+    """
+    state = _rollup_state(db.session, exclusive=True)
+    for model in (DailyDamageStat, DailyOutcomeStat, SymptomPairStat):
+        db.session.execute(delete(model))
+    # Read after the lock: consultation transactions holding it have committed
+    watermark = db.session.execute(select(func.max(Consultation.id))).scalar() or 0
+    state.epoch += 1
+    state.watermark = watermark
+    state.rebuilt_through = 0
+    epoch = state.epoch
+    db.session.commit()
+
+    last_id = 0
+    total = 0
+    while last_id < watermark:
+        state = _rollup_state(db.session, exclusive=True)
+        if state.epoch != epoch:
+            db.session.rollback()
+            raise RuntimeError('Another rollup backfill started; this one stopped')
+
+        consultations = db.session.execute(
+            select(Consultation.id, Consultation.consultation_date, Consultation.motorcycle_id, Consultation.damage_id)
+            .where(Consultation.id > last_id)
+            .where(Consultation.id <= watermark)
+            .order_by(Consultation.id)
+            .limit(chunk_size)
+        ).all()
+        # A short chunk reaches the watermark
+        chunk_end = consultations[-1].id if len(consultations) == chunk_size else watermark
+
+        symptoms = defaultdict(list)
+        for consultation_id, symptom_id in db.session.execute(
+            select(ConsultationSymptom.consultation_id, ConsultationSymptom.symptom_id)
+            .where(ConsultationSymptom.consultation_id > last_id)
+            .where(ConsultationSymptom.consultation_id <= chunk_end)
+        ):
+            symptoms[consultation_id].append(symptom_id)
+
+        batch = RollupBatch()
+        for c in consultations:
+            batch.add(c.consultation_date, c.motorcycle_id, c.damage_id, symptoms.get(c.id, []))
+        batch.flush()
+        state.rebuilt_through = chunk_end
+        db.session.commit()
+
+        last_id = chunk_end
+        total += len(consultations)
+        echo(f'{total} consultations processed')
+
+    return total
+
+def register_commands(app):
+    @app.cli.group('stats')
+    def stats():
+        """Consultation analytics rollups."""
+
+    @stats.command('backfill')
+    @click.option('--chunk-size', default=5000, show_default=True, help='Consultations per transaction.')
+    def backfill_command(chunk_size):
+        """Rebuild rollup tables from consultation history."""
+        total = backfill(chunk_size, echo=click.echo)
+        click.echo(f'Rollups rebuilt from {total} consultations')
@@ -0,0 +1,393 @@
+"""
+ASGI serving mode.
+
+The read paths and POST /api/diagnose are served by coroutines on an async
+SQLAlchemy engine, so a request waiting on the database, or on a slow
+client's upload, holds no thread. Every other route is handed to the Flask
+app on a small thread pool. The async handlers reuse the helpers, caches
+and JSON provider of app.routes, so status codes, bodies and ETags match
+the sync routes.
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+"""
+import asyncio
+import contextvars
+import hashlib
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import jwt
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import InternalServerError
+from werkzeug.http import parse_etags, quote_etag
+from . import create_app, analytics
+from .config import Config, async_database_uri, engine_options
+from .expert_system import read_kb_version
+from .instrumentation import http_requests, http_duration, instrument_engine, span
+from .models import Motorcycle, Symptom, User, Consultation, ConsultationSymptom
+from .routes import (
+    expert_system, response_cache, token_cache, diagnosis_memo, Principal,
+    _bearer_token, _remember_principal, _damage_listing, _rule_listing,
+    _consultation_args, _consultation_select, _consultation_listing,
+    _diagnosis_body, _diagnosis_error
+)
+
+# Returned by a handler to let the Flask app answer instead (e.g. with the
+# 400/415 error page get_json() produces for a malformed body)
+DELEGATE = object()
+
+class Request:
+    """The parts of an ASGI HTTP request the async handlers read."""
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        self.headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = self.headers[name] + ',' + value if name in self.headers else value
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+
+    def get_json(self):
+        """Parses the body like Flask's get_json(); returns DELEGATE where Flask would answer 400/415."""
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+        if not (mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))):
+            return DELEGATE
+        try:
+            return current_app.json.loads(self.body)
+        except ValueError:
+            return DELEGATE
+
+def _jsonify(data, status=200):
+    response = current_app.json.response(data)
+    return status, [(b'content-type', b'application/json')], response.get_data()
+
+def _json_body(request, body):
+    """Serialized JSON with a strong ETag, answering 304 on If-None-Match (as _json_response)."""
+    etag = hashlib.sha1(body).hexdigest()
+    headers = [(b'etag', quote_etag(etag).encode())]
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return 304, headers, b''
+    return 200, [(b'content-type', b'application/json')] + headers, body
+
+def _wsgi_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+class AsyncAPI:
+    """
+    ASGI application in front of a Flask app. Requests for routes in
+    self.routes are handled natively; all others, and anything a handler
+    returns DELEGATE for, go through the Flask app on the thread pool.
+    """
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+        uri = config.get('ASYNC_DATABASE_URL') or async_database_uri(config['SQLALCHEMY_DATABASE_URI'])
+        self.engine = create_async_engine(uri, **engine_options(uri))
+        instrument_engine(self.engine.sync_engine)
+        # after_fork() resets this pool in preforked workers
+        flask_app.extensions['async_engine'] = self.engine
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.threads = config['ASGI_THREADS']
+        self._executor = None
+        self.routes = {
+            ('GET', '/api/motorcycles'): self.get_motorcycles,
+            ('GET', '/api/symptoms'): self.get_symptoms,
+            ('GET', '/api/damages'): self.get_damages,
+            ('GET', '/api/rules'): self.get_rules,
+            ('GET', '/api/consultations'): self.get_consultations,
+            ('POST', '/api/diagnose'): self.diagnose
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        body = await self._read_body(receive)
+        if body is None:
+            return
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            return await self._call_wsgi(scope, body, send)
+
+        start = time.perf_counter()
+        request = Request(scope, body)
+        with self.flask_app.app_context():
+            try:
+                response = await handler(request)
+            except Exception:
+                self.flask_app.logger.exception(f'Exception on {request.path} [{request.method}]')
+                error = InternalServerError()
+                response = 500, [(b'content-type', b'text/html; charset=utf-8')], error.get_body().encode()
+        if response is DELEGATE:
+            return await self._call_wsgi(scope, body, send)
+
+        status, headers, body = response
+        # Same headers Flask-CORS adds to the sync routes
+        origin = request.headers.get('origin')
+        if origin:
+            headers += [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+        else:
+            headers.append((b'access-control-allow-origin', b'*'))
+        elapsed = time.perf_counter() - start
+        headers += [
+            (b'content-length', str(len(body)).encode()),
+            (b'server-timing', f'total;dur={elapsed * 1000:.2f}'.encode())
+        ]
+        http_requests.inc(method=request.method, endpoint=request.path, status=status)
+        http_duration.observe(elapsed, method=request.method, endpoint=request.path)
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _read_body(self, receive):
+        """Returns the whole request body, or None if the client disconnected."""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                if self._executor is not None:
+                    self._executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _in_thread(self, fn, *args, context=None):
+        """
+        Runs fn on the thread pool in a copy of the caller's context (so the
+        Flask app context is visible), or in the given context.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi-sync')
+        if context is None:
+            context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, fn, *args)
+
+    async def _call_wsgi(self, scope, body, send):
+        """Serves a request with the Flask app, streaming its response chunk by chunk."""
+        environ = _wsgi_environ(scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return lambda data: None
+
+        # One context for the whole response: streamed views keep the
+        # request context they pushed between chunks
+        context = contextvars.copy_context()
+        result = await self._in_thread(self.flask_app, environ, start_response, context=context)
+        chunks = iter(result)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while True:
+                chunk = await self._in_thread(next, chunks, None, context=context)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await self._in_thread(result.close, context=context)
+
+    async def knowledge_base(self):
+        kb = expert_system.current()
+        if kb is None:
+            # Compiling queries the database through the sync engine and may
+            # wait on the engine's lock; keep both off the event loop
+            kb = await self._in_thread(expert_system.knowledge_base)
+        return kb
+
+    async def poll_version(self):
+        """Async counterpart of ForwardChainingEngine.poll; the read goes through the async engine."""
+        if expert_system.check_due():
+            async with self.sessions() as session:
+                expert_system.observe(await session.run_sync(read_kb_version))
+        return expert_system.version
+
+    async def authenticate(self, request, session):
+        """Returns the Principal for the request's bearer token, or a 401 response (as token_required)."""
+        token = _bearer_token(request.headers.get('authorization'))
+        if not token:
+            return _jsonify({'message': 'Token is missing!'}, 401)
+
+        principal = token_cache.get(token)
+        if principal is None:
+            try:
+                data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
+                user = (await session.scalars(select(User).filter_by(id=data['user_id']))).first()
+                if not user:
+                    return _jsonify({'message': 'User not found!'}, 401)
+            except jwt.InvalidTokenError as e:
+                return _jsonify({'message': f'Token is invalid: {str(e)}!'}, 401)
+            principal = _remember_principal(token, data, user)
+        return principal
+
+    async def get_motorcycles(self, request):
+        async with self.sessions() as session:
+            motorcycles = (await session.scalars(select(Motorcycle))).all()
+        return _jsonify([m.to_dict() for m in motorcycles])
+
+    async def get_symptoms(self, request):
+        async with self.sessions() as session:
+            symptoms = (await session.scalars(select(Symptom))).all()
+        return _jsonify([s.to_dict() for s in symptoms])
+
+    async def _cached_listing(self, request, name, build):
+        """Async counterpart of _cached_listing; build runs on a sync view of an async session."""
+        key = (name, await self.poll_version())
+        body = response_cache.get(key)
+        if body is None:
+            async with self.sessions() as session:
+                with span('orm.load'):
+                    data = await session.run_sync(build)
+            with span('serialize'):
+                body = current_app.json.dumps(data).encode() + b'\n'
+            response_cache.set(key, body)
+        return _json_body(request, body)
+
+    async def get_damages(self, request):
+        return await self._cached_listing(request, 'damages', _damage_listing)
+
+    async def get_rules(self, request):
+        return await self._cached_listing(request, 'rules', _rule_listing)
+
+    async def get_consultations(self, request):
+        async with self.sessions() as session:
+            current_user = await self.authenticate(request, session)
+            if not isinstance(current_user, Principal):
+                return current_user
+
+            args = request.args
+            try:
+                filters, cursor, limit, paginated = _consultation_args(current_user, args)
+            except ValueError:
+                return _jsonify({'message': 'Invalid query parameters'}, 400)
+
+            with span('orm.load'):
+                consultations = (await session.scalars(_consultation_select(filters, cursor, limit))).all()
+
+            with span('serialize'):
+                data, next_cursor = _consultation_listing(consultations, paginated, limit)
+                body = current_app.json.dumps(data).encode() + b'\n'
+        status, headers, body = _json_body(request, body)
+        if next_cursor:
+            headers.append((b'x-next-cursor', next_cursor.encode()))
+        return status, headers, body
+
+    async def diagnose(self, request):
+        data = request.get_json()
+        if data is DELEGATE:
+            return DELEGATE
+
+        error = _diagnosis_error(data)
+        if error:
+            return _jsonify({'message': error}, 400)
+
+        symptom_ids = data['symptom_ids']
+        motorcycle_id = data['motorcycle_id']
+        top_k = data.get('top_k')
+
+        if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= 50):
+            return _jsonify({'message': 'top_k must be an integer between 1 and 50'}, 400)
+
+        root = await self.knowledge_base()
+        kb = root.scoped(motorcycle_id, build=False)
+        if kb is None:
+            # Compiling the motorcycle's partitions is CPU work; keep it off the event loop
+            kb = await self._in_thread(root.scoped, motorcycle_id)
+        if diagnosis_memo.backend is None:
+            damage_id, diagnosis_json = diagnosis_memo.diagnose(kb, symptom_ids)
+        else:
+            # A shared-backend lookup is a network round trip
+            damage_id, diagnosis_json = await self._in_thread(diagnosis_memo.diagnose, kb, symptom_ids)
+        candidates = None
+        if top_k:
+            with span('engine.rank'):
+                candidates = kb.rank(symptom_ids, top_k)
+
+        writer = self.flask_app.extensions.get('consultation_writer')
+        if writer is not None:
+            args = (data.get('user_id'), motorcycle_id, damage_id, symptom_ids)
+            consultation_id = writer.submit_nowait(*args)
+            if consultation_id is None:
+                # Queue full: submit waits for room and may spill with an fsync
+                consultation_id = await self._in_thread(writer.submit, *args)
+        else:
+            async with self.sessions() as session:
+                consultation = Consultation(
+                    id=self.flask_app.extensions['consultation_ids'].next_id(),
+                    user_id=data.get('user_id'),
+                    motorcycle_id=motorcycle_id,
+                    damage_id=damage_id
+                )
+                session.add(consultation)
+                await session.flush()
+
+                session.add_all(
+                    ConsultationSymptom(consultation_id=consultation.id, symptom_id=symptom_id)
+                    for symptom_id in symptom_ids
+                )
+                buffer = self.flask_app.extensions.get('rollup_buffer')
+                await session.run_sync(
+                    lambda sync_session: analytics.record_consultation(consultation, symptom_ids, sync_session, buffer)
+                )
+                consultation_id = consultation.id
+                await session.commit()
+
+        with span('serialize'):
+            body = _diagnosis_body(consultation_id, damage_id, diagnosis_json, candidates)
+        return 200, [(b'content-type', b'application/json')], body
+
+def create_asgi_app(config_class=Config):
+    """Creates the Flask app and the ASGI application serving it."""
+    return AsyncAPI(create_app(config_class))
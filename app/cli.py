@@ -0,0 +1,16 @@
+import click
+from flask.cli import AppGroup
+
+# 'flask kb ...' commands; modules attach their subcommands to this group
+kb_cli = AppGroup('kb', help='Knowledge-base maintenance commands.')
+
+def register_commands(app):
+    from . import snapshot, kb_io, analysis, rediagnosis  # noqa: F401  (register the 'kb' subcommands)
+    app.cli.add_command(kb_cli)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create missing tables (production runs with AUTO_CREATE_TABLES off)."""
+        from . import db
+        db.create_all()
+        click.echo('Database tables created')
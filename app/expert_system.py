@@ -1,33 +1,1243 @@
+import copy
+import hashlib
+import json
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict, namedtuple
+from sqlalchemy import select, insert, update
+from sqlalchemy.orm import selectinload
 from . import db
-from .models import Rule, RuleSymptom, Damage
+from .instrumentation import span
+from .models import Rule, RuleSymptom, RuleDamage, Damage, Motorcycle, KnowledgeBaseVersion
+
+# Facts are observed symptom ids (plain ints) or concluded damages. Wrapping
+# damages keeps the two id spaces apart inside one index.
+DamageFact = namedtuple('DamageFact', 'damage_id')
+
+# What ForwardChainingEngine.refresh() changed: the knowledge bases before
+# and after, the antecedents (old and new) of every touched rule, and the
+# damage ids whose rows were written.
+KnowledgeBaseDelta = namedtuple('KnowledgeBaseDelta', 'previous current antecedents damage_ids')
+
+def _bitset(positions, size):
+    """Packs a list of bit positions into an int without quadratic big-int ORs."""
+    buffer = bytearray((size + 7) // 8)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, 'little')
+
+# int.bit_count is Python 3.10+
+_popcount = getattr(int, 'bit_count', None) or (lambda bits: bin(bits).count('1'))
+
+def _positions(bits):
+    """Returns the set bit positions of an int, lowest first."""
+    digits = bin(bits)[:1:-1]
+    positions = []
+    position = digits.find('1')
+    while position != -1:
+        positions.append(position)
+        position = digits.find('1', position + 1)
+    return positions
+
+def _drop_bit(bits, position):
+    """Removes bit position - 1, moving the higher bits down by one."""
+    return (bits & ((1 << (position - 1)) - 1)) | ((bits >> position) << (position - 1))
+
+def _open_bit(bits, position):
+    """Moves bit position and above up by one, leaving bit position clear."""
+    return (bits & ((1 << position) - 1)) | ((bits >> position) << (position + 1))
+
+def brand_key(brand):
+    """Normalizes a brand name for matching ('Honda ' and 'honda' are one brand)."""
+    return ' '.join(brand.split()).casefold() if brand else None
+
+def rule_scope(motorcycle_id, brand):
+    """
+    Partition key of a rule: its motorcycle id when it is scoped to one
+    model, its brand key when scoped to a brand, None for a generic rule.
+    """
+    if motorcycle_id is not None:
+        return motorcycle_id
+    return brand_key(brand)
+
+def load_rules(session, rule_ids=None):
+    """
+    Reads (rule_id, damage_id, facts, scope) in evaluation order, for every
+    rule or only the given ids.
+    """
+    def only(query, column):
+        return query if rule_ids is None else query.where(column.in_(rule_ids))
+
+    antecedents = defaultdict(list)
+    for rule_id, symptom_id in session.execute(only(select(RuleSymptom.rule_id, RuleSymptom.symptom_id), RuleSymptom.rule_id)):
+        antecedents[rule_id].append(symptom_id)
+    for rule_id, damage_id in session.execute(only(select(RuleDamage.rule_id, RuleDamage.damage_id), RuleDamage.rule_id)):
+        antecedents[rule_id].append(DamageFact(damage_id))
+
+    return [
+        (rule_id, damage_id, antecedents.get(rule_id, []), rule_scope(motorcycle_id, brand))
+        for rule_id, damage_id, motorcycle_id, brand in session.execute(
+            only(select(Rule.id, Rule.damage_id, Rule.motorcycle_id, Rule.brand), Rule.id).order_by(Rule.id)
+        )
+    ]
+
+def load_damages(session, damage_ids=None):
+    """Reads damage id -> serialized payload, for every damage or only the given ids."""
+    query = select(Damage).options(selectinload(Damage.causes), selectinload(Damage.solutions))
+    if damage_ids is not None:
+        query = query.where(Damage.id.in_(damage_ids))
+    return {damage.id: damage.to_dict() for damage in session.execute(query).scalars()}
+
+def load_motorcycles(session, motorcycle_ids=None):
+    """Reads motorcycle id -> brand key, for every motorcycle or only the given ids."""
+    query = select(Motorcycle.id, Motorcycle.brand)
+    if motorcycle_ids is not None:
+        query = query.where(Motorcycle.id.in_(motorcycle_ids))
+    return {motorcycle_id: brand_key(brand) for motorcycle_id, brand in session.execute(query)}
+
+def read_kb_version(session):
+    """Returns the shared knowledge-base version (see KnowledgeBaseVersion)."""
+    return session.scalar(select(KnowledgeBaseVersion.version).where(KnowledgeBaseVersion.id == 1)) or 0
+
+def bump_kb_version(session):
+    """
+    Increments the shared knowledge-base version inside session's
+    transaction and returns the new value. Every transaction writing rules,
+    symptoms, damages or motorcycles must call it before committing; the
+    UPDATE's row lock gives concurrent writers distinct versions.
+    """
+    bumped = session.execute(
+        update(KnowledgeBaseVersion)
+        .where(KnowledgeBaseVersion.id == 1)
+        .values(version=KnowledgeBaseVersion.version + 1)
+    )
+    if not bumped.rowcount:
+        # Tables created without create_all have no row yet
+        session.execute(insert(KnowledgeBaseVersion).values(id=1, version=1))
+        return 1
+    return read_kb_version(session)
+
+class KnowledgeBase:
+    """
+    Compiled, read-only view of the rule base used on the diagnosis hot path.
+
+    Rules are kept in evaluation order (by rule id) so the first match is the
+    same one the row-by-row implementation used to return.
+
+    This index holds every rule whatever its scope. Diagnoses for a given
+    motorcycle go through scoped(), which only evaluates the partitions
+    (per-scope indexes of this same shape) that apply to it.
+    """
+    def __init__(self, version, rules, damages, motorcycles=None):
+        """
+        Args:
+            version (int): Knowledge-base version this index was built from
+            rules (list): (rule_id, damage_id, facts, scope) tuples in
+                evaluation order, where facts are symptom ids and DamageFact
+                premises and scope is a rule_scope() key
+            damages (dict): Damage id -> serialized damage payload
+            motorcycles (dict): Motorcycle id -> brand key
+        """
+        self.version = version
+        self.damages = damages
+        self.motorcycles = motorcycles if motorcycles is not None else {}
+        self.fact_bits = {}
+        self.rule_ids = []
+        self.rule_damages = []
+        self.rule_facts = []
+        self.rule_masks = []
+        self.rule_scopes = []
+        self.rule_premises = {}
+        self.postings = defaultdict(list)
+        self.unconditional = []
+        self._network = None
+        self._fingerprint = None
+        self._partitions = {}
+        self._views = {}
+
+        # Column bitsets: bit r of fact_rules[f] is set when rule r needs f.
+        # length_slices[j] holds bit j of every rule's antecedent size.
+        length_positions = []
+        size_positions = defaultdict(list)
+        scope_positions = defaultdict(list)
+
+        for rule_id, damage_id, facts, scope in rules:
+            if damage_id not in damages:
+                continue
+
+            position = len(self.rule_ids)
+            antecedent = tuple(set(facts))
+            mask = 0
+            for fact in antecedent:
+                mask |= 1 << self._bit(fact)
+                self.postings[fact].append(position)
+
+            if not mask:
+                self.unconditional.append(position)
+
+            premises = {fact.damage_id for fact in antecedent if isinstance(fact, DamageFact)}
+            if premises:
+                self.rule_premises[position] = premises
+
+            length = len(antecedent)
+            size_positions[length].append(position)
+            j = 0
+            while length:
+                if j == len(length_positions):
+                    length_positions.append([])
+                if length & 1:
+                    length_positions[j].append(position)
+                length >>= 1
+                j += 1
+
+            scope_positions[scope].append(position)
+
+            self.rule_ids.append(rule_id)
+            self.rule_damages.append(damage_id)
+            self.rule_facts.append(antecedent)
+            self.rule_masks.append(mask)
+            self.rule_scopes.append(scope)
+
+        size = len(self.rule_ids)
+        self.postings = dict(self.postings)
+        self.length_slices = [_bitset(positions, size) for positions in length_positions]
+        # Rules grouped by antecedent size
+        self.length_masks = {
+            length: _bitset(positions, size) for length, positions in size_positions.items()
+        }
+        # Rules grouped by scope, the members of each partition
+        self.scope_masks = {
+            scope: _bitset(positions, size) for scope, positions in scope_positions.items()
+        }
+        self._index()
+
+    def _index(self, fact_rules=None):
+        """
+        Derives the matching structures from postings and length masks.
+        fact_rules may be passed in when the per-fact bitsets are already
+        available (e.g. read from a snapshot).
+        """
+        size = len(self.rule_ids)
+        if fact_rules is None:
+            fact_rules = {fact: _bitset(positions, size) for fact, positions in self.postings.items()}
+        self.fact_rules = fact_rules
+        self.all_rules = (1 << size) - 1
+        self.chained = bool(self.rule_premises)
+
+        # Every (certainty, hits, size) level ordered best first for rank()
+        self.rank_levels = sorted(
+            ((count / length if length else 1.0, count, length)
+             for length in self.length_masks
+             for count in range(1 if length else 0, length + 1)),
+            key=lambda level: (-level[0], -level[1])
+        )
+
+    def _bit(self, fact):
+        bit = self.fact_bits.get(fact)
+        if bit is None:
+            bit = self.fact_bits[fact] = len(self.fact_bits)
+        return bit
+
+    @classmethod
+    def load(cls, session, version):
+        """Builds the index with a fixed number of queries, independent of rule count."""
+        return cls(version, load_rules(session), load_damages(session), load_motorcycles(session))
+
+    def position(self, rule_id):
+        """Returns the evaluation position of a rule id, or None when it is not indexed."""
+        position = bisect_left(self.rule_ids, rule_id)
+        if position < len(self.rule_ids) and self.rule_ids[position] == rule_id:
+            return position
+        return None
+
+    def patched(self, version, rules=(), removed=(), damages=None, motorcycles=None):
+        """
+        Returns a new KnowledgeBase with a delta applied, leaving this one
+        untouched (copy-on-write): containers the delta changes are copied,
+        everything else is shared. Diagnoses running against this instance
+        keep seeing a consistent index. Partitions already compiled are
+        patched with the part of the delta in their scope, or shared.
+
+        Args:
+            version (int): Version of the patched knowledge base
+            rules (iterable): (rule_id, damage_id, facts, scope) to insert or replace
+            removed (iterable): Rule ids to drop
+            damages (dict): Damage id -> payload to insert or replace, or
+                None to drop the damage together with the rules concluding it
+            motorcycles (dict): Motorcycle id -> brand key to insert or
+                replace, or None to drop the motorcycle
+
+        Returns:
+            KnowledgeBase: Equivalent to a fresh load() of the patched data
+        """
+        kb = KnowledgeBase.__new__(KnowledgeBase)
+        # Shares untouched state, including the snapshot backing any views
+        kb.__dict__.update(self.__dict__)
+        kb.version = version
+        kb._network = None
+        kb._fingerprint = None
+        kb._partitions = {}
+        kb._views = {}
+        for name in ('rule_ids', 'rule_damages', 'rule_facts', 'rule_scopes', 'unconditional', 'length_slices'):
+            setattr(kb, name, list(getattr(self, name)))
+        # Masks computed on access (snapshot-loaded) follow the patched rules once rebound
+        kb.rule_masks = list(self.rule_masks) if isinstance(self.rule_masks, list) else type(self.rule_masks)(kb)
+        for name in ('fact_bits', 'fact_rules', 'postings', 'rule_premises', 'length_masks', 'scope_masks'):
+            setattr(kb, name, dict(getattr(self, name)))
+
+        if motorcycles:
+            kb.motorcycles = dict(self.motorcycles)
+            for motorcycle_id, brand in motorcycles.items():
+                if brand is None:
+                    kb.motorcycles.pop(motorcycle_id, None)
+                else:
+                    kb.motorcycles[motorcycle_id] = brand
+
+        dropped = set(removed)
+        if damages:
+            kb.damages = dict(self.damages)
+            for damage_id, payload in damages.items():
+                if payload is None:
+                    kb.damages.pop(damage_id, None)
+                else:
+                    kb.damages[damage_id] = payload
+            if any(payload is None for payload in damages.values()):
+                dropped.update(
+                    rule_id for rule_id, damage_id in zip(kb.rule_ids, kb.rule_damages)
+                    if damage_id not in kb.damages
+                )
+
+        # Like load(), rules concluding an unknown damage are not indexed
+        upserts = {}
+        for rule_id, damage_id, facts, scope in rules:
+            if damage_id in kb.damages:
+                upserts[rule_id] = (damage_id, facts, scope)
+            else:
+                dropped.add(rule_id)
+
+        # The delta per scope: (rules, removed ids), for the partitions
+        scoped = defaultdict(lambda: ([], set()))
+        for rule_id in sorted(dropped - set(upserts), reverse=True):
+            position = kb.position(rule_id)
+            if position is not None:
+                scoped[kb.rule_scopes[position]][1].add(rule_id)
+                kb._remove_position(position)
+        for rule_id in sorted(upserts):
+            damage_id, facts, scope = upserts[rule_id]
+            position = kb.position(rule_id)
+            if position is None:
+                position = bisect_left(kb.rule_ids, rule_id)
+                kb._insert_position(position, rule_id)
+            else:
+                if kb.rule_scopes[position] != scope:
+                    scoped[kb.rule_scopes[position]][1].add(rule_id)
+                kb._clear_rule(position)
+            kb._set_rule(position, damage_id, facts, scope)
+            scoped[scope][0].append((rule_id, damage_id, facts, scope))
+
+        while kb.length_slices and not kb.length_slices[-1]:
+            kb.length_slices.pop()
+        kb._index(kb.fact_rules)
+
+        for scope, partition in list(self._partitions.items()):
+            if scope not in kb.scope_masks:
+                continue
+            if scope in scoped:
+                partition = partition.patched(version, *scoped[scope], damages)
+            elif damages:
+                # Same rules, new damage payloads
+                partition = copy.copy(partition)
+                partition.damages = kb.damages
+            kb._partitions[scope] = partition
+        return kb
+
+    # The helpers below mutate in place and are only called by patched() on
+    # its private copy.
+
+    def _clear_rule(self, position):
+        """Removes the rule at position from the fact and length indexes."""
+        bit = 1 << position
+        facts = self.rule_facts[position]
+        for fact in facts:
+            rules = self.fact_rules[fact] & ~bit
+            if rules:
+                self.fact_rules[fact] = rules
+                self.postings[fact] = [p for p in self.postings[fact] if p != position]
+            else:
+                # fact_bits keeps the fact; its bit is simply unused
+                del self.fact_rules[fact]
+                del self.postings[fact]
+
+        length = len(facts)
+        for j in range(length.bit_length()):
+            if length >> j & 1:
+                self.length_slices[j] &= ~bit
+        rules = self.length_masks[length] & ~bit
+        if rules:
+            self.length_masks[length] = rules
+        else:
+            del self.length_masks[length]
+
+        rules = self.scope_masks[self.rule_scopes[position]] & ~bit
+        if rules:
+            self.scope_masks[self.rule_scopes[position]] = rules
+        else:
+            del self.scope_masks[self.rule_scopes[position]]
+
+        if not facts:
+            self.unconditional.remove(position)
+        self.rule_premises.pop(position, None)
+
+    def _set_rule(self, position, damage_id, facts, scope):
+        """Indexes a rule at an empty position, as __init__ does."""
+        bit = 1 << position
+        antecedent = tuple(set(facts))
+        mask = 0
+        for fact in antecedent:
+            mask |= 1 << self._bit(fact)
+            self.fact_rules[fact] = self.fact_rules.get(fact, 0) | bit
+            positions = list(self.postings.get(fact, ()))
+            insort(positions, position)
+            self.postings[fact] = positions
+
+        if not mask:
+            insort(self.unconditional, position)
+
+        premises = {fact.damage_id for fact in antecedent if isinstance(fact, DamageFact)}
+        if premises:
+            self.rule_premises[position] = premises
+
+        length = len(antecedent)
+        for j in range(length.bit_length()):
+            if j == len(self.length_slices):
+                self.length_slices.append(0)
+            if length >> j & 1:
+                self.length_slices[j] |= bit
+        self.length_masks[length] = self.length_masks.get(length, 0) | bit
+        self.scope_masks[scope] = self.scope_masks.get(scope, 0) | bit
+
+        self.rule_damages[position] = damage_id
+        self.rule_facts[position] = antecedent
+        self.rule_scopes[position] = scope
+        if isinstance(self.rule_masks, list):
+            self.rule_masks[position] = mask
+
+    def _shift(self, position, move, offset):
+        """Renumbers every rule at or after position by offset."""
+        for fact, rules in self.fact_rules.items():
+            if rules >> position:
+                self.fact_rules[fact] = move(rules, position)
+        self.length_slices = [move(s, position) if s >> position else s for s in self.length_slices]
+        self.length_masks = {
+            length: move(rules, position) if rules >> position else rules
+            for length, rules in self.length_masks.items()
+        }
+        self.scope_masks = {
+            scope: move(rules, position) if rules >> position else rules
+            for scope, rules in self.scope_masks.items()
+        }
+        for fact, positions in self.postings.items():
+            i = bisect_left(positions, position)
+            if i < len(positions):
+                self.postings[fact] = list(positions[:i]) + [p + offset for p in positions[i:]]
+        i = bisect_left(self.unconditional, position)
+        self.unconditional[i:] = [p + offset for p in self.unconditional[i:]]
+        self.rule_premises = {
+            p + offset if p >= position else p: premises for p, premises in self.rule_premises.items()
+        }
+
+    def _remove_position(self, position):
+        self._clear_rule(position)
+        self._shift(position + 1, _drop_bit, -1)
+        for rules in self._rule_columns():
+            del rules[position]
+
+    def _insert_position(self, position, rule_id):
+        self._shift(position, _open_bit, 1)
+        for rules in self._rule_columns():
+            rules.insert(position, None)
+        self.rule_ids[position] = rule_id
+
+    def _rule_columns(self):
+        columns = [self.rule_ids, self.rule_damages, self.rule_facts, self.rule_scopes]
+        if isinstance(self.rule_masks, list):
+            columns.append(self.rule_masks)
+        return columns
+
+    def _count_slices(self, facts):
+        """
+        Adds each fact's column bitset into a bit-sliced counter: afterwards
+        bit r of counter[j] is bit j of the number of rule r's premises that
+        are present.
+        """
+        counter = []
+        for fact in set(facts):
+            carry = self.fact_rules.get(fact, 0)
+            j = 0
+            while carry:
+                if j == len(counter):
+                    counter.append(carry)
+                    break
+                counter[j], carry = counter[j] ^ carry, counter[j] & carry
+                j += 1
+        return counter
+
+    def match_bits(self, facts):
+        """
+        Returns a bitset over rule positions with a bit set for every rule
+        whose antecedent is a subset of the given facts.
+
+        A rule matches when its hit count from _count_slices equals its
+        antecedent size. All rules are tested at once with a handful of
+        big-integer AND/XOR operations per fact.
+        """
+        counter = self._count_slices(facts)
+
+        length_slices = self.length_slices
+        diff = 0
+        for j in range(max(len(counter), len(length_slices))):
+            diff |= (counter[j] if j < len(counter) else 0) ^ (length_slices[j] if j < len(length_slices) else 0)
+
+        return self.all_rules & ~diff
+
+    def infer_bits(self, symptom_ids):
+        """
+        Forward-chains from the observed symptoms to a fixpoint and returns
+        the bitset of every rule that fired. Without chained rules this is a
+        single match.
+        """
+        facts = set(symptom_ids)
+        bits = self.match_bits(facts)
+
+        while self.chained:
+            concluded = {DamageFact(self.rule_damages[p]) for p in _positions(bits)} - facts
+            if not concluded:
+                break
+            facts |= concluded
+            bits = self.match_bits(facts)
+
+        return bits
+
+    def match(self, symptom_ids):
+        """Returns the positions of every rule that fires, in evaluation order."""
+        return _positions(self.infer_bits(symptom_ids))
+
+    def first_match(self, symptom_ids):
+        """
+        Returns the position of the rule whose conclusion is the diagnosis,
+        or None. Conclusions that only served as premises for another fired
+        rule are intermediate and are skipped.
+        """
+        bits = self.infer_bits(symptom_ids)
+        if not bits:
+            return None
+        if not self.chained:
+            return (bits & -bits).bit_length() - 1
+
+        return self._conclusion(_positions(bits))
+
+    def _conclusion(self, fired):
+        """Picks the diagnosis among fired rule positions given in ascending order."""
+        consumed = set()
+        for position in fired:
+            consumed.update(self.rule_premises.get(position, ()))
+        for position in fired:
+            if self.rule_damages[position] not in consumed:
+                return position
+        return fired[0]
+
+    def fingerprint(self):
+        """
+        Content hash of the rules and damage payloads. version only counts
+        invalidations within one process; the fingerprint is the same in
+        every process serving the same knowledge base.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(repr((list(self.rule_ids), list(self.rule_damages), list(self.rule_scopes))).encode())
+            digest.update(repr([
+                sorted(facts, key=lambda fact: (isinstance(fact, DamageFact), fact)) for facts in self.rule_facts
+            ]).encode())
+            damages = {str(damage_id): self.damages[damage_id] for damage_id in sorted(self.damages)}
+            digest.update(json.dumps(damages, sort_keys=True, default=str).encode())
+            digest.update(repr(sorted(self.motorcycles.items())).encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def damage_payload(self, position):
+        return self.damages[self.rule_damages[position]]
+
+    def conclude(self, symptom_ids):
+        """Returns the diagnosed damage id for the observed symptoms, or None."""
+        position = self.first_match(symptom_ids)
+        return self.rule_damages[position] if position is not None else None
+
+    def diagnose(self, symptom_ids):
+        """Returns the diagnosed damage payload for the observed symptoms, or None."""
+        position = self.first_match(symptom_ids)
+        return self.damage_payload(position) if position is not None else None
+
+    def rank(self, symptom_ids, top_k=5):
+        """
+        Returns the top_k damages by certainty factor (fraction of a rule's
+        premises that hold), including partial matches with the missing
+        symptoms listed. Only the best rule per damage is reported.
+
+        The bit-sliced counter from match_bits gives every rule's hit count
+        in the same pass as exact matching. Certainty levels (hits, size)
+        are then visited from best to worst, and each level is one bitset
+        of rules, so only the rules that end up in the result are decoded.
+        """
+        facts = set(symptom_ids)
+        for position in _positions(self.infer_bits(facts)) if self.chained else ():
+            facts.add(DamageFact(self.rule_damages[position]))
+
+        return [
+            self._candidate(position, certainty, facts)
+            for certainty, count, position in self._ranked(facts, top_k)
+        ]
+
+    def _ranked(self, facts, top_k):
+        """
+        Returns (certainty, hits, position) of the best rule for each of the
+        top_k damages, best first, for facts that already include every
+        concluded DamageFact.
+        """
+        counter = self._count_slices(facts)
+        touched = 0
+        for counter_slice in counter:
+            touched |= counter_slice
+
+        ranked = []
+        seen = set()
+        for certainty, count, size in self.rank_levels:
+            bits = self.length_masks[size] & (touched if count else self.all_rules)
+            if count.bit_length() > len(counter):
+                bits = 0
+            for j, counter_slice in enumerate(counter):
+                if not bits:
+                    break
+                bits &= counter_slice if count >> j & 1 else ~counter_slice
+
+            while bits and len(ranked) < top_k:
+                lowest = bits & -bits
+                bits ^= lowest
+                position = lowest.bit_length() - 1
+                damage_id = self.rule_damages[position]
+                if damage_id in seen:
+                    continue
+                seen.add(damage_id)
+                ranked.append((certainty, count, position))
+
+            if len(ranked) >= top_k:
+                break
+
+        return ranked
+
+    def _candidate(self, position, certainty, facts):
+        antecedent = self.rule_facts[position]
+        missing = [fact for fact in antecedent if fact not in facts]
+        return {
+            'rule_id': self.rule_ids[position],
+            'certainty': round(certainty, 4),
+            'matched_symptom_ids': sorted(f for f in antecedent if f in facts and not isinstance(f, DamageFact)),
+            'missing_symptom_ids': sorted(f for f in missing if not isinstance(f, DamageFact)),
+            'missing_premise_damage_ids': sorted(f.damage_id for f in missing if isinstance(f, DamageFact)),
+            'damage': self.damage_payload(position)
+        }
+
+    def network(self):
+        """Returns the Rete network for this knowledge base, compiled on first use."""
+        if self._network is None:
+            self._network = ReteNetwork(self)
+        return self._network
+
+    def partition(self, scope):
+        """
+        Returns the KnowledgeBase holding only the rules of one scope (None
+        for the generic rules), compiled on first use, or None when the
+        scope has no rules.
+        """
+        if scope not in self.scope_masks:
+            return None
+        if len(self.scope_masks) == 1:
+            return self
+        partition = self._partitions.get(scope)
+        if partition is None:
+            with span('engine.partition'):
+                partition = KnowledgeBase(self.version, [
+                    (self.rule_ids[p], self.rule_damages[p], self.rule_facts[p], scope)
+                    for p in _positions(self.scope_masks[scope])
+                ], self.damages, self.motorcycles)
+            self._partitions[scope] = partition
+        return partition
+
+    def scopes(self, motorcycle_id=None):
+        """
+        Returns the scopes with rules that apply to a motorcycle, most
+        specific first: the model's own, its brand's, then the generic one.
+        """
+        scopes = []
+        if type(motorcycle_id) is int:
+            scopes.append(motorcycle_id)
+            brand = self.motorcycles.get(motorcycle_id)
+            if brand is not None:
+                scopes.append(brand)
+        scopes.append(None)
+        return tuple(scope for scope in scopes if scope in self.scope_masks)
+
+    def scoped(self, motorcycle_id=None, build=True):
+        """
+        Returns the ScopedKnowledgeBase diagnosing for one motorcycle (no
+        motorcycle: generic rules only). With build=False, returns None
+        instead of compiling a partition, for callers that must not block.
+        """
+        scopes = self.scopes(motorcycle_id)
+        view = self._views.get(scopes)
+        if view is None:
+            if not build and len(self.scope_masks) > 1 and not all(s in self._partitions for s in scopes):
+                return None
+            view = self._views[scopes] = ScopedKnowledgeBase(self, scopes)
+        return view
+
+class ScopedKnowledgeBase:
+    """
+    The rules that apply to one motorcycle, as an ordered list of
+    partitions: the model's rules, its brand's, then the generic ones. A
+    diagnosis only evaluates these partitions, so its cost follows their
+    size rather than the whole catalogue's. Facts concluded in one
+    partition feed chained rules in the others, and when several rules
+    fire the more specific partition wins, so generic rules are the
+    fallback.
+    """
+    def __init__(self, kb, scopes):
+        self.kb = kb
+        self.version = kb.version
+        self.scopes = scopes
+        self.partitions = [kb.partition(scope) for scope in scopes]
+        self.chained = any(partition.chained for partition in self.partitions)
+        self._compiled = None
+
+    @property
+    def damages(self):
+        return self.kb.damages
+
+    def fingerprint(self):
+        """Content hash of the knowledge base and the scopes evaluated."""
+        return f'{self.kb.fingerprint()}:{"/".join(map(str, self.scopes))}'
+
+    def _infer(self, symptom_ids):
+        """
+        Forward-chains across the partitions to a fixpoint. Returns the
+        facts (observed and concluded) and each partition's fired bitset.
+        """
+        facts = set(symptom_ids)
+        fired = [partition.match_bits(facts) for partition in self.partitions]
+        while self.chained:
+            concluded = {
+                DamageFact(partition.rule_damages[p])
+                for partition, bits in zip(self.partitions, fired) for p in _positions(bits)
+            } - facts
+            if not concluded:
+                break
+            facts |= concluded
+            fired = [partition.match_bits(facts) for partition in self.partitions]
+        return facts, fired
+
+    def conclude(self, symptom_ids):
+        """Returns the diagnosed damage id for the observed symptoms, or None."""
+        if len(self.partitions) == 1:
+            return self.partitions[0].conclude(symptom_ids)
+
+        _, fired = self._infer(symptom_ids)
+        if not self.chained:
+            for partition, bits in zip(self.partitions, fired):
+                if bits:
+                    return partition.rule_damages[(bits & -bits).bit_length() - 1]
+            return None
+
+        # As KnowledgeBase._conclusion, over the partitions in order
+        fired = [(partition, _positions(bits)) for partition, bits in zip(self.partitions, fired)]
+        consumed = set()
+        for partition, positions in fired:
+            for position in positions:
+                consumed.update(partition.rule_premises.get(position, ()))
+        first = None
+        for partition, positions in fired:
+            for position in positions:
+                damage_id = partition.rule_damages[position]
+                if damage_id not in consumed:
+                    return damage_id
+                if first is None:
+                    first = damage_id
+        return first
+
+    def diagnose(self, symptom_ids):
+        """Returns the diagnosed damage payload for the observed symptoms, or None."""
+        damage_id = self.conclude(symptom_ids)
+        return self.kb.damages[damage_id] if damage_id is not None else None
+
+    def rank(self, symptom_ids, top_k=5):
+        """
+        KnowledgeBase.rank over the partitions. Each partition ranks its
+        own top_k damages and the lists are merged; on equal certainty and
+        hits the more specific partition comes first.
+        """
+        if len(self.partitions) == 1:
+            return self.partitions[0].rank(symptom_ids, top_k)
+
+        facts, _ = self._infer(symptom_ids)
+        ranked = sorted(
+            (-certainty, -count, index, order, position, certainty)
+            for index, partition in enumerate(self.partitions)
+            for order, (certainty, count, position) in enumerate(partition._ranked(facts, top_k))
+        )
+        candidates = []
+        seen = set()
+        for _, _, index, _, position, certainty in ranked:
+            partition = self.partitions[index]
+            damage_id = partition.rule_damages[position]
+            if damage_id in seen:
+                continue
+            seen.add(damage_id)
+            candidates.append(partition._candidate(position, certainty, facts))
+            if len(candidates) >= top_k:
+                break
+        return candidates
+
+    def compiled(self):
+        """
+        Returns one KnowledgeBase holding the partitions' rules in
+        precedence order (so positions are not in rule id order), for the
+        interactive sessions that walk a single index.
+        """
+        if len(self.partitions) == 1:
+            return self.partitions[0]
+        if self._compiled is None:
+            rules = [
+                (partition.rule_ids[p], partition.rule_damages[p], partition.rule_facts[p], scope)
+                for scope, partition in zip(self.scopes, self.partitions)
+                for p in range(len(partition.rule_ids))
+            ]
+            self._compiled = KnowledgeBase(self.version, rules, self.kb.damages, self.kb.motorcycles)
+        return self._compiled
+
+class ReteNetwork:
+    """
+    Rete-style discrimination network over a KnowledgeBase.
+
+    Each rule's antecedent is sorted by descending fact frequency and
+    inserted into a prefix tree, so rules sharing a prefix share the join
+    nodes for it. A node is one join: "all facts on the path from the root
+    are present". The alpha memory maps each fact to the nodes that test it.
+    """
+    def __init__(self, kb):
+        self.kb = kb
+        self.node_fact = []
+        self.node_parent = []
+        self.node_children = []
+        self.node_rules = []
+        self.root_children = {}
+        self.alpha = defaultdict(list)
+
+        frequency = {fact: len(positions) for fact, positions in kb.postings.items()}
+        bit = kb.fact_bits
+
+        for position, facts in enumerate(kb.rule_facts):
+            node = None
+            children = self.root_children
+            for fact in sorted(facts, key=lambda fact: (-frequency[fact], bit[fact])):
+                child = children.get(fact)
+                if child is None:
+                    child = len(self.node_fact)
+                    self.node_fact.append(fact)
+                    self.node_parent.append(node)
+                    self.node_children.append({})
+                    self.node_rules.append([])
+                    self.alpha[fact].append(child)
+                    children[fact] = child
+                node = child
+                children = self.node_children[node]
+
+            if node is not None:
+                self.node_rules[node].append(position)
+
+        self.alpha = dict(self.alpha)
+
+    def session(self):
+        return ReteSession(self)
+
+class ReteSession:
+    """
+    Working memory for one interactive diagnosis. Facts are asserted one at
+    a time and only the join nodes reachable from the new fact are visited.
+    """
+    def __init__(self, network):
+        self.network = network
+        self.facts = set()
+        self.satisfied = set()
+        self.fired = []
+
+        agenda = []
+        for position in network.kb.unconditional:
+            self._fire(position, agenda, [])
+        self._propagate(agenda, [])
+
+    def _fire(self, position, agenda, fired):
+        self.fired.append(position)
+        fired.append(position)
+        agenda.append(DamageFact(self.network.kb.rule_damages[position]))
+
+    def _activate(self, node, agenda, fired):
+        network = self.network
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.satisfied.add(node)
+            for position in network.node_rules[node]:
+                self._fire(position, agenda, fired)
+            for fact, child in network.node_children[node].items():
+                if fact in self.facts:
+                    stack.append(child)
+
+    def _propagate(self, agenda, fired):
+        network = self.network
+        while agenda:
+            fact = agenda.pop()
+            if fact in self.facts:
+                continue
+            self.facts.add(fact)
+
+            for node in network.alpha.get(fact, ()):
+                parent = network.node_parent[node]
+                if parent is None or parent in self.satisfied:
+                    self._activate(node, agenda, fired)
+
+    def assert_symptom(self, symptom_id):
+        """
+        Adds an observed symptom and propagates it, including through chained
+        rules. Returns the positions of the rules that fired as a result.
+        """
+        fired = []
+        self._propagate([symptom_id], fired)
+        return sorted(fired)
+
+    def conclusions(self):
+        """Returns the damage payloads concluded so far, in evaluation order."""
+        kb = self.network.kb
+        seen = set()
+        payloads = []
+        for position in sorted(self.fired):
+            damage_id = kb.rule_damages[position]
+            if damage_id not in seen:
+                seen.add(damage_id)
+                payloads.append(kb.damages[damage_id])
+        return payloads
+
+class QuestionSession:
+    """
+    Interactive diagnosis that asks for one symptom at a time.
+
+    The rules that can still fire and change the outcome are kept as a
+    bitset over rule positions. Denying a symptom removes every rule that needs it with one AND against
+    that symptom's column; confirming one asserts it into a ReteSession, so
+    rules (including chained ones) fire incrementally and stop being open
+    candidates.
+    """
+    # Below this many candidates, questions come from the candidates' own
+    # antecedents instead of a scan over every symptom column
+    SMALL_CANDIDATE_SET = 64
+
+    def __init__(self, kb, symptom_ids=(), motorcycle_id=None):
+        self.kb = kb
+        self.motorcycle_id = motorcycle_id  # The kb's scope, kept so the session can be rebuilt
+        self.rete = kb.network().session()
+        self.confirmed = set()
+        self.denied = set()
+        self.candidates = kb.all_rules
+        self.lock = threading.Lock()
+        self._prune_fired()
+        for symptom_id in symptom_ids:
+            self.answer(symptom_id, True)
+
+    def answer(self, symptom_id, present):
+        """Records a confirmed or denied symptom and prunes the candidate rules."""
+        if symptom_id in self.confirmed or symptom_id in self.denied:
+            return
+        if present:
+            self.confirmed.add(symptom_id)
+            if self.rete.assert_symptom(symptom_id):
+                self._prune_fired()
+        else:
+            self.denied.add(symptom_id)
+            self.candidates &= ~self.kb.fact_rules.get(symptom_id, 0)
+
+    def _prune_fired(self):
+        """
+        Drops fired rules from the candidates, along with every rule after
+        the current diagnosis: rules are evaluated in order, so those can
+        no longer change the outcome. That does not hold once rules chain
+        (a later rule consuming a concluded damage moves the diagnosis past
+        rules already dropped), so chained knowledge bases only drop the
+        fired rules.
+        """
+        if not self.rete.fired:
+            return
+        if not self.kb.chained:
+            position = self.kb._conclusion(sorted(self.rete.fired))
+            self.candidates &= (1 << position) - 1
+        for position in self.rete.fired:
+            self.candidates &= ~(1 << position)
+
+    def diagnosis(self):
+        """Returns the damage concluded from the confirmed symptoms so far, or None."""
+        if not self.rete.fired:
+            return None
+        return self.kb.damage_payload(self.kb._conclusion(sorted(self.rete.fired)))
+
+    def next_question(self):
+        """
+        Returns (symptom_id, hits, total) for the unanswered symptom that
+        best splits the candidate rules, or None when nothing is left to
+        ask. hits is how many of the total candidates need the symptom.
+
+        With every candidate rule equally likely, the information gain of a
+        question is the binary entropy of hits / total, so the best symptom
+        is the one closest to an even split. Ties go to the symptom more
+        candidates need, which also settles the last remaining rule. Each
+        step costs one AND and popcount per symptom column.
+        """
+        candidates = self.candidates
+        total = _popcount(candidates)
+        if not total:
+            return None
+
+        kb = self.kb
+        if total <= self.SMALL_CANDIDATE_SET:
+            facts = {fact for position in _positions(candidates) for fact in kb.rule_facts[position]}
+        else:
+            facts = kb.fact_rules
+        answered = self.confirmed | self.denied
+
+        best = None
+        best_score = None
+        for fact in facts:
+            if isinstance(fact, DamageFact) or fact in answered:
+                continue
+            hits = _popcount(candidates & kb.fact_rules[fact])
+            if not hits:
+                continue
+            score = (min(hits, total - hits) if hits < total else 0, hits)
+            if best_score is None or score > best_score:
+                best, best_score = fact, score
+        return (best, best_score[1], total) if best is not None else None
 
 class ForwardChainingEngine:
+    """
+    Holds the compiled knowledge base of this process. Its version is the
+    shared one from the kb_version row (bump_kb_version), read again every
+    check_interval seconds, so writes made through other processes are
+    picked up without a snapshot.
+    """
     def __init__(self):
-        pass
-        
-    def diagnose(self, symptom_ids):
+        self._kb = None
+        self._version = None
+        self._lock = threading.Lock()
+        self._check_interval = 1.0
+        self._next_check = 0.0
+        self._snapshot_path = None
+        self._dirty = False
+
+    @property
+    def version(self):
+        """Newest shared knowledge-base version this process has seen (None before the first check)."""
+        return self._version
+
+    def configure(self, snapshot_path=None, check_interval=1.0):
+        """
+        Sets how often the shared version is read, and optionally enables
+        loading the knowledge base from a binary snapshot (see
+        app/snapshot.py) written for that version. Forgets the compiled
+        knowledge base, since it may belong to another database.
+        """
+        with self._lock:
+            self._snapshot_path = snapshot_path
+            self._check_interval = check_interval
+            self._kb = None
+            self._version = None
+            self._next_check = 0.0
+
+    def check_due(self):
+        """True when the shared version should be read again."""
+        return self._version is None or time.monotonic() >= self._next_check
+
+    def observe(self, version):
+        """Records a shared version read from the database; a newer one makes the compiled knowledge base stale."""
+        self._next_check = time.monotonic() + self._check_interval
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+
+    def poll(self):
+        """
+        Reads the shared version when a check is due (needs an app context)
+        and returns the newest version seen.
+        """
+        if self.check_due():
+            self.observe(read_kb_version(db.session))
+        return self._version
+
+    def invalidate(self):
+        """
+        Drops the compiled knowledge base, so the next use recompiles it from
+        the database rather than from a snapshot. Writes that bumped the
+        shared version do not need this; it is for bulk loads in this process.
+        """
+        with self._lock:
+            self._kb = None
+            self._dirty = True
+
+    def refresh(self, version, rule_ids=(), damage_ids=(), motorcycle_ids=()):
+        """
+        Publishes committed writes to the given rules, damages and
+        motorcycles by patching the compiled knowledge base instead of
+        recompiling it. Ids whose rows are gone are removed. Readers holding
+        the previous KnowledgeBase keep a consistent view of it (see
+        KnowledgeBase.patched).
+
+        Args:
+            version (int): Shared version the write's transaction bumped to
+
+        Returns:
+            KnowledgeBaseDelta, or None when the compiled knowledge base was
+            not at version - 1 (another process wrote in between, or there
+            was none); the next knowledge_base() call then rebuilds it
+        """
+        rule_ids = set(rule_ids)
+        damage_ids = set(damage_ids)
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+            previous = self._kb
+            if previous is None or previous.version != version - 1:
+                return None
+
+            added = [damage_id for damage_id in damage_ids if damage_id not in previous.damages]
+            if added:
+                # Rules concluding a damage the index did not know were skipped
+                rule_ids.update(db.session.scalars(select(Rule.id).where(Rule.damage_id.in_(added))))
+            rules = load_rules(db.session, rule_ids) if rule_ids else []
+            damages = dict.fromkeys(damage_ids)
+            if damage_ids:
+                damages.update(load_damages(db.session, damage_ids))
+            motorcycles = dict.fromkeys(motorcycle_ids)
+            if motorcycle_ids:
+                motorcycles.update(load_motorcycles(db.session, motorcycles))
+            antecedents = [
+                previous.rule_facts[position]
+                for position in map(previous.position, rule_ids) if position is not None
+            ]
+            antecedents.extend(facts for _, _, facts, _ in rules)
+            removed = rule_ids - {rule_id for rule_id, _, _, _ in rules}
+
+            with span('engine.patch'):
+                kb = previous.patched(version, rules, removed, damages, motorcycles)
+            self._kb = kb
+        # Outside the lock so readers are not held up; export_snapshot never
+        # lets an older knowledge base replace a newer one
+        if self._snapshot_path:
+            self._export(kb)
+        return KnowledgeBaseDelta(previous, kb, antecedents, damage_ids)
+
+    def current(self):
+        """
+        Returns the compiled knowledge base if it is up to date, else None.
+        Never compiles or queries, so it is safe to call from an event loop;
+        it also returns None while a check of the shared version is due.
+        """
+        kb = self._kb
+        if kb is not None and kb.version == self._version and not self.check_due():
+            return kb
+        return None
+
+    def knowledge_base(self):
+        """Returns the compiled knowledge base, rebuilding it if it is stale."""
+        kb = self.current()
+        if kb is not None:
+            return kb
+
+        version = self.poll()
+        export = False
+        with self._lock:
+            kb = self._kb
+            if kb is None or kb.version != version:
+                kb, export = self._build()
+                self._kb = kb
+                if kb.version > self._version:
+                    self._version = kb.version
+        if export:
+            self._export(kb)
+        return kb
+
+    def _build(self):
+        """Returns (knowledge base, whether it was compiled and should be exported to the snapshot)."""
+        # Read in the same transaction as the rules, so the version matches them
+        version = read_kb_version(db.session)
+        if self._snapshot_path is None:
+            with span('engine.compile'):
+                return KnowledgeBase.load(db.session, version), False
+
+        from .snapshot import load_knowledge_base
+        if not self._dirty:
+            try:
+                with span('engine.snapshot_load'):
+                    kb = load_knowledge_base(self._snapshot_path, version)
+                if kb is not None:
+                    return kb, False
+            except (FileNotFoundError, ValueError):
+                pass  # Missing, unreadable or older format: rebuild and overwrite it
+
+        with span('engine.compile'):
+            kb = KnowledgeBase.load(db.session, version)
+        self._dirty = False
+        return kb, True
+
+    def _export(self, kb):
+        from .snapshot import export_snapshot
+        with span('engine.snapshot_write'):
+            export_snapshot(self._snapshot_path, kb)
+
+    def start_questions(self, symptom_ids=(), motorcycle_id=None):
+        """Returns a QuestionSession over the current rules for a motorcycle."""
+        return QuestionSession(self.knowledge_base().scoped(motorcycle_id).compiled(), symptom_ids, motorcycle_id)
+
+    def start_session(self, motorcycle_id=None):
+        """Returns an incremental ReteSession over the current rules for a motorcycle."""
+        return self.knowledge_base().scoped(motorcycle_id).compiled().network().session()
+
+    def diagnose(self, symptom_ids, motorcycle_id=None):
         """
         Implements the forward chaining algorithm to diagnose motor damage
         based on observed symptoms.
-        
+
         Args:
             symptom_ids (list): List of symptom IDs observed
-            
+            motorcycle_id (int): Motorcycle whose model and brand rules
+                apply besides the generic ones
+
         Returns:
             dict: Diagnosed damage with causes and solutions
         """
-        rules = Rule.query.all()
-        potential_damages = []
-        
-        for rule in rules:
-            rule_symptom_ids = [rs.symptom_id for rs in RuleSymptom.query.filter_by(rule_id=rule.id).all()]
-            
-            if all(symptom_id in symptom_ids for symptom_id in rule_symptom_ids):
-                damage = Damage.query.get(rule.damage_id)
-                potential_damages.append(damage)
-                
-        if potential_damages:
-            damage = potential_damages[0]  # Simplification: pick first match
-            return damage.to_dict()
-        else:
-            return None
\ No newline at end of file
+        kb = self.knowledge_base().scoped(motorcycle_id)
+        with span('engine.match'):
+            return kb.diagnose(symptom_ids)
+
+    def rank(self, symptom_ids, top_k=5, motorcycle_id=None):
+        """
+        Returns up to top_k candidate damages, including partial matches,
+        ordered by certainty factor. See KnowledgeBase.rank.
+        """
+        kb = self.knowledge_base().scoped(motorcycle_id)
+        with span('engine.rank'):
+            return kb.rank(symptom_ids, top_k)
@@ -0,0 +1,187 @@
+"""
+Consultation ids, allocated in the application for every insert path
+(/api/diagnose and /api/diagnose/batch, in WSGI, ASGI and write-behind
+mode) so pre-allocated ids never mix with AUTO_INCREMENT ones.
+
+Each process leases a worker id from the worker_id_leases table, which
+keeps ids unique across processes and hosts sharing the database. A
+background thread renews the lease; a process that dies stops renewing
+and its worker id is taken over once the lease expires.
+"""
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from . import db
+from .models import WorkerIdLease
+
+logger = logging.getLogger(__name__)
+
+# 2024-01-01T00:00:00Z in milliseconds
+ID_EPOCH_MS = 1704067200000
+WORKER_BITS = 7
+SEQUENCE_BITS = 6
+MAX_WORKERS = 1 << WORKER_BITS
+
+class IdAllocator:
+    """
+    Time-ordered 53-bit ids: 40 bits of milliseconds since ID_EPOCH_MS, 7 bits
+    of worker id and a 6-bit sequence. 53 bits keeps ids exact in
+    JavaScript clients; up to 128 processes can allocate at once, each up
+    to 64 ids per millisecond.
+
+    The worker id is leased on first use and renewed every lease_ttl / 3
+    seconds. If a renewal finds the lease taken over (this process stalled
+    past its expiry), the next id leases a new worker id. While the
+    database is unreachable the current lease is kept: other processes
+    need the database to take it over.
+    """
+    def __init__(self, app, lease_ttl=60):
+        self.app = app
+        self.lease_ttl = lease_ttl
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.worker_id = None
+        self._pid = os.getpid()
+        self._checked = 0.0
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def next_id(self):
+        with self._lock:
+            if self.worker_id is None:
+                self._acquire()
+            elif time.monotonic() - self._checked > self.lease_ttl * 2 / 3:
+                # The heartbeat has not run for a while (the process was stalled); check before issuing
+                self._renewal_result(self.worker_id, self._renew(self.worker_id))
+                if self.worker_id is None:
+                    self._acquire()
+
+            now = int(time.time() * 1000) - ID_EPOCH_MS
+            if now < self._last_ms:
+                now = self._last_ms  # Clock went backwards; keep ids increasing
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    while now <= self._last_ms:
+                        time.sleep(0.0001)
+                        now = int(time.time() * 1000) - ID_EPOCH_MS
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+    def lease(self):
+        """Leases a worker id now instead of on the first id; returns it."""
+        with self._lock:
+            if self.worker_id is None:
+                self._acquire()
+            return self.worker_id
+
+    def release(self):
+        """Stops renewing and frees the worker id for other processes."""
+        self._stop.set()
+        with self._lock:
+            worker_id, self.worker_id = self.worker_id, None
+        # atexit handlers survive fork; only the process that leased releases
+        if worker_id is None or os.getpid() != self._pid:
+            return
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    delete(WorkerIdLease)
+                    .where(WorkerIdLease.worker_id == worker_id, WorkerIdLease.holder == self.holder)
+                )
+        except SQLAlchemyError:
+            logger.exception('Could not release consultation worker id %d', worker_id)
+
+    def _connect(self):
+        # Own transaction, independent of whatever the caller's session has open
+        with self.app.app_context():
+            return db.engine.begin()
+
+    def _acquire(self):
+        now = datetime.utcnow()
+        values = {'holder': self.holder, 'expires_at': now + timedelta(seconds=self.lease_ttl)}
+        with self._connect() as connection:
+            leases = dict(connection.execute(select(WorkerIdLease.worker_id, WorkerIdLease.expires_at)).all())
+
+        for worker_id in range(MAX_WORKERS):
+            if worker_id not in leases:
+                try:
+                    with self._connect() as connection:
+                        connection.execute(insert(WorkerIdLease).values(worker_id=worker_id, **values))
+                except IntegrityError:
+                    continue  # Another process leased it first
+            elif leases[worker_id] < now:
+                # Take over an expired lease unless another process just did
+                with self._connect() as connection:
+                    taken = connection.execute(
+                        update(WorkerIdLease)
+                        .where(WorkerIdLease.worker_id == worker_id, WorkerIdLease.expires_at < now)
+                        .values(**values)
+                    ).rowcount
+                if not taken:
+                    continue
+            else:
+                continue
+
+            self.worker_id = worker_id
+            self._checked = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._heartbeat, name='worker-id-lease', daemon=True)
+                self._thread.start()
+                atexit.register(self.release)
+            logger.info('Leased consultation worker id %d', worker_id)
+            return
+
+        raise RuntimeError(
+            f'All {MAX_WORKERS} consultation worker ids are leased; '
+            'run fewer processes against this database'
+        )
+
+    def _renew(self, worker_id):
+        """Extends the lease; returns False when another process has taken it over, None on errors."""
+        try:
+            with self._connect() as connection:
+                return bool(connection.execute(
+                    update(WorkerIdLease)
+                    .where(WorkerIdLease.worker_id == worker_id, WorkerIdLease.holder == self.holder)
+                    .values(expires_at=datetime.utcnow() + timedelta(seconds=self.lease_ttl))
+                ).rowcount)
+        except SQLAlchemyError:
+            logger.exception('Could not renew the lease on consultation worker id %d', worker_id)
+            return None
+
+    def _renewal_result(self, worker_id, renewed):
+        # Called with the lock held; ignores results for a worker id already replaced
+        if worker_id != self.worker_id:
+            return
+        self._checked = time.monotonic()
+        if renewed is False:
+            logger.error('Lost the lease on consultation worker id %d; leasing another', worker_id)
+            self.worker_id = None
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.lease_ttl / 3):
+            worker_id = self.worker_id
+            if worker_id is None:
+                continue
+            # Renew outside the lock so id allocation never waits on the database
+            renewed = self._renew(worker_id)
+            with self._lock:
+                self._renewal_result(worker_id, renewed)
+
+def init_id_allocator(app):
+    """Creates the process's consultation id allocator (app.extensions['consultation_ids'])."""
+    allocator = IdAllocator(app, lease_ttl=app.config['WORKER_ID_LEASE_TTL'])
+    app.extensions['consultation_ids'] = allocator
+    return allocator
@@ -0,0 +1,294 @@
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from . import db
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+class Metric:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+
+class CounterMetric(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _format_labels(self.labels, key), value) for key, value in self._values.items()]
+
+class HistogramMetric(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, counts in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append((self.name + '_bucket' + _format_labels(self.labels, key, [('le', bound)]), count))
+                lines.append((self.name + '_bucket' + _format_labels(self.labels, key, [('le', '+Inf')]), counts[-2]))
+                lines.append((self.name + '_count' + _format_labels(self.labels, key), counts[-2]))
+                lines.append((self.name + '_sum' + _format_labels(self.labels, key), counts[-1]))
+        return lines
+
+class Registry:
+    """
+    Process-local metrics rendered in the Prometheus text exposition format.
+    Gauges whose value lives elsewhere (cache sizes, queue depths) are
+    registered as callbacks and read at scrape time.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.gauges = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = CounterMetric(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = HistogramMetric(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name, help_text, fn, label='key'):
+        """
+        fn returns a number, or a dict of label value -> number. Registering
+        the same name again replaces the callback (one app per process).
+        """
+        self.gauges = [gauge for gauge in self.gauges if gauge[0] != name]
+        self.gauges.append((name, help_text, fn, label))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        for name, help_text, fn, label in self.gauges:
+            value = fn()
+            if value is None:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            if isinstance(value, dict):
+                lines.extend(f'{name}{{{label}="{k}"}} {v}' for k, v in value.items())
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+http_requests = registry.counter('http_requests_total', 'HTTP requests handled.', ('method', 'endpoint', 'status'))
+http_duration = registry.histogram('http_request_duration_seconds', 'HTTP request latency.', ('method', 'endpoint'))
+http_queries = registry.histogram('http_request_sql_queries', 'SQL statements per HTTP request.', ('method', 'endpoint'), COUNT_BUCKETS)
+sql_duration = registry.histogram('sql_query_duration_seconds', 'SQL statement latency.')
+span_duration = registry.histogram('span_duration_seconds', 'Time spent in instrumented stages.', ('span',))
+
+@contextmanager
+def span(name):
+    """
+    Times a stage of request handling (engine matching, ORM loading,
+    serialization). The time is reported in Server-Timing and in
+    span_duration_seconds. Outside a request it only feeds the histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        span_duration.observe(elapsed, span=name)
+        if has_request_context() and 'spans' in g:
+            g.spans[name] += elapsed
+
+class SamplingProfiler:
+    """
+    Samples one thread's Python stack every interval seconds and counts
+    folded stacks ("outer;inner;leaf" lines, as used by flamegraph.pl and
+    speedscope). Sampling keeps the overhead independent of call volume.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+def instrument_engine(engine):
+    """
+    Times every statement on engine into sql_duration_seconds and, inside a
+    Flask request, into its per-request SQL count. For an async engine pass
+    its sync_engine.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        sql_duration.observe(elapsed)
+        if has_request_context() and 'sql_count' in g:
+            g.sql_count += 1
+            g.sql_time += elapsed
+
+def _endpoint_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+def init_instrumentation(app):
+    """
+    Hooks SQL and request timing into the app, exposes /metrics and adds a
+    Server-Timing header to every response. When PROFILING_ENABLED is set,
+    a request carrying 'X-Profile: 1' is sampled and its folded stacks are
+    written under PROFILE_DIR.
+    """
+    from .routes import token_cache, response_cache, session_store, diagnosis_memo
+
+    if not app.config.get('PROFILE_DIR'):
+        app.config['PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')
+
+    caches = {
+        'token': token_cache, 'response': response_cache, 'session': session_store,
+        'diagnosis': diagnosis_memo.local
+    }
+    for stat in ('size', 'hits', 'misses', 'evictions'):
+        registry.gauge_callback(
+            f'cache_{stat}', f'In-process cache {stat}.',
+            lambda stat=stat: {name: cache.stats()[stat] for name, cache in caches.items()},
+            label='cache'
+        )
+    registry.gauge_callback(
+        'diagnosis_cache_shared', 'Shared diagnosis cache backend counters.',
+        lambda: {stat: diagnosis_memo.stats()['shared'][stat] for stat in ('hits', 'misses', 'errors')}
+        if diagnosis_memo.backend is not None else None,
+        label='stat'
+    )
+    registry.gauge_callback(
+        'write_behind', 'Write-behind consultation writer counters.',
+        lambda: app.extensions['consultation_writer'].stats() if 'consultation_writer' in app.extensions else None,
+        label='stat'
+    )
+
+    instrument_engine(db.engine)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.spans = defaultdict(float)
+        if app.config.get('PROFILING_ENABLED') and request.headers.get('X-Profile') == '1':
+            g.profiler = SamplingProfiler(threading.get_ident(), app.config['PROFILE_INTERVAL']).start()
+
+    @app.after_request
+    def record_request(response):
+        if 'request_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        method = request.method
+        endpoint = _endpoint_label()
+
+        http_requests.inc(method=method, endpoint=endpoint, status=response.status_code)
+        http_duration.observe(elapsed, method=method, endpoint=endpoint)
+        http_queries.observe(g.sql_count, method=method, endpoint=endpoint)
+
+        timings = [f'sql;dur={g.sql_time * 1000:.2f};desc="{g.sql_count} queries"']
+        timings.extend(f'{name};dur={seconds * 1000:.2f}' for name, seconds in g.spans.items())
+        timings.append(f'total;dur={elapsed * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+        path = finish_profile()
+        if path is not None:
+            response.headers['X-Profile-File'] = path
+
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        # after_request is skipped when the view raises; never leave a sampler running
+        finish_profile()
+
+    profile_counter = itertools.count()
+
+    def finish_profile():
+        """Stops the request's profiler, if any, and writes its samples; returns the file path."""
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return None
+        profiler.stop()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        endpoint = _endpoint_label().strip('/').replace('/', '_') or 'root'
+        # pid and a per-process counter keep concurrent requests to one endpoint apart
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(profile_counter)}-{request.method}-{endpoint}.folded"
+        path = os.path.join(app.config['PROFILE_DIR'], name)
+        profiler.write(path)
+        return path
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
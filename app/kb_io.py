@@ -0,0 +1,446 @@
+"""
+Bulk import and export of the knowledge base as code-keyed bundles.
+
+A bundle has five sections that reference each other by code (G1, K4)
+instead of database ids, so it can move between databases:
+
+    symptoms   code, name, description
+    damages    code, name, description
+    causes     damage, description
+    solutions  damage, description
+    rules      damage, symptoms, premises, brand, model
+
+A rule with a brand applies to that brand's motorcycles, with a brand and
+model to that one motorcycle (which must exist), and without either to
+every motorcycle. In JSON a bundle is an object of section lists. As CSV it is one file per
+section; rule symptoms and premises are space-separated code lists.
+Imports are idempotent: symptoms and damages are upserted by code, and
+causes, solutions and rules that already exist are left alone.
+"""
+import csv
+import io
+import json
+import os
+import zipfile
+from collections import defaultdict
+import click
+from sqlalchemy import select, insert, update, text
+from . import db
+from .cli import kb_cli
+from .expert_system import brand_key, rule_scope, bump_kb_version
+from .models import Motorcycle, Symptom, Damage, Cause, Solution, Rule, RuleSymptom, RuleDamage
+
+SECTIONS = {
+    'symptoms': ('code', 'name', 'description'),
+    'damages': ('code', 'name', 'description'),
+    'causes': ('damage', 'description'),
+    'solutions': ('damage', 'description'),
+    'rules': ('damage', 'symptoms', 'premises', 'brand', 'model')
+}
+CODE_LENGTH = 10  # Symptom.code / Damage.code column size
+CHUNK_SIZE = 1000
+
+class BundleError(ValueError):
+    """Raised when a bundle fails validation; errors lists every problem found."""
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} error(s) in knowledge-base bundle')
+        self.errors = errors
+
+def _codes(value):
+    """Rule symptoms/premises arrive as lists (JSON) or space-separated strings (CSV)."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.replace(',', ' ').split()
+    return list(value)
+
+def _known(code, codes):
+    return isinstance(code, str) and code in codes
+
+def _chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def read_csv_sections(files):
+    """
+    Builds a bundle from CSV text. files maps a section name (or a file
+    name such as 'rules.csv') to a text stream.
+    """
+    bundle = {}
+    for name, stream in files.items():
+        section = os.path.splitext(os.path.basename(name))[0]
+        if section not in SECTIONS:
+            raise BundleError([f'Unknown section {name!r}; expected one of {", ".join(SECTIONS)}'])
+        bundle[section] = [
+            {key: (value if value != '' else None) for key, value in row.items() if key in SECTIONS[section]}
+            for row in csv.DictReader(stream)
+        ]
+    return bundle
+
+def read_bundle(path):
+    """Reads a bundle from a .json file, a .zip of CSV files or a directory of CSV files."""
+    if os.path.isdir(path):
+        files = {
+            name: open(os.path.join(path, name), newline='', encoding='utf-8-sig')
+            for name in os.listdir(path) if name.endswith('.csv')
+        }
+        try:
+            return read_csv_sections(files)
+        finally:
+            for f in files.values():
+                f.close()
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return read_csv_sections({
+                name: io.TextIOWrapper(archive.open(name), encoding='utf-8-sig', newline='')
+                for name in archive.namelist() if name.endswith('.csv')
+            })
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _code_map(model):
+    """code -> id with a single query; duplicate codes resolve to the oldest row."""
+    ids = {}
+    for code, row_id in db.session.execute(select(model.code, model.id).order_by(model.id.desc())):
+        ids[code] = row_id
+    return ids
+
+def _motorcycle_map():
+    """(brand key, model key) -> motorcycle id with a single query."""
+    return {
+        (brand_key(brand), brand_key(model)): motorcycle_id
+        for motorcycle_id, brand, model in db.session.execute(
+            select(Motorcycle.id, Motorcycle.brand, Motorcycle.model).order_by(Motorcycle.id.desc())
+        )
+    }
+
+def validate(bundle, symptom_ids, damage_ids, motorcycle_ids=None):
+    """
+    Checks a bundle in memory against the codes (and motorcycles) already
+    in the database. Returns the normalized sections, or raises BundleError.
+    """
+    motorcycle_ids = motorcycle_ids or {}
+    errors = []
+    if not isinstance(bundle, dict):
+        raise BundleError(['Bundle must be an object with ' + ', '.join(SECTIONS) + ' lists'])
+    unknown = set(bundle) - set(SECTIONS)
+    if unknown:
+        errors.append('Unknown section(s): ' + ', '.join(sorted(unknown)))
+
+    sections = {name: bundle.get(name) or [] for name in SECTIONS}
+    for name, rows in sections.items():
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise BundleError([f'{name} must be a list of objects'])
+
+    known = {'symptoms': set(symptom_ids), 'damages': set(damage_ids)}
+    for name in ('symptoms', 'damages'):
+        seen = set()
+        for i, row in enumerate(sections[name]):
+            code, label = row.get('code'), f'{name}[{i}]'
+            if not code or not isinstance(code, str) or len(code) > CODE_LENGTH:
+                errors.append(f'{label}: code must be a string of 1-{CODE_LENGTH} characters')
+            elif code in seen:
+                errors.append(f'{label}: duplicate code {code}')
+            seen.add(code)
+            if not row.get('name'):
+                errors.append(f'{label}: name is required')
+        known[name] |= seen
+
+    for name in ('causes', 'solutions'):
+        for i, row in enumerate(sections[name]):
+            if not _known(row.get('damage'), known['damages']):
+                errors.append(f'{name}[{i}]: unknown damage {row.get("damage")!r}')
+            if not row.get('description'):
+                errors.append(f'{name}[{i}]: description is required')
+
+    rules = []
+    for i, row in enumerate(sections['rules']):
+        label = f'rules[{i}]'
+        symptoms, premises = _codes(row.get('symptoms')), _codes(row.get('premises'))
+        if not _known(row.get('damage'), known['damages']):
+            errors.append(f'{label}: unknown damage {row.get("damage")!r}')
+        if not symptoms and not premises:
+            errors.append(f'{label}: needs at least one symptom or premise')
+        for code in symptoms:
+            if not _known(code, known['symptoms']):
+                errors.append(f'{label}: unknown symptom {code!r}')
+        for code in premises:
+            if not _known(code, known['damages']):
+                errors.append(f'{label}: unknown premise damage {code!r}')
+        brand, model, motorcycle_id = row.get('brand') or None, row.get('model') or None, None
+        if brand is not None and not (isinstance(brand, str) and brand.strip() and len(brand) <= 100):
+            errors.append(f'{label}: brand must be a string of 1-100 characters')
+        elif model is not None:
+            if brand is None:
+                errors.append(f'{label}: model {model!r} needs a brand')
+            else:
+                motorcycle_id = motorcycle_ids.get((brand_key(brand), brand_key(str(model))))
+                if motorcycle_id is None:
+                    errors.append(f'{label}: unknown motorcycle {brand} {model}')
+        rules.append({
+            'damage': row.get('damage'),
+            'symptoms': symptoms,
+            'premises': premises,
+            # A model rule is scoped by its motorcycle alone
+            'motorcycle_id': motorcycle_id,
+            'brand': brand.strip() if brand and motorcycle_id is None else None
+        })
+    sections['rules'] = rules
+
+    if errors:
+        raise BundleError(errors)
+    return sections
+
+def _commit():
+    """Commits one chunk together with a bump of the shared knowledge-base version."""
+    bump_kb_version(db.session)
+    db.session.commit()
+
+def _upsert_by_code(model, rows, ids, chunk_size):
+    """
+    Inserts rows with new codes and updates the changed ones with
+    executemany statements, one transaction per chunk.
+    """
+    existing = {}
+    if any(row['code'] in ids for row in rows):
+        for row_id, name, description in db.session.execute(select(model.id, model.name, model.description)):
+            existing[row_id] = (name, description)
+
+    inserts, updates = [], []
+    for row in rows:
+        values = {'code': row['code'], 'name': row['name'], 'description': row.get('description')}
+        row_id = ids.get(row['code'])
+        if row_id is None:
+            inserts.append(values)
+        elif existing.get(row_id) != (values['name'], values['description']):
+            updates.append({'id': row_id, 'name': values['name'], 'description': values['description']})
+
+    for chunk in _chunks(inserts, chunk_size):
+        db.session.execute(insert(model), chunk)
+        _commit()
+    for chunk in _chunks(updates, chunk_size):
+        db.session.execute(update(model), chunk)
+        _commit()
+    return {'inserted': len(inserts), 'updated': len(updates), 'unchanged': len(rows) - len(inserts) - len(updates)}
+
+def _insert_texts(model, rows, damage_ids, chunk_size):
+    """Adds causes or solutions whose (damage, description) pair is not stored yet."""
+    existing = set(db.session.execute(select(model.damage_id, model.description)).all())
+    inserts = []
+    for row in rows:
+        key = (damage_ids[row['damage']], row['description'])
+        if key not in existing:
+            existing.add(key)
+            inserts.append({'damage_id': key[0], 'description': key[1]})
+    for chunk in _chunks(inserts, chunk_size):
+        db.session.execute(insert(model), chunk)
+        _commit()
+    return {'inserted': len(inserts), 'existing': len(rows) - len(inserts)}
+
+def _existing_rules():
+    """Signatures (damage_id, symptom ids, premise ids, scope) of the stored rules, in three queries."""
+    symptoms, premises = defaultdict(set), defaultdict(set)
+    for rule_id, symptom_id in db.session.execute(select(RuleSymptom.rule_id, RuleSymptom.symptom_id)):
+        symptoms[rule_id].add(symptom_id)
+    for rule_id, damage_id in db.session.execute(select(RuleDamage.rule_id, RuleDamage.damage_id)):
+        premises[rule_id].add(damage_id)
+    return {
+        (damage_id, frozenset(symptoms[rule_id]), frozenset(premises[rule_id]), rule_scope(motorcycle_id, brand))
+        for rule_id, damage_id, motorcycle_id, brand in db.session.execute(
+            select(Rule.id, Rule.damage_id, Rule.motorcycle_id, Rule.brand)
+        )
+    }
+
+def _autoinc_step():
+    """
+    The gap between consecutive AUTO_INCREMENT ids one multi-row INSERT
+    receives on MySQL, or None when the server does not guarantee them:
+    innodb_autoinc_lock_mode 0 and 1 reserve a simple insert's ids as one
+    block, 2 (interleaved) does not.
+    """
+    lock_mode, increment = db.session.execute(
+        text('SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment')
+    ).one()
+    return increment if int(lock_mode) in (0, 1) else None
+
+def _insert_rules(rows):
+    """
+    Inserts rules and returns their ids in order. Dialects with
+    executemany RETURNING (SQLite, PostgreSQL) report the generated ids.
+    MySQL inserts the chunk as one multi-row INSERT, whose ids follow
+    LAST_INSERT_ID() when the auto-increment lock mode reserves them as a
+    block. Only where it does not (interleaved mode) is each row inserted
+    on its own and its id read back.
+    """
+    dialect = db.session.get_bind().dialect
+    if dialect.insert_executemany_returning_sort_by_parameter_order:
+        result = db.session.execute(insert(Rule).returning(Rule.id, sort_by_parameter_order=True), rows)
+        return result.scalars().all()
+
+    if dialect.name == 'mysql':
+        step = _autoinc_step()
+        if step is not None:
+            first = db.session.execute(insert(Rule).values(rows)).lastrowid  # LAST_INSERT_ID(): the first row's id
+            return [first + i * step for i in range(len(rows))]
+
+    return [db.session.execute(insert(Rule).values(**row)).inserted_primary_key[0] for row in rows]
+
+def import_bundle(bundle, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Validates a bundle and writes it with chunked executemany inserts.
+    Codes are resolved with one lookup per table. Returns per-section
+    counts; with dry_run the bundle is only validated.
+
+    Raises:
+        BundleError: The bundle is invalid; nothing was written
+    """
+    symptom_ids, damage_ids = _code_map(Symptom), _code_map(Damage)
+    sections = validate(bundle, symptom_ids, damage_ids, _motorcycle_map())
+    if dry_run:
+        return {name: {'rows': len(rows)} for name, rows in sections.items()}
+
+    report = {
+        'symptoms': _upsert_by_code(Symptom, sections['symptoms'], symptom_ids, chunk_size),
+        'damages': _upsert_by_code(Damage, sections['damages'], damage_ids, chunk_size)
+    }
+    if report['symptoms']['inserted']:
+        symptom_ids = _code_map(Symptom)
+    if report['damages']['inserted']:
+        damage_ids = _code_map(Damage)
+
+    report['causes'] = _insert_texts(Cause, sections['causes'], damage_ids, chunk_size)
+    report['solutions'] = _insert_texts(Solution, sections['solutions'], damage_ids, chunk_size)
+
+    existing = _existing_rules() if sections['rules'] else set()
+    signatures = []
+    for row in sections['rules']:
+        signature = (
+            damage_ids[row['damage']],
+            frozenset(symptom_ids[code] for code in row['symptoms']),
+            frozenset(damage_ids[code] for code in row['premises']),
+            rule_scope(row['motorcycle_id'], row['brand'])
+        )
+        if signature not in existing:
+            existing.add(signature)
+            signatures.append((signature, row))
+
+    for chunk in _chunks(signatures, chunk_size):
+        rule_ids = _insert_rules([
+            {'damage_id': damage_id, 'motorcycle_id': row['motorcycle_id'], 'brand': row['brand']}
+            for (damage_id, _, _, _), row in chunk
+        ])
+        rule_symptoms = [
+            {'rule_id': rule_id, 'symptom_id': symptom_id}
+            for rule_id, ((_, symptoms, _, _), _) in zip(rule_ids, chunk) for symptom_id in sorted(symptoms)
+        ]
+        rule_damages = [
+            {'rule_id': rule_id, 'damage_id': damage_id}
+            for rule_id, ((_, _, premises, _), _) in zip(rule_ids, chunk) for damage_id in sorted(premises)
+        ]
+        if rule_symptoms:
+            db.session.execute(insert(RuleSymptom), rule_symptoms)
+        if rule_damages:
+            db.session.execute(insert(RuleDamage), rule_damages)
+        _commit()
+    report['rules'] = {'inserted': len(signatures), 'existing': len(sections['rules']) - len(signatures)}
+    return report
+
+def export_bundle():
+    """Returns the whole knowledge base as a code-keyed bundle (a fixed number of queries)."""
+    symptoms = db.session.execute(select(Symptom.id, Symptom.code, Symptom.name, Symptom.description).order_by(Symptom.id)).all()
+    damages = db.session.execute(select(Damage.id, Damage.code, Damage.name, Damage.description).order_by(Damage.id)).all()
+    symptom_codes = {row.id: row.code for row in symptoms}
+    damage_codes = {row.id: row.code for row in damages}
+
+    bundle = {
+        'symptoms': [{'code': row.code, 'name': row.name, 'description': row.description} for row in symptoms],
+        'damages': [{'code': row.code, 'name': row.name, 'description': row.description} for row in damages]
+    }
+    for name, model in (('causes', Cause), ('solutions', Solution)):
+        bundle[name] = [
+            {'damage': damage_codes[damage_id], 'description': description}
+            for damage_id, description in db.session.execute(
+                select(model.damage_id, model.description).order_by(model.id)
+            )
+        ]
+
+    antecedents, premises = defaultdict(list), defaultdict(list)
+    for rule_id, symptom_id in db.session.execute(select(RuleSymptom.rule_id, RuleSymptom.symptom_id).order_by(RuleSymptom.id)):
+        antecedents[rule_id].append(symptom_codes[symptom_id])
+    for rule_id, damage_id in db.session.execute(select(RuleDamage.rule_id, RuleDamage.damage_id).order_by(RuleDamage.id)):
+        premises[rule_id].append(damage_codes[damage_id])
+    motorcycles = {
+        row.id: (row.brand, row.model)
+        for row in db.session.execute(select(Motorcycle.id, Motorcycle.brand, Motorcycle.model))
+    }
+    bundle['rules'] = [
+        {
+            'damage': damage_codes[damage_id],
+            'symptoms': antecedents[rule_id],
+            'premises': premises[rule_id],
+            'brand': motorcycles[motorcycle_id][0] if motorcycle_id is not None else brand,
+            'model': motorcycles[motorcycle_id][1] if motorcycle_id is not None else None
+        }
+        for rule_id, damage_id, motorcycle_id, brand in db.session.execute(
+            select(Rule.id, Rule.damage_id, Rule.motorcycle_id, Rule.brand).order_by(Rule.id)
+        )
+    ]
+    return bundle
+
+def write_csv_sections(bundle, open_section):
+    """Writes each section as CSV; open_section(name) returns a text stream for 'name.csv'."""
+    for name, columns in SECTIONS.items():
+        with open_section(f'{name}.csv') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in bundle[name]:
+                if name == 'rules':
+                    row = dict(row, symptoms=' '.join(row['symptoms']), premises=' '.join(row['premises']))
+                writer.writerow(row)
+
+def csv_archive(bundle):
+    """Returns a zip archive (bytes) holding one CSV file per section."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        write_csv_sections(bundle, lambda name: io.TextIOWrapper(archive.open(name, 'w'), encoding='utf-8', newline=''))
+    return buffer.getvalue()
+
+@kb_cli.command('import')
+@click.argument('path')
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True, help='Rows per transaction.')
+@click.option('--dry-run', is_flag=True, help='Validate the bundle without writing.')
+def import_command(path, chunk_size, dry_run):
+    """Import a knowledge-base bundle (.json, .zip of CSVs or a CSV directory)."""
+    from flask import current_app
+    from .routes import expert_system
+    try:
+        report = import_bundle(read_bundle(path), chunk_size, dry_run)
+    except BundleError as e:
+        for error in e.errors:
+            click.echo(error, err=True)
+        raise click.ClickException(str(e))
+    if not dry_run:
+        expert_system.invalidate()
+        snapshot_path = current_app.config.get('KB_SNAPSHOT_PATH')
+        if snapshot_path:
+            # Running workers pick up the new snapshot on their next check
+            from .snapshot import export_snapshot
+            export_snapshot(snapshot_path)
+    for name, counts in report.items():
+        click.echo(f'{name}: ' + ', '.join(f'{k} {v}' for k, v in counts.items()))
+
+@kb_cli.command('export')
+@click.argument('path')
+def export_command(path):
+    """Export the knowledge base to PATH (.json, .zip, or a directory for CSV files)."""
+    bundle = export_bundle()
+    if path.endswith('.json'):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(bundle, f, ensure_ascii=False, indent=2)
+    elif path.endswith('.zip'):
+        with open(path, 'wb') as f:
+            f.write(csv_archive(bundle))
+    else:
+        os.makedirs(path, exist_ok=True)
+        write_csv_sections(bundle, lambda name: open(os.path.join(path, name), 'w', newline='', encoding='utf-8'))
+    click.echo(f'Exported {len(bundle["rules"])} rules to {path}')
@@ -0,0 +1,192 @@
+"""
+Memoized diagnoses for POST /api/diagnose.
+
+The same symptom combinations are diagnosed over and over, so results are
+cached as serialized JSON keyed by the canonical symptom set (sorted,
+deduplicated) and the rule scopes evaluated for the motorcycle. A bounded in-process LRU answers most lookups; an optional
+shared backend lets worker processes reuse each other's results.
+"""
+import logging
+import threading
+from flask import current_app
+from .cache import LRUCache
+from .instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+def canonical_symptoms(symptom_ids):
+    """
+    Returns the sorted, deduplicated symptom ids, or None when they are not
+    all integers (such requests are diagnosed without memoization).
+    """
+    if not isinstance(symptom_ids, (list, tuple)) or not all(type(s) is int for s in symptom_ids):
+        return None
+    return tuple(sorted(set(symptom_ids)))
+
+def _encode(entry):
+    damage_id, body = entry
+    return (b'-' if damage_id is None else str(damage_id).encode()) + b'\n' + body
+
+def _decode(raw):
+    damage_id, _, body = raw.partition(b'\n')
+    return (None if damage_id == b'-' else int(damage_id), body)
+
+class RedisBackend:
+    """Shared backend on Redis (requires the optional 'redis' package)."""
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(f"{url.partition('://')[0]}:// backends need the 'redis' package (pip install redis)") from e
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=ttl)
+
+    def pop(self, key, default=None):
+        pipeline = self._client.pipeline()
+        pipeline.get(key)
+        pipeline.delete(key)
+        value = pipeline.execute()[0]
+        return value if value is not None else default
+
+def backend_from_url(url):
+    """
+    Builds the shared backend named by DIAGNOSIS_CACHE_BACKEND or
+    SESSION_STORE_BACKEND: 'redis://...' for Redis, 'memory://' for a
+    process-local stand-in with the same interface, or None when unset.
+    """
+    if not url:
+        return None
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    if url.startswith('memory://'):
+        return LRUCache(maxsize=100000)
+    raise ValueError(f'Unsupported shared backend: {url}')
+
+class DiagnosisMemo:
+    """
+    Maps a symptom set to (damage_id, diagnosis JSON bytes).
+
+    Local entries are keyed by (knowledge-base version, scopes, symptom
+    set), so a knowledge-base write makes them unreachable and the LRU ages
+    them out. Motorcycles with the same applicable scopes share entries.
+    Shared entries are keyed by the knowledge base's content fingerprint
+    instead, since versions are only meaningful within one process. A
+    failing shared backend is counted and skipped, never surfaced.
+    """
+    def __init__(self, maxsize=10000, backend=None, ttl=3600):
+        self.local = LRUCache(maxsize)
+        self.backend = backend
+        self.ttl = ttl
+        self.shared_hits = 0
+        self.shared_misses = 0
+        self.shared_errors = 0
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, backend=None, ttl=3600):
+        self.local.maxsize = maxsize
+        self.local.clear()
+        self.backend = backend
+        self.ttl = ttl
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _compute(self, kb, symptom_ids):
+        with span('engine.match'):
+            diagnosis = kb.diagnose(symptom_ids)
+        with span('serialize'):
+            body = current_app.json.dumps(diagnosis).encode()
+        return (diagnosis['id'] if diagnosis else None, body)
+
+    def _shared_get(self, key):
+        try:
+            raw = self.backend.get(key)
+        except Exception:
+            logger.exception('Diagnosis cache backend read failed')
+            self._count('shared_errors')
+            return None
+        self._count('shared_hits' if raw is not None else 'shared_misses')
+        return _decode(raw) if raw is not None else None
+
+    def _shared_set(self, key, entry):
+        try:
+            self.backend.set(key, _encode(entry), self.ttl)
+        except Exception:
+            logger.exception('Diagnosis cache backend write failed')
+            self._count('shared_errors')
+
+    def diagnose(self, kb, symptom_ids):
+        """
+        Args:
+            kb (ScopedKnowledgeBase): Rules for the motorcycle (KnowledgeBase.scoped)
+            symptom_ids (list): Observed symptom ids
+
+        Returns:
+            tuple: (damage id or None, diagnosis serialized as JSON bytes)
+        """
+        symptoms = canonical_symptoms(symptom_ids)
+        if symptoms is None:
+            return self._compute(kb, symptom_ids)
+
+        local_key = (kb.version, kb.scopes, symptoms)
+        entry = self.local.get(local_key)
+        if entry is not None:
+            return entry
+
+        shared_key = None
+        if self.backend is not None:
+            shared_key = f"diagnosis:{kb.fingerprint()}:{','.join(map(str, symptoms))}"
+            entry = self._shared_get(shared_key)
+        if entry is None:
+            entry = self._compute(kb, symptoms)
+            if shared_key is not None:
+                self._shared_set(shared_key, entry)
+
+        self.local.set(local_key, entry)
+        return entry
+
+    def carry_over(self, delta):
+        """
+        Re-keys local entries from delta.previous to delta.current when the
+        delta cannot have changed them, so a small edit does not empty the
+        memo. An entry survives when its damage was not rewritten and no
+        touched rule could fire on its symptom set, whatever the rule's
+        scope. Chained rule sets can change a result indirectly, so nothing
+        is carried across them.
+
+        Args:
+            delta (KnowledgeBaseDelta): Returned by ForwardChainingEngine.refresh
+
+        Returns:
+            int: Number of entries carried over
+        """
+        if delta is None or delta.previous.chained or delta.current.chained:
+            return 0
+        version = delta.previous.version
+        antecedents = [frozenset(facts) for facts in delta.antecedents]
+        carried = 0
+        for (entry_version, scopes, symptoms), entry in self.local.items():
+            if entry_version != version or entry[0] in delta.damage_ids:
+                continue
+            observed = set(symptoms)
+            if any(antecedent <= observed for antecedent in antecedents):
+                continue
+            self.local.set((delta.current.version, scopes, symptoms), entry)
+            carried += 1
+        return carried
+
+    def stats(self):
+        stats = self.local.stats()
+        stats['shared'] = {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'hits': self.shared_hits,
+            'misses': self.shared_misses,
+            'errors': self.shared_errors
+        }
+        return stats
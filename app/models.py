@@ -1,5 +1,6 @@
 from . import db
 from datetime import datetime
+from sqlalchemy import event
 
 class Motorcycle(db.Model):
     __tablename__ = 'motorcycles'
@@ -78,13 +79,21 @@ class Rule(db.Model):
     __tablename__ = 'rules'
     id = db.Column(db.Integer, primary_key=True)
     damage_id = db.Column(db.Integer, db.ForeignKey('damages.id'), nullable=False)
+    # Scope: a rule for one motorcycle model, for every model of a brand, or
+    # (both NULL) a generic rule that applies to every motorcycle
+    motorcycle_id = db.Column(db.Integer, db.ForeignKey('motorcycles.id'), index=True)
+    brand = db.Column(db.String(100))
     symptoms = db.relationship('RuleSymptom', backref='rule', lazy=True)
+    premises = db.relationship('RuleDamage', backref='rule', lazy=True)
     
     def to_dict(self):
         return {
             'id': self.id,
             'damage_id': self.damage_id,
-            'symptoms': [rule_symptom.symptom_id for rule_symptom in self.symptoms]
+            'motorcycle_id': self.motorcycle_id,
+            'brand': self.brand,
+            'symptoms': [rule_symptom.symptom_id for rule_symptom in self.symptoms],
+            'premise_damage_ids': [premise.damage_id for premise in self.premises]
         }
 
 class RuleSymptom(db.Model):
@@ -93,6 +102,38 @@ class RuleSymptom(db.Model):
     rule_id = db.Column(db.Integer, db.ForeignKey('rules.id'), nullable=False)
     symptom_id = db.Column(db.Integer, db.ForeignKey('symptoms.id'), nullable=False)
 
+class RuleDamage(db.Model):
+    """Damage that must already be concluded before a rule can fire (chained rules)."""
+    __tablename__ = 'rule_damages'
+    id = db.Column(db.Integer, primary_key=True)
+    rule_id = db.Column(db.Integer, db.ForeignKey('rules.id'), nullable=False)
+    damage_id = db.Column(db.Integer, db.ForeignKey('damages.id'), nullable=False)
+
+class KnowledgeBaseVersion(db.Model):
+    """
+    Single row (id 1) counting knowledge-base writes. Every transaction that
+    writes rules, symptoms, damages or motorcycles increments it, so each
+    process can tell whether its compiled knowledge base is current.
+    """
+    __tablename__ = 'kb_version'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+@event.listens_for(KnowledgeBaseVersion.__table__, 'after_create')
+def _insert_kb_version(target, connection, **kwargs):
+    connection.execute(target.insert().values(id=1, version=0))
+
+class WorkerIdLease(db.Model):
+    """
+    One row per consultation-id worker id in use (see app/ids.py). A process
+    holds its row while it renews expires_at; a row past expires_at belongs
+    to a process that died and may be taken over.
+    """
+    __tablename__ = 'worker_id_leases'
+    worker_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    holder = db.Column(db.String(100), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
 class User(db.Model):
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
@@ -111,7 +152,16 @@ class User(db.Model):
 
 class Consultation(db.Model):
     __tablename__ = 'consultations'
-    id = db.Column(db.Integer, primary_key=True)
+    # Keyset pagination walks (consultation_date, id); each filter gets a
+    # composite index with that suffix so filtered pages are index range scans.
+    __table_args__ = (
+        db.Index('ix_consultations_date_id', 'consultation_date', 'id'),
+        db.Index('ix_consultations_user_date_id', 'user_id', 'consultation_date', 'id'),
+        db.Index('ix_consultations_motorcycle_date_id', 'motorcycle_id', 'consultation_date', 'id'),
+        db.Index('ix_consultations_damage_date_id', 'damage_id', 'consultation_date', 'id'),
+    )
+    # 64-bit for the pre-allocated time-ordered ids of app/ids.py
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     motorcycle_id = db.Column(db.Integer, db.ForeignKey('motorcycles.id'), nullable=False)
     damage_id = db.Column(db.Integer, db.ForeignKey('damages.id'))
@@ -130,6 +180,52 @@ class Consultation(db.Model):
 
 class ConsultationSymptom(db.Model):
     __tablename__ = 'consultation_symptoms'
+    __table_args__ = (
+        db.Index('ix_consultation_symptoms_consultation_symptom', 'consultation_id', 'symptom_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    consultation_id = db.Column(db.Integer, db.ForeignKey('consultations.id'), nullable=False)
-    symptom_id = db.Column(db.Integer, db.ForeignKey('symptoms.id'), nullable=False)
\ No newline at end of file
+    consultation_id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), db.ForeignKey('consultations.id'), nullable=False)
+    symptom_id = db.Column(db.Integer, db.ForeignKey('symptoms.id'), nullable=False)
+
+# Rollup tables maintained incrementally by app.analytics. They are keyed so
+# every increment is an upsert and dashboard reads never scan consultations.
+
+class DailyDamageStat(db.Model):
+    __tablename__ = 'daily_damage_stats'
+    day = db.Column(db.Date, primary_key=True)
+    motorcycle_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    damage_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class DailyOutcomeStat(db.Model):
+    __tablename__ = 'daily_outcome_stats'
+    day = db.Column(db.Date, primary_key=True)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    misses = db.Column(db.Integer, nullable=False, default=0)
+
+class SymptomPairStat(db.Model):
+    """Co-occurrence counts with symptom_a <= symptom_b; the diagonal holds single-symptom counts."""
+    __tablename__ = 'symptom_pair_stats'
+    __table_args__ = (
+        db.Index('ix_symptom_pair_stats_count', 'count'),
+    )
+    symptom_a = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    symptom_b = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class RollupState(db.Model):
+    """
+    Single row (id 1) fencing live rollup increments against a rebuild
+    (analytics.backfill). The rebuild covers consultation ids up to
+    watermark and has committed those up to rebuilt_through; live
+    increments for ids in between are left to it. epoch counts rebuilds.
+    """
+    __tablename__ = 'rollup_state'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    epoch = db.Column(db.Integer, nullable=False, default=0)
+    watermark = db.Column(db.BigInteger, nullable=False, default=0)
+    rebuilt_through = db.Column(db.BigInteger, nullable=False, default=0)
+
+@event.listens_for(RollupState.__table__, 'after_create')
+def _insert_rollup_state(target, connection, **kwargs):
+    connection.execute(target.insert().values(id=1, epoch=0, watermark=0, rebuilt_through=0))
@@ -0,0 +1,230 @@
+"""
+Offline re-diagnosis of consultation history against the current rules.
+
+After a rule change, every stored consultation is diagnosed again, with
+the rules that apply to its motorcycle, and the ones whose damage_id would
+differ are written to a JSON-lines report:
+
+    {"consultation_id": 17, "change": "changed", "old_damage_id": 3, "new_damage_id": 5}
+
+change is 'changed', 'newly_matched' (no diagnosis before) or
+'newly_unmatched' (no diagnosis now). Consultations are read in id order
+in chunks, like analytics.backfill, and fanned out to a process pool. The
+parent compiles the knowledge base once into a snapshot file that every
+worker memory-maps, so the rules are shared instead of copied per worker.
+
+Progress is checkpointed after each chunk (last consultation id, report
+offset and counts), so an interrupted run resumes where it stopped. A
+checkpoint is only valid for the rules it was started with.
+"""
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import click
+from sqlalchemy import select
+from . import db
+from .cli import kb_cli
+from .models import Consultation, ConsultationSymptom
+
+CHUNK_SIZE = 5000
+
+COUNTERS = ('scanned', 'unchanged', 'changed', 'newly_matched', 'newly_unmatched')
+
+class CheckpointError(Exception):
+    """The checkpoint cannot be resumed."""
+
+# Knowledge base of a pool worker, loaded once by _init_worker
+_kb = None
+
+def _init_worker(snapshot_path):
+    global _kb
+    from .snapshot import load_knowledge_base
+    _kb = load_knowledge_base(snapshot_path)
+
+def _change(old_damage_id, new_damage_id):
+    if old_damage_id == new_damage_id:
+        return 'unchanged'
+    if old_damage_id is None:
+        return 'newly_matched'
+    if new_damage_id is None:
+        return 'newly_unmatched'
+    return 'changed'
+
+def rediagnose_chunk(rows, kb=None):
+    """
+    Args:
+        rows (list): (consultation_id, damage_id, motorcycle_id, symptom_ids) tuples
+        kb (KnowledgeBase): Defaults to the pool worker's knowledge base
+
+    Returns:
+        tuple: (counts dict, report lines for the rows that differ)
+    """
+    kb = kb or _kb
+    counts = dict.fromkeys(COUNTERS, 0)
+    lines = []
+    # Symptom sets repeat a lot; diagnose each distinct one once per chunk
+    # and set of scopes
+    diagnosed = {}
+    for consultation_id, old_damage_id, motorcycle_id, symptom_ids in rows:
+        scoped = kb.scoped(motorcycle_id)
+        key = (scoped.scopes, symptom_ids)
+        if key not in diagnosed:
+            diagnosed[key] = scoped.conclude(symptom_ids)
+        new_damage_id = diagnosed[key]
+        change = _change(old_damage_id, new_damage_id)
+        counts[change] += 1
+        if change != 'unchanged':
+            lines.append(json.dumps({
+                'consultation_id': consultation_id,
+                'change': change,
+                'old_damage_id': old_damage_id,
+                'new_damage_id': new_damage_id
+            }).encode() + b'\n')
+    counts['scanned'] = len(rows)
+    return counts, lines
+
+def _chunks(last_id, chunk_size):
+    """Yields lists of (consultation_id, damage_id, motorcycle_id, symptom_ids) in id order, after last_id."""
+    while True:
+        consultations = db.session.execute(
+            select(Consultation.id, Consultation.damage_id, Consultation.motorcycle_id)
+            .where(Consultation.id > last_id)
+            .order_by(Consultation.id)
+            .limit(chunk_size)
+        ).all()
+        if not consultations:
+            return
+
+        symptoms = defaultdict(list)
+        for consultation_id, symptom_id in db.session.execute(
+            select(ConsultationSymptom.consultation_id, ConsultationSymptom.symptom_id)
+            .where(ConsultationSymptom.consultation_id > last_id)
+            .where(ConsultationSymptom.consultation_id <= consultations[-1].id)
+        ):
+            symptoms[consultation_id].append(symptom_id)
+        db.session.rollback()  # don't hold a read transaction between chunks
+
+        yield [
+            (c.id, c.damage_id, c.motorcycle_id, tuple(sorted(set(symptoms.get(c.id, ())))))
+            for c in consultations
+        ]
+        last_id = consultations[-1].id
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_checkpoint(path, checkpoint):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def rediagnose(report_path, checkpoint_path=None, workers=None, chunk_size=CHUNK_SIZE, restart=False, echo=print):
+    """
+    Re-diagnoses every consultation and writes the differences to report_path.
+
+    Args:
+        report_path (str): JSON-lines report, appended to when resuming
+        checkpoint_path (str): Defaults to report_path + '.checkpoint'
+        workers (int): Worker processes (default: CPU count); 1 runs in-process
+        chunk_size (int): Consultations per chunk
+        restart (bool): Ignore an existing checkpoint and start over
+
+    Returns:
+        dict: Counts per outcome, summed over the whole history
+    """
+    from .snapshot import export_snapshot
+    checkpoint_path = checkpoint_path or f'{report_path}.checkpoint'
+    workers = workers or os.cpu_count() or 1
+
+    snapshot_dir = tempfile.mkdtemp(prefix='rediagnose-')
+    snapshot_path = os.path.join(snapshot_dir, 'kb.snap')
+    try:
+        kb = export_snapshot(snapshot_path)
+        fingerprint = kb.fingerprint()
+
+        checkpoint = None if restart else _read_checkpoint(checkpoint_path)
+        if checkpoint is not None:
+            if checkpoint['fingerprint'] != fingerprint:
+                raise CheckpointError(f'{checkpoint_path} was written for different rules; rerun with --restart')
+            size = os.path.getsize(report_path) if os.path.exists(report_path) else 0
+            if size < checkpoint['report_offset']:
+                raise CheckpointError(f'{report_path} is shorter than its checkpoint; rerun with --restart')
+            if checkpoint['last_id']:
+                echo(f"Resuming after consultation {checkpoint['last_id']}")
+        else:
+            checkpoint = {
+                'fingerprint': fingerprint,
+                'last_id': 0,
+                'report_offset': 0,
+                'counts': dict.fromkeys(COUNTERS, 0),
+                'complete': False
+            }
+
+        with open(report_path, 'ab+') as report:
+            # Drops lines written after the last checkpoint
+            report.truncate(checkpoint['report_offset'])
+
+            def commit(last_id, counts, lines):
+                report.writelines(lines)
+                report.flush()
+                os.fsync(report.fileno())
+                for name, count in counts.items():
+                    checkpoint['counts'][name] += count
+                checkpoint['last_id'] = last_id
+                checkpoint['report_offset'] = report.tell()
+                _write_checkpoint(checkpoint_path, checkpoint)
+                echo(f"{checkpoint['counts']['scanned']} consultations re-diagnosed")
+
+            chunks = _chunks(checkpoint['last_id'], chunk_size)
+            if workers == 1:
+                for rows in chunks:
+                    commit(rows[-1][0], *rediagnose_chunk(rows, kb))
+            else:
+                # Workers are spawned so they inherit no database connections
+                with ProcessPoolExecutor(
+                    workers, multiprocessing.get_context('spawn'),
+                    initializer=_init_worker, initargs=(snapshot_path,)
+                ) as pool:
+                    # Results are committed in id order with a bounded number
+                    # of chunks in flight, so the checkpoint is always a prefix
+                    pending = deque()
+                    for rows in chunks:
+                        pending.append((rows[-1][0], pool.submit(rediagnose_chunk, rows)))
+                        if len(pending) >= workers * 2:
+                            last_id, future = pending.popleft()
+                            commit(last_id, *future.result())
+                    while pending:
+                        last_id, future = pending.popleft()
+                        commit(last_id, *future.result())
+
+        checkpoint['complete'] = True
+        _write_checkpoint(checkpoint_path, checkpoint)
+        return checkpoint['counts']
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+@kb_cli.command('rediagnose')
+@click.argument('report')
+@click.option('--checkpoint', help='Checkpoint file (default: REPORT.checkpoint).')
+@click.option('--workers', type=int, help='Worker processes (default: CPU count).')
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True, help='Consultations per chunk.')
+@click.option('--restart', is_flag=True, help='Ignore an existing checkpoint and start over.')
+def rediagnose_command(report, checkpoint, workers, chunk_size, restart):
+    """Re-diagnose past consultations with the current rules and report the differences."""
+    try:
+        counts = rediagnose(report, checkpoint, workers, chunk_size, restart, echo=click.echo)
+    except CheckpointError as e:
+        raise click.ClickException(str(e))
+    for name, count in counts.items():
+        click.echo(f'{name}: {count}')
@@ -1,42 +1,447 @@
-from flask import request, jsonify, current_app
+from flask import request, jsonify, current_app, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import select, insert, delete, and_, or_, event, inspect
+from sqlalchemy.orm import selectinload
+import base64
+import csv
+import hashlib
+import io
+import json
 import jwt
+import secrets
+import time
+from collections import namedtuple
 from datetime import datetime, timedelta
 from functools import wraps
 from . import db
-from .models import Motorcycle, Damage, Symptom, Cause, Solution, Rule, RuleSymptom, User, Consultation, ConsultationSymptom
-from .expert_system import ForwardChainingEngine
+from .models import Motorcycle, Damage, Symptom, Cause, Solution, Rule, RuleSymptom, RuleDamage, User, Consultation, ConsultationSymptom
+from .expert_system import ForwardChainingEngine, bump_kb_version
+from .cache import LRUCache
+from .memo import DiagnosisMemo, backend_from_url
+from .sessions import SessionStore
+from .search import SymptomIndex
+from .instrumentation import span
+from . import analytics
+from . import kb_io
+from . import analysis
 
 # Initialize expert system engine
 expert_system = ForwardChainingEngine()
 
+# Serialized knowledge-base listings keyed by (endpoint, shared knowledge-base version)
+response_cache = LRUCache(maxsize=64)
+
+def _json_response(body):
+    """Wraps serialized JSON in a response with a strong ETag, answering 304 on If-None-Match."""
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
+
+def _cached_listing(name, build):
+    """
+    Serves a knowledge-base listing from response_cache. The body is only
+    rebuilt after a write, through any process, bumps the shared
+    knowledge-base version.
+    """
+    key = (name, expert_system.poll())
+    body = response_cache.get(key)
+    if body is None:
+        with span('orm.load'):
+            data = build()
+        with span('serialize'):
+            body = current_app.json.dumps(data).encode() + b'\n'
+        response_cache.set(key, body)
+    return _json_response(body)
+
+def _damage_listing(session):
+    damages = session.scalars(
+        select(Damage).options(selectinload(Damage.causes), selectinload(Damage.solutions))
+    ).all()
+    return [d.to_dict() for d in damages]
+
+def _rule_listing(session):
+    rules = session.scalars(select(Rule).options(selectinload(Rule.symptoms), selectinload(Rule.premises))).all()
+    return [r.to_dict() for r in rules]
+
+# Serialized /api/diagnose results keyed by canonical symptom set (see app/memo.py)
+diagnosis_memo = DiagnosisMemo()
+
+def _diagnosis_body(consultation_id, damage_id, diagnosis_json, candidates):
+    """
+    Builds the /api/diagnose body around the memoized diagnosis JSON,
+    keeping the sorted key order jsonify would produce.
+    """
+    dumps = current_app.json.dumps
+    parts = []
+    if candidates is not None:
+        parts.append(b'"candidates":' + dumps(candidates).encode())
+    parts.append(b'"consultation_id":' + dumps(consultation_id).encode())
+    parts.append(b'"diagnosis":' + diagnosis_json)
+    if damage_id is None:
+        parts.append(b'"message":"No matching diagnosis found"')
+    return b'{' + b','.join(parts) + b'}\n'
+
+# Fuzzy symptom search (see app/search.py), kept at the knowledge-base version
+symptom_index = SymptomIndex()
+
+def _symptom_index():
+    """Returns symptom_index, rebuilt from the database when it is behind the knowledge base."""
+    version = expert_system.poll()  # notices writes made through other processes
+    if symptom_index.version != version:
+        with span('orm.load'):
+            symptoms = [s.to_dict() for s in Symptom.query.order_by(Symptom.id)]
+        symptom_index.rebuild(symptoms, version)
+    return symptom_index
+
+def _publish(version, rule_ids=(), damage_ids=(), symptoms=(), removed_symptom_ids=(), motorcycle_ids=()):
+    """
+    Applies committed knowledge-base writes to the engine as an incremental
+    delta and keeps the memoized diagnoses the delta cannot have changed.
+    Symptom changes are applied to symptom_index the same way. version is
+    the shared version the write's transaction bumped to (bump_kb_version).
+    """
+    delta = expert_system.refresh(version, rule_ids, damage_ids, motorcycle_ids)
+    diagnosis_memo.carry_over(delta)
+    # Any other write in between leaves the index stale, to be rebuilt on search
+    symptom_index.advance(version - 1, version, symptoms, removed_symptom_ids)
+
+def _id_list(data, key):
+    """Returns data[key] as a list of ints ([] when absent), or None when it is not one."""
+    value = data.get(key, [])
+    if not isinstance(value, list) or not all(type(v) is int for v in value):
+        return None
+    return value
+
+def _missing_ids(model, ids):
+    """Returns the ids that have no row in model's table, sorted."""
+    ids = set(ids)
+    if not ids:
+        return []
+    return sorted(ids - set(db.session.scalars(select(model.id).where(model.id.in_(ids)))))
+
+def _rule_scope(data, rule=None):
+    """
+    Returns (motorcycle_id, brand, error message) for a rule from request
+    data. Fields left out keep rule's values (PATCH); without a rule they
+    default to a generic rule.
+    """
+    motorcycle_id = data.get('motorcycle_id', rule.motorcycle_id if rule else None)
+    brand = data.get('brand', rule.brand if rule else None)
+    if motorcycle_id is not None and type(motorcycle_id) is not int:
+        return None, None, 'motorcycle_id must be an integer'
+    if brand is not None and (not isinstance(brand, str) or not brand.strip() or len(brand) > 100):
+        return None, None, 'brand must be a non-empty string of at most 100 characters'
+    if motorcycle_id is not None and brand is not None:
+        return None, None, 'A rule is scoped to a motorcycle_id or a brand, not both'
+    if motorcycle_id is not None and db.session.get(Motorcycle, motorcycle_id) is None:
+        return None, None, 'Unknown motorcycle_id'
+    return motorcycle_id, brand.strip() if brand else None, None
+
+def _replace_rows(model, rule_id, column, ids):
+    """Replaces a rule's RuleSymptom or RuleDamage rows."""
+    db.session.execute(delete(model).where(model.rule_id == rule_id))
+    if ids:
+        db.session.execute(insert(model), [{'rule_id': rule_id, column: i} for i in ids])
+
+def _delete_rules(rule_ids):
+    """Deletes rules together with their RuleSymptom and RuleDamage rows."""
+    if rule_ids:
+        db.session.execute(delete(RuleSymptom).where(RuleSymptom.rule_id.in_(rule_ids)))
+        db.session.execute(delete(RuleDamage).where(RuleDamage.rule_id.in_(rule_ids)))
+        db.session.execute(delete(Rule).where(Rule.id.in_(rule_ids)))
+
+# Identity handed to protected views; enough for role checks and ownership filters
+Principal = namedtuple('Principal', 'id username role')
+
+# Interactive diagnosis sessions (QuestionSession) keyed by session id
+session_store = SessionStore(expert_system.start_questions)
+
+def _session_state(session_id, session):
+    """Serializes a QuestionSession with its next question."""
+    question = session.next_question()
+    if question is not None:
+        symptom_id, hits, total = question
+        symptom = db.session.get(Symptom, symptom_id)
+        question = {
+            'symptom': symptom.to_dict() if symptom else {'id': symptom_id},
+            'candidate_rules': total,
+            'rules_requiring': hits
+        }
+    return {
+        'session_id': session_id,
+        'confirmed': sorted(session.confirmed),
+        'denied': sorted(session.denied),
+        'diagnosis': session.diagnosis(),
+        'candidate_rules': question['candidate_rules'] if question else 0,
+        'question': question,
+        'done': question is None
+    }
+
+# Verified token -> Principal, so authenticated requests skip the user lookup
+token_cache = LRUCache(maxsize=10000, ttl=60)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user_tokens(mapper, connection, target):
+    """Drops cached principals when a user's role or password changes or the user is removed."""
+    state = inspect(target)
+    if state.deleted or state.was_deleted or any(
+        state.attrs[name].history.has_changes() for name in ('role', 'password', 'username')
+    ):
+        token_cache.discard_where(lambda principal: principal.id == target.id)
+
+def _bearer_token(auth_header):
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header.split(' ')[1]
+    return None
+
+def _remember_principal(token, data, user):
+    """Caches the principal for a verified token, never past the token's own expiry."""
+    principal = Principal(user.id, user.username, user.role)
+    ttl = token_cache.ttl
+    if 'exp' in data:
+        ttl = min(ttl, data['exp'] - time.time())
+    if ttl > 0:
+        token_cache.set(token, principal, ttl=ttl)
+    return principal
+
 # Authentication decorator
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        
-        if 'Authorization' in request.headers:
-            auth_header = request.headers['Authorization']
-            if auth_header.startswith('Bearer '):
-                token = auth_header.split(' ')[1]
+        token = _bearer_token(request.headers.get('Authorization'))
         
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
         
-        try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = User.query.filter_by(id=data['user_id']).first()
-            if not current_user:
-                return jsonify({'message': 'User not found!'}), 401
-        except jwt.InvalidTokenError as e:
-            return jsonify({'message': f'Token is invalid: {str(e)}!'}), 401
+        current_user = token_cache.get(token)
+        if current_user is None:
+            try:
+                data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
+                user = User.query.filter_by(id=data['user_id']).first()
+                if not user:
+                    return jsonify({'message': 'User not found!'}), 401
+            except jwt.InvalidTokenError as e:
+                return jsonify({'message': f'Token is invalid: {str(e)}!'}), 401
+            
+            current_user = _remember_principal(token, data, user)
             
         return f(current_user, *args, **kwargs)
     
     return decorated
 
+def _ndjson_items(stream):
+    """Yields one decoded item per non-empty NDJSON line, or None if a line is malformed."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+def _diagnosis_error(data):
+    """Returns why a diagnosis request ({motorcycle_id, symptom_ids, user_id}) is invalid, or None."""
+    if not isinstance(data, dict) or not data.get('symptom_ids') or not data.get('motorcycle_id'):
+        return 'Missing data'
+    if not isinstance(data['symptom_ids'], list) or not all(type(s) is int for s in data['symptom_ids']):
+        return 'symptom_ids must be a list of integers'
+    if type(data['motorcycle_id']) is not int:
+        return 'motorcycle_id must be an integer'
+    if data.get('user_id') is not None and type(data['user_id']) is not int:
+        return 'user_id must be an integer'
+    return None
+
+def _diagnose_chunk(kb, chunk):
+    """
+    Diagnoses and persists one chunk of batch items in a single transaction.
+    Consultations are flushed together to get their ids, then every
+    consultation symptom is written with one executemany insert.
+    """
+    results = []
+    consultations = []
+    
+    for index, item in chunk:
+        # A bad item gets its own result line; the rest of the batch goes on
+        error = _diagnosis_error(item)
+        if error:
+            results.append({'index': index, 'message': error})
+            continue
+            
+        diagnosis = kb.scoped(item['motorcycle_id']).diagnose(item['symptom_ids'])
+        consultation = Consultation(
+            id=current_app.extensions['consultation_ids'].next_id(),
+            user_id=item.get('user_id'),
+            motorcycle_id=item['motorcycle_id'],
+            damage_id=diagnosis['id'] if diagnosis else None
+        )
+        consultations.append(consultation)
+        results.append({'index': index, 'consultation': consultation, 'symptom_ids': item['symptom_ids'], 'diagnosis': diagnosis})
+    
+    if consultations:
+        try:
+            db.session.add_all(consultations)
+            db.session.flush()
+            
+            # Read ids before commit expires the instances
+            rollups = analytics.ConsultationRollups(current_app.extensions.get('rollup_buffer'))
+            for result in results:
+                if 'consultation' in result:
+                    consultation = result.pop('consultation')
+                    result['consultation_id'] = consultation.id
+                    rollups.add(consultation.id, consultation.consultation_date, consultation.motorcycle_id,
+                                consultation.damage_id, result['symptom_ids'])
+            
+            rows = [
+                {'consultation_id': result['consultation_id'], 'symptom_id': symptom_id}
+                for result in results if 'consultation_id' in result
+                for symptom_id in result['symptom_ids']
+            ]
+            if rows:
+                db.session.execute(insert(ConsultationSymptom), rows)
+            rollups.flush()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    lines = []
+    for result in results:
+        if 'consultation_id' in result:
+            result = {
+                'index': result['index'],
+                'consultation_id': result['consultation_id'],
+                'diagnosis': result['diagnosis']
+            }
+            if not result['diagnosis']:
+                result['message'] = 'No matching diagnosis found'
+        lines.append(json.dumps(result) + '\n')
+    
+    # Drop the flushed consultations from the identity map between chunks
+    db.session.expunge_all()
+    return lines
+
+def _encode_cursor(consultation):
+    raw = f"{consultation.consultation_date.isoformat()}|{consultation.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    date, consultation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(date), int(consultation_id)
+
+def _parse_day(value):
+    return datetime.fromisoformat(value).date() if value else None
+
+def _consultation_filters(current_user, args):
+    """
+    Builds the WHERE clauses for consultation listings from query args.
+    Non-admin users are always restricted to their own consultations.
+    Raises ValueError on malformed arguments.
+    """
+    filters = []
+    if current_user.role != 'admin':
+        filters.append(Consultation.user_id == current_user.id)
+    elif args.get('user_id'):
+        filters.append(Consultation.user_id == int(args['user_id']))
+    
+    if args.get('motorcycle_id'):
+        filters.append(Consultation.motorcycle_id == int(args['motorcycle_id']))
+    if args.get('damage_id'):
+        filters.append(Consultation.damage_id == int(args['damage_id']))
+    if args.get('date_from'):
+        filters.append(Consultation.consultation_date >= datetime.fromisoformat(args['date_from']))
+    if args.get('date_to'):
+        date_to = datetime.fromisoformat(args['date_to'])
+        if len(args['date_to']) == 10:
+            # A bare date includes the whole day
+            filters.append(Consultation.consultation_date < date_to + timedelta(days=1))
+        else:
+            filters.append(Consultation.consultation_date <= date_to)
+    return filters
+
+def _consultation_select(filters, cursor, limit):
+    """
+    Selects one page of consultations matching filters, newest first,
+    using keyset pagination on (consultation_date, id) so deep pages cost
+    the same as the first one.
+    """
+    query = select(Consultation).options(selectinload(Consultation.symptoms)).filter(*filters)
+    if cursor:
+        date, consultation_id = cursor
+        query = query.filter(or_(
+            Consultation.consultation_date < date,
+            and_(Consultation.consultation_date == date, Consultation.id < consultation_id)
+        ))
+    return query.order_by(Consultation.consultation_date.desc(), Consultation.id.desc()).limit(limit)
+
+def _consultation_page(filters, cursor, limit):
+    """Returns one page of consultations (see _consultation_select)."""
+    return db.session.scalars(_consultation_select(filters, cursor, limit)).all()
+
+def _consultation_args(current_user, args):
+    """
+    Parses a consultation listing request into (filters, cursor, limit,
+    paginated). Passing limit or cursor selects keyset pages of up to 500
+    items. The legacy bare array is deprecated and capped: it is the first
+    CONSULTATION_LIST_MAX consultations, newest first, selected with one
+    extra row to tell whether it was truncated. Raises ValueError on
+    malformed arguments.
+    """
+    filters = _consultation_filters(current_user, args)
+    cursor = _decode_cursor(args['cursor']) if args.get('cursor') else None
+    paginated = 'limit' in args or 'cursor' in args
+    if paginated:
+        limit = max(1, min(int(args.get('limit', 50)), 500))
+    else:
+        limit = current_app.config['CONSULTATION_LIST_MAX'] + 1
+    return filters, cursor, limit, paginated
+
+def _consultation_listing(consultations, paginated, limit):
+    """
+    Returns (data, next_cursor). next_cursor is only set for a truncated
+    bare array (paginated listings carry it in the body) and is sent as
+    the X-Next-Cursor header, to continue with ?cursor=.
+    """
+    if paginated:
+        return {
+            'items': [c.to_dict() for c in consultations],
+            'next_cursor': _encode_cursor(consultations[-1]) if len(consultations) == limit else None
+        }, None
+    if len(consultations) < limit:
+        return [c.to_dict() for c in consultations], None
+    consultations = consultations[:-1]
+    return [c.to_dict() for c in consultations], _encode_cursor(consultations[-1])
+
+def _iter_consultations(filters, chunk_size=1000):
+    """Yields every matching consultation page by page, keeping memory constant."""
+    cursor = None
+    while True:
+        page = _consultation_page(filters, cursor, chunk_size)
+        yield from page
+        if len(page) < chunk_size:
+            return
+        cursor = (page[-1].consultation_date, page[-1].id)
+        db.session.expunge_all()
+
 def init_routes(app):
+    token_cache.maxsize = app.config['TOKEN_CACHE_SIZE']
+    token_cache.ttl = app.config['TOKEN_CACHE_TTL']
+    session_store.configure(
+        app.config['SESSION_STORE_SIZE'],
+        app.config['SESSION_IDLE_TIMEOUT'],
+        backend_from_url(app.config.get('SESSION_STORE_BACKEND'))
+    )
+    expert_system.configure(app.config.get('KB_SNAPSHOT_PATH'), app.config['KB_SNAPSHOT_CHECK_INTERVAL'])
+    # Shared versions restart with each database; drop what an earlier app cached
+    response_cache.clear()
+    symptom_index.rebuild([], None)
+    diagnosis_memo.configure(
+        app.config['DIAGNOSIS_CACHE_SIZE'],
+        backend_from_url(app.config.get('DIAGNOSIS_CACHE_BACKEND')),
+        app.config['DIAGNOSIS_CACHE_TTL']
+    )
+    
     # Routes
     @app.route('/api/login', methods=['POST'])
     def login():
@@ -82,6 +487,14 @@ def init_routes(app):
         
         return jsonify({'message': 'User created successfully'}), 201
 
+    @app.route('/api/auth/cache', methods=['GET'])
+    @token_required
+    def auth_cache_stats(current_user):
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        return jsonify(token_cache.stats())
+
     @app.route('/api/motorcycles', methods=['GET'])
     def get_motorcycles():
         motorcycles = Motorcycle.query.all()
@@ -104,7 +517,10 @@ def init_routes(app):
         )
         
         db.session.add(new_motorcycle)
+        version = bump_kb_version(db.session)
         db.session.commit()
+        # Brand-scoped rules apply to the new model
+        _publish(version, motorcycle_ids=[new_motorcycle.id])
         
         return jsonify(new_motorcycle.to_dict()), 201
 
@@ -113,6 +529,28 @@ def init_routes(app):
         symptoms = Symptom.query.all()
         return jsonify([s.to_dict() for s in symptoms])
 
+    @app.route('/api/symptoms/search', methods=['GET'])
+    def search_symptoms():
+        """
+        Ranked fuzzy search over symptom code, name and description
+        (?q=bunyi belt), paginated with limit and offset.
+        """
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'message': 'Missing q'}), 400
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+        offset = max(0, request.args.get('offset', 0, type=int))
+        
+        index = _symptom_index()
+        with span('search'):
+            total, items = index.search(query, limit, offset)
+        
+        return jsonify({
+            'items': items,
+            'total': total,
+            'next_offset': offset + limit if offset + limit < total else None
+        })
+
     @app.route('/api/symptoms', methods=['POST'])
     @token_required
     def add_symptom(current_user):
@@ -131,14 +569,82 @@ def init_routes(app):
         )
         
         db.session.add(new_symptom)
+        version = bump_kb_version(db.session)
         db.session.commit()
+        _publish(version, symptoms=[new_symptom.to_dict()])
         
         return jsonify(new_symptom.to_dict()), 201
 
+    @app.route('/api/symptoms/<int:symptom_id>', methods=['PUT', 'PATCH'])
+    @token_required
+    def update_symptom(current_user, symptom_id):
+        """PUT replaces the symptom; PATCH changes only the fields given."""
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        symptom = db.session.get(Symptom, symptom_id)
+        if symptom is None:
+            return jsonify({'message': 'Symptom not found'}), 404
+        
+        data = request.get_json()
+        
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Missing data'}), 400
+        if request.method == 'PUT' and (not data.get('code') or not data.get('name')):
+            return jsonify({'message': 'Missing data'}), 400
+        if any(key in data and not data[key] for key in ('code', 'name')):
+            return jsonify({'message': 'code and name cannot be empty'}), 400
+        
+        for key in ('code', 'name', 'description'):
+            if key in data or request.method == 'PUT':
+                setattr(symptom, key, data.get(key, ''))
+        
+        version = bump_kb_version(db.session)
+        db.session.commit()
+        # No rule changes; republishes the snapshot's symptom catalogue
+        _publish(version, symptoms=[symptom.to_dict()])
+        
+        return jsonify(symptom.to_dict())
+
+    @app.route('/api/symptoms/<int:symptom_id>', methods=['DELETE'])
+    @token_required
+    def delete_symptom(current_user, symptom_id):
+        """
+        Deletes a symptom and removes it from every rule. Rules left without
+        any symptom or premise are deleted too.
+        """
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        symptom = db.session.get(Symptom, symptom_id)
+        if symptom is None:
+            return jsonify({'message': 'Symptom not found'}), 404
+        if db.session.scalar(select(ConsultationSymptom.id).where(ConsultationSymptom.symptom_id == symptom_id).limit(1)):
+            return jsonify({'message': 'Symptom is referenced by consultations'}), 409
+        
+        rule_ids = set(db.session.scalars(select(RuleSymptom.rule_id).where(RuleSymptom.symptom_id == symptom_id)))
+        db.session.execute(delete(RuleSymptom).where(RuleSymptom.symptom_id == symptom_id))
+        remaining = set()
+        if rule_ids:
+            remaining.update(db.session.scalars(select(RuleSymptom.rule_id).where(RuleSymptom.rule_id.in_(rule_ids))))
+            remaining.update(db.session.scalars(select(RuleDamage.rule_id).where(RuleDamage.rule_id.in_(rule_ids))))
+        deleted_rule_ids = sorted(rule_ids - remaining)
+        _delete_rules(deleted_rule_ids)
+        db.session.delete(symptom)
+        version = bump_kb_version(db.session)
+        db.session.commit()
+        _publish(version, rule_ids=rule_ids, removed_symptom_ids=[symptom_id])
+        
+        return jsonify({
+            'message': 'Symptom deleted',
+            'id': symptom_id,
+            'updated_rule_ids': sorted(remaining),
+            'deleted_rule_ids': deleted_rule_ids
+        })
+
     @app.route('/api/damages', methods=['GET'])
     def get_damages():
-        damages = Damage.query.all()
-        return jsonify([d.to_dict() for d in damages])
+        return _cached_listing('damages', lambda: _damage_listing(db.session))
 
     @app.route('/api/damages', methods=['POST'])
     @token_required
@@ -158,14 +664,95 @@ def init_routes(app):
         )
         
         db.session.add(new_damage)
+        version = bump_kb_version(db.session)
         db.session.commit()
+        _publish(version, damage_ids=[new_damage.id])
         
         return jsonify(new_damage.to_dict()), 201
 
+    @app.route('/api/damages/<int:damage_id>', methods=['PUT', 'PATCH'])
+    @token_required
+    def update_damage(current_user, damage_id):
+        """
+        PUT replaces the damage; PATCH changes only the fields given. causes
+        and solutions, when given, are lists of descriptions that replace the
+        existing ones.
+        """
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        damage = db.session.get(Damage, damage_id)
+        if damage is None:
+            return jsonify({'message': 'Damage not found'}), 404
+        
+        data = request.get_json()
+        
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Missing data'}), 400
+        if request.method == 'PUT' and (not data.get('code') or not data.get('name')):
+            return jsonify({'message': 'Missing data'}), 400
+        if any(key in data and not data[key] for key in ('code', 'name')):
+            return jsonify({'message': 'code and name cannot be empty'}), 400
+        for key in ('causes', 'solutions'):
+            value = data.get(key, [])
+            if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                return jsonify({'message': f'{key} must be a list of strings'}), 400
+        
+        for key in ('code', 'name', 'description'):
+            if key in data or request.method == 'PUT':
+                setattr(damage, key, data.get(key, ''))
+        for key, model in (('causes', Cause), ('solutions', Solution)):
+            if key in data:
+                db.session.execute(delete(model).where(model.damage_id == damage_id))
+                db.session.add_all(model(damage_id=damage_id, description=d) for d in data[key])
+        
+        version = bump_kb_version(db.session)
+        db.session.commit()
+        _publish(version, damage_ids=[damage_id])
+        
+        return jsonify(db.session.get(Damage, damage_id).to_dict())
+
+    @app.route('/api/damages/<int:damage_id>', methods=['DELETE'])
+    @token_required
+    def delete_damage(current_user, damage_id):
+        """Deletes a damage with its causes, solutions and the rules concluding it."""
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        damage = db.session.get(Damage, damage_id)
+        if damage is None:
+            return jsonify({'message': 'Damage not found'}), 404
+        if db.session.scalar(select(Consultation.id).where(Consultation.damage_id == damage_id).limit(1)):
+            return jsonify({'message': 'Damage is referenced by consultations'}), 409
+        premise_rule_ids = sorted(db.session.scalars(select(RuleDamage.rule_id).where(RuleDamage.damage_id == damage_id)))
+        if premise_rule_ids:
+            return jsonify({'message': 'Damage is a premise of other rules', 'rule_ids': premise_rule_ids}), 409
+        
+        rule_ids = sorted(db.session.scalars(select(Rule.id).where(Rule.damage_id == damage_id)))
+        _delete_rules(rule_ids)
+        db.session.execute(delete(Cause).where(Cause.damage_id == damage_id))
+        db.session.execute(delete(Solution).where(Solution.damage_id == damage_id))
+        db.session.execute(delete(Damage).where(Damage.id == damage_id))
+        version = bump_kb_version(db.session)
+        db.session.commit()
+        _publish(version, rule_ids=rule_ids, damage_ids=[damage_id])
+        
+        return jsonify({'message': 'Damage deleted', 'id': damage_id, 'deleted_rule_ids': rule_ids})
+
     @app.route('/api/rules', methods=['GET'])
     def get_rules():
-        rules = Rule.query.all()
-        return jsonify([r.to_dict() for r in rules])
+        return _cached_listing('rules', lambda: _rule_listing(db.session))
+
+    @app.route('/api/rules/analysis', methods=['GET'])
+    @token_required
+    def analyze_rules(current_user):
+        """Duplicate, conflicting, subsumed and unreachable rules, and unused symptoms/damages."""
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        return _cached_listing(
+            'rules-analysis', lambda: analysis.analyze_knowledge_base(expert_system.knowledge_base())
+        )
 
     @app.route('/api/rules', methods=['POST'])
     @token_required
@@ -175,68 +762,419 @@ def init_routes(app):
             
         data = request.get_json()
         
-        if not data or not data.get('damage_id') or not data.get('symptom_ids'):
+        if not data or not data.get('damage_id') or not (data.get('symptom_ids') or data.get('premise_damage_ids')):
             return jsonify({'message': 'Missing data'}), 400
+        
+        if type(data['damage_id']) is not int:
+            return jsonify({'message': 'damage_id must be an integer'}), 400
+        ids = {}
+        for key in ('symptom_ids', 'premise_damage_ids'):
+            ids[key] = _id_list(data, key)
+            if ids[key] is None:
+                return jsonify({'message': f'{key} must be a list of integers'}), 400
+        
+        # Optional scope: motorcycle_id (one model) or brand; neither makes a generic rule
+        motorcycle_id, brand, error = _rule_scope(data)
+        if error:
+            return jsonify({'message': error}), 400
+        
+        unknown = {
+            'symptom_ids': _missing_ids(Symptom, ids['symptom_ids']),
+            'damage_ids': _missing_ids(Damage, [data['damage_id']] + ids['premise_damage_ids'])
+        }
+        if unknown['symptom_ids'] or unknown['damage_ids']:
+            return jsonify(dict(unknown, message='Unknown ids')), 400
             
-        new_rule = Rule(damage_id=data['damage_id'])
+        new_rule = Rule(damage_id=data['damage_id'], motorcycle_id=motorcycle_id, brand=brand)
         db.session.add(new_rule)
         db.session.flush()
         
-        for symptom_id in data['symptom_ids']:
-            rule_symptom = RuleSymptom(rule_id=new_rule.id, symptom_id=symptom_id)
-            db.session.add(rule_symptom)
+        rule_symptoms = [{'rule_id': new_rule.id, 'symptom_id': symptom_id} for symptom_id in ids['symptom_ids']]
+        if rule_symptoms:
+            db.session.execute(insert(RuleSymptom), rule_symptoms)
+        
+        # Chained rules: conclusions of other rules used as premises
+        premises = [{'rule_id': new_rule.id, 'damage_id': damage_id} for damage_id in ids['premise_damage_ids']]
+        if premises:
+            db.session.execute(insert(RuleDamage), premises)
         
+        version = bump_kb_version(db.session)
         db.session.commit()
+        _publish(version, rule_ids=[new_rule.id])
         
         return jsonify(new_rule.to_dict()), 201
 
+    @app.route('/api/rules/<int:rule_id>', methods=['PUT', 'PATCH'])
+    @token_required
+    def update_rule(current_user, rule_id):
+        """
+        PUT replaces the rule; PATCH changes only the fields given
+        (damage_id, symptom_ids, premise_damage_ids, motorcycle_id, brand).
+        """
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        rule = db.session.get(Rule, rule_id)
+        if rule is None:
+            return jsonify({'message': 'Rule not found'}), 404
+        
+        data = request.get_json()
+        
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Missing data'}), 400
+        if request.method == 'PUT' and (not data.get('damage_id') or not (data.get('symptom_ids') or data.get('premise_damage_ids'))):
+            return jsonify({'message': 'Missing data'}), 400
+        
+        damage_id = data.get('damage_id', rule.damage_id)
+        if type(damage_id) is not int:
+            return jsonify({'message': 'damage_id must be an integer'}), 400
+        current = {
+            'symptom_ids': [rs.symptom_id for rs in rule.symptoms],
+            'premise_damage_ids': [rd.damage_id for rd in rule.premises]
+        }
+        changed = {}
+        for key in current:
+            if key in data or request.method == 'PUT':
+                ids = _id_list(data, key)
+                if ids is None:
+                    return jsonify({'message': f'{key} must be a list of integers'}), 400
+                changed[key] = current[key] = ids
+        if not current['symptom_ids'] and not current['premise_damage_ids']:
+            return jsonify({'message': 'A rule needs at least one symptom or premise'}), 400
+        motorcycle_id, brand, error = _rule_scope(data, rule if request.method == 'PATCH' else None)
+        if error:
+            return jsonify({'message': error}), 400
+        
+        unknown = {
+            'symptom_ids': _missing_ids(Symptom, changed.get('symptom_ids', [])),
+            'damage_ids': _missing_ids(Damage, [damage_id] + changed.get('premise_damage_ids', []))
+        }
+        if unknown['symptom_ids'] or unknown['damage_ids']:
+            return jsonify(dict(unknown, message='Unknown ids')), 400
+        
+        rule.damage_id = damage_id
+        rule.motorcycle_id = motorcycle_id
+        rule.brand = brand
+        if 'symptom_ids' in changed:
+            _replace_rows(RuleSymptom, rule_id, 'symptom_id', changed['symptom_ids'])
+        if 'premise_damage_ids' in changed:
+            _replace_rows(RuleDamage, rule_id, 'damage_id', changed['premise_damage_ids'])
+        version = bump_kb_version(db.session)
+        db.session.commit()
+        _publish(version, rule_ids=[rule_id])
+        
+        return jsonify(db.session.get(Rule, rule_id).to_dict())
+
+    @app.route('/api/rules/<int:rule_id>', methods=['DELETE'])
+    @token_required
+    def delete_rule(current_user, rule_id):
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        if db.session.get(Rule, rule_id) is None:
+            return jsonify({'message': 'Rule not found'}), 404
+        
+        _delete_rules([rule_id])
+        version = bump_kb_version(db.session)
+        db.session.commit()
+        _publish(version, rule_ids=[rule_id])
+        
+        return jsonify({'message': 'Rule deleted', 'id': rule_id})
+
     @app.route('/api/diagnose', methods=['POST'])
     def diagnose():
         data = request.get_json()
         
-        if not data or not data.get('symptom_ids') or not data.get('motorcycle_id'):
-            return jsonify({'message': 'Missing data'}), 400
+        error = _diagnosis_error(data)
+        if error:
+            return jsonify({'message': error}), 400
             
         symptom_ids = data['symptom_ids']
         motorcycle_id = data['motorcycle_id']
+        top_k = data.get('top_k')
         
-        diagnosis = expert_system.diagnose(symptom_ids)
+        if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or not 1 <= top_k <= 50):
+            return jsonify({'message': 'top_k must be an integer between 1 and 50'}), 400
         
-        new_consultation = Consultation(
-            user_id=data.get('user_id'),
-            motorcycle_id=motorcycle_id,
-            damage_id=diagnosis['id'] if diagnosis else None
-        )
-        db.session.add(new_consultation)
-        db.session.flush()
+        # Only the generic rules and those of this motorcycle's model and brand are evaluated
+        kb = expert_system.knowledge_base().scoped(motorcycle_id)
+        damage_id, diagnosis_json = diagnosis_memo.diagnose(kb, symptom_ids)
+        candidates = None
+        if top_k:
+            with span('engine.rank'):
+                candidates = kb.rank(symptom_ids, top_k)
         
-        for symptom_id in symptom_ids:
-            cs = ConsultationSymptom(consultation_id=new_consultation.id, symptom_id=symptom_id)
-            db.session.add(cs)
+        writer = app.extensions.get('consultation_writer')
+        if writer is not None:
+            # Write-behind: the consultation is persisted by a background worker
+            consultation_id = writer.submit(
+                data.get('user_id'), motorcycle_id, damage_id, symptom_ids
+            )
+        else:
+            new_consultation = Consultation(
+                id=app.extensions['consultation_ids'].next_id(),
+                user_id=data.get('user_id'),
+                motorcycle_id=motorcycle_id,
+                damage_id=damage_id
+            )
+            db.session.add(new_consultation)
+            db.session.flush()
+            
+            for symptom_id in symptom_ids:
+                cs = ConsultationSymptom(consultation_id=new_consultation.id, symptom_id=symptom_id)
+                db.session.add(cs)
+            
+            analytics.record_consultation(new_consultation, symptom_ids, buffer=app.extensions.get('rollup_buffer'))
+            db.session.commit()
+            consultation_id = new_consultation.id
         
-        db.session.commit()
+        with span('serialize'):
+            body = _diagnosis_body(consultation_id, damage_id, diagnosis_json, candidates)
+            return current_app.response_class(body, mimetype='application/json')
+
+    @app.route('/api/diagnose/cache', methods=['GET'])
+    @token_required
+    def diagnosis_cache_stats(current_user):
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
         
-        if diagnosis:
-            return jsonify({
-                'consultation_id': new_consultation.id,
-                'diagnosis': diagnosis
-            })
+        return jsonify(diagnosis_memo.stats())
+
+    @app.route('/api/diagnose/batch', methods=['POST'])
+    def diagnose_batch():
+        """
+        Diagnoses many inspections against one compiled rule snapshot.
+        Accepts a JSON array or an application/x-ndjson stream of
+        {motorcycle_id, symptom_ids, user_id} items and streams one NDJSON
+        result line per item, committing every BATCH_CHUNK_SIZE items.
+        """
+        if request.mimetype == 'application/x-ndjson':
+            items = _ndjson_items(request.stream)
         else:
-            return jsonify({
-                'consultation_id': new_consultation.id,
-                'diagnosis': None,
-                'message': 'No matching diagnosis found'
-            })
+            items = request.get_json(silent=True)
+            if not isinstance(items, list):
+                return jsonify({'message': 'Expected a JSON array or NDJSON body'}), 400
+        
+        kb = expert_system.knowledge_base()
+        chunk_size = app.config['BATCH_CHUNK_SIZE']
+        
+        def generate():
+            chunk = []
+            for index, item in enumerate(items):
+                chunk.append((index, item))
+                if len(chunk) >= chunk_size:
+                    yield from _diagnose_chunk(kb, chunk)
+                    chunk = []
+            if chunk:
+                yield from _diagnose_chunk(kb, chunk)
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    @app.route('/api/sessions', methods=['POST'])
+    def start_session():
+        """
+        Starts an interactive diagnosis. Optional symptom_ids are confirmed
+        up front; the response carries the first question to ask. With a
+        motorcycle_id, that model's and brand's rules are asked about too.
+        """
+        data = request.get_json(silent=True) or {}
+        symptom_ids = data.get('symptom_ids', [])
+        motorcycle_id = data.get('motorcycle_id')
+        
+        if not isinstance(symptom_ids, list) or not all(isinstance(s, int) for s in symptom_ids):
+            return jsonify({'message': 'symptom_ids must be a list of integers'}), 400
+        if motorcycle_id is not None and type(motorcycle_id) is not int:
+            return jsonify({'message': 'motorcycle_id must be an integer'}), 400
+        
+        session = expert_system.start_questions(symptom_ids, motorcycle_id)
+        session_id = secrets.token_urlsafe(16)
+        session_store.set(session_id, session)
+        
+        return jsonify(_session_state(session_id, session)), 201
+
+    @app.route('/api/sessions/<session_id>', methods=['GET'])
+    def get_session(session_id):
+        session = session_store.get(session_id)
+        if session is None:
+            return jsonify({'message': 'Session not found or expired'}), 404
+        
+        with session.lock:
+            return jsonify(_session_state(session_id, session))
+
+    @app.route('/api/sessions/<session_id>/answer', methods=['POST'])
+    def answer_session(session_id):
+        """Confirms or denies one symptom: {symptom_id, present}."""
+        data = request.get_json(silent=True)
+        
+        if not data or not isinstance(data.get('symptom_id'), int) or not isinstance(data.get('present'), bool):
+            return jsonify({'message': 'symptom_id (integer) and present (boolean) are required'}), 400
+        
+        session = session_store.get(session_id)
+        if session is None:
+            return jsonify({'message': 'Session not found or expired'}), 404
+        
+        with session.lock:
+            session.answer(data['symptom_id'], data['present'])
+            session_store.set(session_id, session)
+            return jsonify(_session_state(session_id, session))
+
+    @app.route('/api/sessions/<session_id>', methods=['DELETE'])
+    def end_session(session_id):
+        if session_store.pop(session_id) is None:
+            return jsonify({'message': 'Session not found or expired'}), 404
+        return jsonify({'message': 'Session ended'})
 
     @app.route('/api/consultations', methods=['GET'])
     @token_required
     def get_consultations(current_user):
-        if current_user.role == 'admin':
-            consultations = Consultation.query.all()
+        """
+        Lists consultations, optionally filtered by user_id (admin only),
+        motorcycle_id, damage_id, date_from and date_to. Passing limit or
+        cursor switches to keyset pagination and returns
+        {items, next_cursor} instead of a bare array (see _consultation_args).
+        """
+        try:
+            filters, cursor, limit, paginated = _consultation_args(current_user, request.args)
+        except ValueError:
+            return jsonify({'message': 'Invalid query parameters'}), 400
+        
+        with span('orm.load'):
+            consultations = _consultation_page(filters, cursor, limit)
+        
+        with span('serialize'):
+            data, next_cursor = _consultation_listing(consultations, paginated, limit)
+            
+            # Consultations change with every diagnosis, so only the ETag is
+            # reused: an unchanged listing costs the client no transfer.
+            body = current_app.json.dumps(data).encode() + b'\n'
+        response = _json_response(body)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    @app.route('/api/consultations/export', methods=['GET'])
+    @token_required
+    def export_consultations(current_user):
+        """
+        Streams every consultation matching the listing filters as NDJSON
+        (default) or CSV (?format=csv), reading in keyset-paginated chunks.
+        """
+        try:
+            filters = _consultation_filters(current_user, request.args)
+        except ValueError:
+            return jsonify({'message': 'Invalid query parameters'}), 400
+        
+        export_format = request.args.get('format', 'ndjson')
+        
+        if export_format == 'csv':
+            def generate():
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(['id', 'user_id', 'motorcycle_id', 'damage_id', 'consultation_date', 'symptoms'])
+                for c in _iter_consultations(filters):
+                    data = c.to_dict()
+                    writer.writerow([
+                        data['id'], data['user_id'], data['motorcycle_id'], data['damage_id'],
+                        data['consultation_date'], ';'.join(str(s) for s in data['symptoms'])
+                    ])
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            mimetype = 'text/csv'
+        elif export_format == 'ndjson':
+            def generate():
+                for c in _iter_consultations(filters):
+                    yield json.dumps(c.to_dict()) + '\n'
+            mimetype = 'application/x-ndjson'
         else:
-            consultations = Consultation.query.filter_by(user_id=current_user.id).all()
+            return jsonify({'message': 'Unsupported format'}), 400
+        
+        response = Response(stream_with_context(generate()), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename=consultations.{export_format}'
+        return response
+
+    @app.route('/api/stats/damages', methods=['GET'])
+    @token_required
+    def stats_damages(current_user):
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        try:
+            date_from = _parse_day(request.args.get('date_from'))
+            date_to = _parse_day(request.args.get('date_to'))
+            motorcycle_id = request.args.get('motorcycle_id', type=int)
+        except ValueError:
+            return jsonify({'message': 'Invalid query parameters'}), 400
+        
+        return jsonify(analytics.damage_frequency(date_from, date_to, motorcycle_id))
+
+    @app.route('/api/stats/symptom-pairs', methods=['GET'])
+    @token_required
+    def stats_symptom_pairs(current_user):
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
         
-        return jsonify([c.to_dict() for c in consultations])
+        limit = max(1, min(request.args.get('limit', 20, type=int), 500))
+        return jsonify(analytics.symptom_pairs(limit))
+
+    @app.route('/api/stats/hit-rate', methods=['GET'])
+    @token_required
+    def stats_hit_rate(current_user):
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        try:
+            date_from = _parse_day(request.args.get('date_from'))
+            date_to = _parse_day(request.args.get('date_to'))
+        except ValueError:
+            return jsonify({'message': 'Invalid query parameters'}), 400
+        
+        return jsonify(analytics.hit_rate(date_from, date_to))
+
+    @app.route('/api/kb/import', methods=['POST'])
+    @token_required
+    def import_knowledge_base(current_user):
+        """
+        Imports a code-keyed knowledge-base bundle (see app/kb_io.py): a JSON
+        object, or multipart/form-data with one CSV file per section
+        (symptoms.csv, damages.csv, ...). ?dry_run=1 only validates.
+        """
+        if current_user.role != 'admin':
+            return jsonify({'message': 'Permission denied'}), 403
+        
+        try:
+            if request.files:
+                bundle = kb_io.read_csv_sections({
+                    f.filename or name: io.StringIO(f.read().decode('utf-8-sig'))
+                    for name, f in request.files.items()
+                })
+            else:
+                bundle = request.get_json(silent=True)
+                if bundle is None:
+                    return jsonify({'message': 'Expected a JSON bundle or CSV files'}), 400
+            
+            dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+            report = kb_io.import_bundle(bundle, app.config['KB_IMPORT_CHUNK_SIZE'], dry_run)
+        except kb_io.BundleError as e:
+            return jsonify({'message': str(e), 'errors': e.errors}), 400
+        except UnicodeDecodeError:
+            return jsonify({'message': 'CSV files must be UTF-8'}), 400
+        
+        if not dry_run:
+            expert_system.invalidate()
+        
+        return jsonify({'dry_run': dry_run, 'report': report})
+
+    @app.route('/api/kb/export', methods=['GET'])
+    def export_knowledge_base():
+        """Exports the knowledge base as a JSON bundle, or ?format=csv as a zip of CSV files."""
+        if request.args.get('format') == 'csv':
+            return Response(
+                kb_io.csv_archive(kb_io.export_bundle()),
+                mimetype='application/zip',
+                headers={'Content-Disposition': 'attachment; filename=knowledge_base.zip'}
+            )
+        return _cached_listing('kb-export', kb_io.export_bundle)
 
     @app.route('/api/seed', methods=['POST'])
     def seed_database():
@@ -284,10 +1222,6 @@ def init_routes(app):
             {'code': 'G29', 'name': 'Alur Torque Cam Menjadi Lebih Landai'}
         ]
         
-        for symptom_data in symptoms:
-            symptom = Symptom(**symptom_data)
-            db.session.add(symptom)
-        
         damages = [
             {'code': 'K1', 'name': 'Drive Belt Aus'},
             {'code': 'K2', 'name': 'Ramp Plate Rusak'},
@@ -306,10 +1240,6 @@ def init_routes(app):
             {'code': 'K15', 'name': 'Torque Cam Rusak'}
         ]
         
-        for damage_data in damages:
-            damage = Damage(**damage_data)
-            db.session.add(damage)
-        
         admin_user = User(
             username='admin',
             password=generate_password_hash('admin123'),
@@ -324,56 +1254,35 @@ def init_routes(app):
         )
         db.session.add(tech_user)
         
+        bump_kb_version(db.session)  # motorcycles
         db.session.commit()
         
-        rule1 = Rule(damage_id=1)  # K1: Drive Belt Aus
-        db.session.add(rule1)
-        db.session.flush()
-        
-        rule_symptom1 = RuleSymptom(rule_id=rule1.id, symptom_id=4)  # G4
-        db.session.add(rule_symptom1)
-        
-        rule2 = Rule(damage_id=4)  # K4: Drive Belt Putus
-        db.session.add(rule2)
-        db.session.flush()
-        
-        rule_symptom2a = RuleSymptom(rule_id=rule2.id, symptom_id=1)  # G1
-        rule_symptom2b = RuleSymptom(rule_id=rule2.id, symptom_id=2)  # G2
-        rule_symptom2c = RuleSymptom(rule_id=rule2.id, symptom_id=7)  # G7
-        db.session.add(rule_symptom2a)
-        db.session.add(rule_symptom2b)
-        db.session.add(rule_symptom2c)
-        
-        rule3 = Rule(damage_id=5)  # K5: Drive Belt Terkontaminasi Minyak
-        db.session.add(rule3)
-        db.session.flush()
-        
-        rule_symptom3a = RuleSymptom(rule_id=rule3.id, symptom_id=8)  # G8
-        rule_symptom3b = RuleSymptom(rule_id=rule3.id, symptom_id=10)  # G10
-        db.session.add(rule_symptom3a)
-        db.session.add(rule_symptom3b)
+        rules = [
+            {'damage': 'K1', 'symptoms': ['G4']},  # K1: Drive Belt Aus
+            {'damage': 'K4', 'symptoms': ['G1', 'G2', 'G7']},  # K4: Drive Belt Putus
+            {'damage': 'K5', 'symptoms': ['G8', 'G10']}  # K5: Drive Belt Terkontaminasi Minyak
+        ]
         
         solutions = [
-            {'damage_id': 1, 'description': 'Ganti drive belt dengan yang baru sesuai spesifikasi pabrikan.'},
-            {'damage_id': 4, 'description': 'Ganti drive belt yang putus dengan yang baru.'},
-            {'damage_id': 5, 'description': 'Bersihkan permukaan pully dari minyak dan ganti drive belt dengan yang baru.'}
+            {'damage': 'K1', 'description': 'Ganti drive belt dengan yang baru sesuai spesifikasi pabrikan.'},
+            {'damage': 'K4', 'description': 'Ganti drive belt yang putus dengan yang baru.'},
+            {'damage': 'K5', 'description': 'Bersihkan permukaan pully dari minyak dan ganti drive belt dengan yang baru.'}
         ]
         
-        for solution_data in solutions:
-            solution = Solution(**solution_data)
-            db.session.add(solution)
-        
         causes = [
-            {'damage_id': 1, 'description': 'Umur pakai drive belt sudah terlalu lama.'},
-            {'damage_id': 4, 'description': 'Drive belt sudah aus parah sehingga menjadi putus.'},
-            {'damage_id': 5, 'description': 'Kebocoran oli transmisi atau kebocoran oli dari bagian mesin.'}
+            {'damage': 'K1', 'description': 'Umur pakai drive belt sudah terlalu lama.'},
+            {'damage': 'K4', 'description': 'Drive belt sudah aus parah sehingga menjadi putus.'},
+            {'damage': 'K5', 'description': 'Kebocoran oli transmisi atau kebocoran oli dari bagian mesin.'}
         ]
         
-        for cause_data in causes:
-            cause = Cause(**cause_data)
-            db.session.add(cause)
-        
-        db.session.commit()
+        kb_io.import_bundle({
+            'symptoms': symptoms,
+            'damages': damages,
+            'causes': causes,
+            'solutions': solutions,
+            'rules': rules
+        })
+        expert_system.invalidate()
         
         return jsonify({'message': 'Database seeded successfully'}), 200
 
@@ -0,0 +1,338 @@
+"""
+In-memory fuzzy search over the symptom catalogue (GET /api/symptoms/search).
+
+Symptom code, name and description are normalized into terms: lowercased
+and accent-folded, common chat abbreviations expanded ("tdk" -> "tidak"),
+"bunyi2" reduplication folded, and stopwords dropped. Each word is indexed
+both as written and as a light Indonesian stem: particles (-lah, -kah,
+-pun), possessives (-nya, -ku, -mu), suffixes -kan/-an/-i and the prefixes
+di-, ke-, se-, ter-, ber- and me- before a nasal or liquid. So "berbunyi",
+"bunyinya" and "bunyi" meet.
+
+A query word matches a term exactly, as a prefix (typeahead), or within one
+or two edits (typos, found through a trigram index over the terms).
+Symptoms are ranked by how many query words they match, then by the summed
+match quality weighted by field (code > name > description).
+
+Postings are bitsets over symptom ids, and the ranking is a bit-sliced
+counter like the rule engine's (KnowledgeBase.rank): a query costs a few
+big-integer operations per query word and match level, and only the
+symptoms on the requested page are decoded, however common the words are.
+"""
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+import re
+import threading
+import unicodedata
+from .cache import LRUCache
+from .expert_system import _popcount
+
+# Field weights; a term found in several fields counts with the best one
+FIELD_WEIGHTS = (('code', 3.0), ('name', 2.0), ('description', 1.0))
+
+# Match quality per kind of match
+EXACT, PREFIX, ONE_EDIT, TWO_EDITS = 1.0, 0.8, 0.6, 0.4
+
+# Every quality * weight is a multiple of this, so scores are counted in
+# whole units and add up exactly
+SCORE_UNIT = 0.2
+MAX_UNITS = round(EXACT * FIELD_WEIGHTS[0][1] / SCORE_UNIT)
+
+ABBREVIATIONS = {
+    'tdk': 'tidak', 'gak': 'tidak', 'ga': 'tidak', 'gk': 'tidak', 'nggak': 'tidak', 'enggak': 'tidak',
+    'yg': 'yang', 'dgn': 'dengan', 'dg': 'dengan', 'krn': 'karena', 'utk': 'untuk',
+    'sdh': 'sudah', 'udah': 'sudah', 'blm': 'belum', 'lg': 'lagi', 'msn': 'mesin', 'mtr': 'motor'
+}
+
+STOPWORDS = frozenset({
+    'yang', 'dan', 'atau', 'di', 'ke', 'dari', 'pada', 'saat', 'ketika', 'dengan', 'ini', 'itu',
+    'untuk', 'the', 'a', 'of'
+})
+
+_WORD = re.compile(r'[a-z0-9]+')
+_REDUPLICATED = re.compile(r'^([a-z]{2,})2$')
+
+_PARTICLES = ('lah', 'kah', 'tah', 'pun')
+_POSSESSIVES = ('nya', 'ku', 'mu')
+_SUFFIXES = ('kan', 'an', 'i')
+_PREFIXES = ('ber', 'ter', 'di', 'ke', 'se')
+# me- only before these, so words like "mesin" keep their first syllable
+_ME_ONSETS = ('ng', 'ny', 'm', 'n', 'l', 'r', 'w', 'y')
+
+def _strip_suffix(word, suffixes):
+    for suffix in suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+def stem(word):
+    """Light, dictionary-free Indonesian stemmer; index and queries use the same one."""
+    if not word.isalpha():
+        return word
+    word = _strip_suffix(word, _PARTICLES)
+    word = _strip_suffix(word, _POSSESSIVES)
+    word = _strip_suffix(word, _SUFFIXES)
+    for prefix in _PREFIXES:
+        if word.startswith(prefix) and len(word) - len(prefix) >= 4:
+            return word[len(prefix):]
+    if word.startswith('me') and word[2:].startswith(_ME_ONSETS) and len(word) >= 6:
+        return word[2:]
+    return word
+
+def normalize(text):
+    """Returns the normalized words of text, stopwords removed."""
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    words = []
+    for word in _WORD.findall(text):
+        word = ABBREVIATIONS.get(word, word)
+        word = _REDUPLICATED.sub(r'\1', word)
+        if word not in STOPWORDS:
+            words.append(word)
+    return words
+
+def _trigrams(term):
+    padded = f'^{term}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _edits(a, b, limit):
+    """
+    Optimal string alignment distance (a swap of neighbours counts once),
+    or limit + 1 once it is certain to exceed limit. Only the cells within
+    limit of the diagonal can stay under it, so only those are computed.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    previous2 = None
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [i if i <= limit else over] + [over] * len(b)
+        best = current[0]
+        # Plain comparisons; min() calls dominate the cost of this loop
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            value = previous[j - 1] + (a[i - 1] != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1] and previous2[j - 2] + 1 < value:
+                value = previous2[j - 2] + 1
+            current[j] = value
+            if value < best:
+                best = value
+        if best > limit:
+            return over
+        previous2, previous = previous, current
+    return min(previous[-1], over)
+
+def _add(counter, bits, value):
+    """Adds value to the count of every member of bits in a bit-sliced counter."""
+    j = 0
+    while value:
+        if value & 1:
+            carry = bits
+            k = j
+            while carry:
+                if k >= len(counter):
+                    counter.extend([0] * (k - len(counter)))
+                    counter.append(carry)
+                    break
+                counter[k], carry = counter[k] ^ carry, counter[k] & carry
+                k += 1
+        value >>= 1
+        j += 1
+
+def _top(counter, bits, count):
+    """
+    Returns up to count (value, position) pairs for the members of bits,
+    highest value first and lowest position first among equal values.
+    Values are walked from the top slice down, so only the branches that
+    reach the result are split.
+    """
+    ranked = []
+    stack = [(len(counter) - 1, bits, 0)] if bits else []
+    while stack and len(ranked) < count:
+        j, bits, value = stack.pop()
+        if j < 0:
+            while bits and len(ranked) < count:
+                lowest = bits & -bits
+                bits ^= lowest
+                ranked.append((value, lowest.bit_length() - 1))
+            continue
+        low = bits & ~counter[j]
+        high = bits & counter[j]
+        if low:
+            stack.append((j - 1, low, value))
+        if high:
+            stack.append((j - 1, high, value | 1 << j))
+    return ranked
+
+class SymptomIndex:
+    """
+    Term index over symptoms, updated in place as symptoms change.
+
+    version is the knowledge-base version the index reflects (see
+    routes._symptom_index); None means it has not been built yet. Bit n
+    of a posting bitset stands for symptom id n.
+    """
+    def __init__(self):
+        self.version = None
+        self._symptoms = {}
+        self._symptom_terms = {}
+        self._postings = defaultdict(dict)  # term -> {field weight: bitset of symptom ids}
+        self._terms = []  # sorted, for prefix lookups
+        self._trigrams = defaultdict(set)  # trigram -> terms
+        self._matched = LRUCache(maxsize=10000)  # query word -> _levels(word)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._symptoms)
+
+    def _terms_of(self, symptom):
+        terms = {}
+        for field, weight in FIELD_WEIGHTS:
+            for word in normalize(symptom.get(field)):
+                for term in {word, stem(word)}:
+                    if terms.get(term, 0) < weight:
+                        terms[term] = weight
+        return terms
+
+    def _add_term(self, term):
+        insort(self._terms, term)
+        # Only words are typo candidates; codes and numbers must match exactly or by prefix
+        if term.isalpha():
+            for trigram in _trigrams(term):
+                self._trigrams[trigram].add(term)
+
+    def _drop_term(self, term):
+        del self._postings[term]
+        del self._terms[bisect_left(self._terms, term)]
+        if term.isalpha():
+            for trigram in _trigrams(term):
+                self._trigrams[trigram].discard(term)
+                if not self._trigrams[trigram]:
+                    del self._trigrams[trigram]
+
+    def _remove(self, symptom_id):
+        self._symptoms.pop(symptom_id, None)
+        for term, weight in self._symptom_terms.pop(symptom_id, {}).items():
+            postings = self._postings[term]
+            postings[weight] ^= 1 << symptom_id
+            if not postings[weight]:
+                del postings[weight]
+            if not postings:
+                self._drop_term(term)
+
+    def _upsert(self, symptom):
+        self._remove(symptom['id'])
+        terms = self._terms_of(symptom)
+        for term, weight in terms.items():
+            if term not in self._postings:
+                self._add_term(term)
+            postings = self._postings[term]
+            postings[weight] = postings.get(weight, 0) | 1 << symptom['id']
+        self._symptoms[symptom['id']] = symptom
+        self._symptom_terms[symptom['id']] = terms
+
+    def rebuild(self, symptoms, version):
+        """Replaces the whole index with the given symptom dicts."""
+        fresh = SymptomIndex()
+        for symptom in symptoms:
+            fresh._upsert(symptom)
+        with self._lock:
+            for name in ('_symptoms', '_symptom_terms', '_postings', '_terms', '_trigrams'):
+                setattr(self, name, getattr(fresh, name))
+            self._matched.clear()
+            self.version = version
+
+    def advance(self, previous_version, version, symptoms=(), removed_ids=()):
+        """
+        Applies symptom changes made between two knowledge-base versions.
+        Returns False (leaving the index stale) when the index was not at
+        previous_version, so the next search rebuilds it instead.
+        """
+        with self._lock:
+            if self.version != previous_version:
+                return False
+            for symptom_id in removed_ids:
+                self._remove(symptom_id)
+            for symptom in symptoms:
+                self._upsert(symptom)
+            self._matched.clear()
+            self.version = version
+            return True
+
+    def _matches(self, word):
+        """Returns {term: quality} for every term a query word matches."""
+        matches = {}
+        for term in (word, stem(word)):
+            if term in self._postings:
+                matches[term] = EXACT
+
+        if len(word) >= 2:
+            i = bisect_left(self._terms, word)
+            while i < len(self._terms) and self._terms[i].startswith(word):
+                matches.setdefault(self._terms[i], PREFIX)
+                i += 1
+
+        if len(word) >= 4 and word.isalpha():
+            limit = 1 if len(word) < 8 else 2
+            trigrams = _trigrams(word)
+            shared = Counter()
+            for trigram in trigrams:
+                shared.update(self._trigrams.get(trigram, ()))
+            # An edit changes at most three trigrams
+            needed = max(1, len(trigrams) - 3 * limit)
+            for term, count in shared.items():
+                if count < needed or term in matches or abs(len(term) - len(word)) > limit:
+                    continue
+                distance = _edits(word, term, limit)
+                if distance <= limit:
+                    matches[term] = ONE_EDIT if distance <= 1 else TWO_EDITS
+        return matches
+
+    def _levels(self, word):
+        """
+        Returns [(units, bits)] best first, where bits holds the symptoms
+        whose best match for a query word scores units.
+        """
+        by_units = defaultdict(int)
+        for term, quality in self._matches(word).items():
+            for weight, bits in self._postings[term].items():
+                by_units[round(quality * weight / SCORE_UNIT)] |= bits
+
+        levels = []
+        seen = 0
+        for units in sorted(by_units, reverse=True):
+            bits = by_units[units] & ~seen
+            if bits:
+                levels.append((units, bits))
+                seen |= bits
+        return levels
+
+    def search(self, query, limit=20, offset=0):
+        """
+        Returns (total, ranked page) where each entry is the symptom dict
+        with its 'score'. Symptoms matching more query words rank first,
+        then by score; ties are broken by symptom id.
+        """
+        words = list(dict.fromkeys(normalize(query)))
+        # Rank key: words matched above the score units, which sum to at most this
+        shift = (MAX_UNITS * len(words)).bit_length()
+        counter = []
+        matched = 0
+        with self._lock:
+            for word in words:
+                levels = self._matched.get(word)
+                if levels is None:
+                    levels = self._levels(word)
+                    self._matched.set(word, levels)
+                for units, bits in levels:
+                    _add(counter, bits, (1 << shift) + units)
+                    matched |= bits
+
+            page = [
+                dict(self._symptoms[symptom_id], score=round((key & ((1 << shift) - 1)) * SCORE_UNIT, 3))
+                for key, symptom_id in _top(counter, matched, offset + limit)[offset:]
+            ]
+        return _popcount(matched), page
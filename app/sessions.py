@@ -0,0 +1,97 @@
+"""
+Storage for interactive diagnosis sessions (/api/sessions).
+
+A QuestionSession holds compiled bitsets and a Rete session, so it lives
+in the worker that created it. With a shared backend, the few facts that
+define a session (its motorcycle and the confirmed and denied symptoms)
+are written there on every answer, and a worker that does not hold the
+session, or holds an older copy of it, rebuilds it by replaying them.
+Requests for one session then need no sticky routing.
+"""
+import json
+import logging
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+def session_state(session):
+    """The answers that define a QuestionSession, as stored in the shared backend."""
+    return {
+        'motorcycle_id': session.motorcycle_id,
+        'confirmed': sorted(session.confirmed),
+        'denied': sorted(session.denied)
+    }
+
+class SessionStore(LRUCache):
+    """
+    Sessions keyed by session id. Every answer re-stores the session, so
+    the TTL acts as an idle timeout, locally and in the backend.
+
+    Answers are order independent, so replaying the confirmed symptoms and
+    then the denied ones yields the same candidates and diagnosis. Two
+    workers answering the same session at once keep the last write. A
+    failing backend is logged and skipped; sessions then only survive in
+    the worker that holds them.
+    """
+    def __init__(self, start, maxsize=10000, ttl=1800, backend=None):
+        """
+        Args:
+            start (callable): (symptom_ids, motorcycle_id) -> new QuestionSession
+            backend: Shared backend (memo.backend_from_url) or None
+        """
+        super().__init__(maxsize, ttl)
+        self.start = start
+        self.backend = backend
+
+    def configure(self, maxsize, ttl, backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.clear()
+
+    def get(self, key, default=None):
+        session = super().get(key)
+        if self.backend is None:
+            return session if session is not None else default
+
+        try:
+            raw = self.backend.get(_key(key))
+        except Exception:
+            logger.exception('Session store backend read failed')
+            return session if session is not None else default
+        if raw is None:
+            if session is not None:
+                super().pop(key)  # Ended or expired through another worker
+            return default
+
+        state = json.loads(raw)
+        if session is None or session_state(session) != state:
+            session = self.start(state['confirmed'], state['motorcycle_id'])
+            for symptom_id in state['denied']:
+                session.answer(symptom_id, False)
+            super().set(key, session)
+        return session
+
+    def set(self, key, value, ttl=None):
+        super().set(key, value, ttl)
+        if self.backend is not None:
+            try:
+                self.backend.set(_key(key), json.dumps(session_state(value)).encode(), ttl or self.ttl)
+            except Exception:
+                logger.exception('Session store backend write failed')
+
+    def pop(self, key, default=None):
+        """Removes a session; returns it (or its stored state when only the backend held it)."""
+        session = super().pop(key)
+        if self.backend is not None:
+            try:
+                raw = self.backend.pop(_key(key))
+            except Exception:
+                logger.exception('Session store backend delete failed')
+                raw = None
+            if session is None and raw is not None:
+                session = json.loads(raw)
+        return session if session is not None else default
+
+def _key(session_id):
+    return f'session:{session_id}'
@@ -0,0 +1,446 @@
+"""
+Compact binary snapshots of the compiled knowledge base.
+
+A snapshot holds symptoms, damages (with causes and solutions),
+motorcycle brands, rules with their antecedents and scopes as flat typed
+arrays: CSR offset/value pairs for every
+one-to-many relation, and one interned UTF-8 string table. It also holds
+the posting lists, antecedent-size and scope bitsets the matcher needs. Loading
+maps the file read-only and wraps the sections in memoryviews, so pages
+are shared between worker processes and no database query is needed.
+
+Each snapshot records the shared knowledge-base version it was compiled
+at (see KnowledgeBaseVersion). Processes only load a snapshot written for
+the version they expect, and an export never replaces a snapshot of a
+newer version.
+"""
+import array
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Mapping
+from contextlib import contextmanager
+import click
+from . import db
+from .cli import kb_cli
+from .expert_system import KnowledgeBase, DamageFact, read_kb_version
+from .models import Symptom
+
+try:
+    import fcntl
+except ImportError:  # Windows: exports of one path are not serialized
+    fcntl = None
+
+MAGIC = b'MESKBSNP'
+FORMAT_VERSION = 2
+_HEADER = struct.Struct('<8sII')  # magic, format version, manifest length
+_ALIGN = 8
+
+# Rule scope kinds in rules.scopes (kind, value) pairs
+_GENERIC, _MOTORCYCLE, _BRAND = 0, 1, 2
+
+class _StringTable:
+    def __init__(self):
+        self.index = {}
+        self.data = bytearray()
+        self.offsets = array.array('Q', [0])
+
+    def add(self, value):
+        """Returns the id of an interned string; None is stored as -1."""
+        if value is None:
+            return -1
+        string_id = self.index.get(value)
+        if string_id is None:
+            string_id = self.index[value] = len(self.offsets) - 1
+            self.data += value.encode('utf-8')
+            self.offsets.append(len(self.data))
+        return string_id
+
+def _csr(groups, typecode='q'):
+    """Flattens a list of sequences into (offsets, values) arrays."""
+    offsets = array.array('Q', [0])
+    values = array.array(typecode)
+    for group in groups:
+        values.extend(group)
+        offsets.append(len(values))
+    return offsets, values
+
+def _bitset_bytes(value, size):
+    return value.to_bytes((size + 7) // 8, 'little')
+
+def write_snapshot(path, kb, symptoms):
+    """
+    Serializes a KnowledgeBase and the symptom catalogue to path. The file
+    is written next to the target and renamed into place, so readers never
+    see a partial snapshot.
+
+    Args:
+        path (str): Destination file
+        kb (KnowledgeBase): Compiled knowledge base
+        symptoms (list): Symptom dicts as returned by Symptom.to_dict()
+    """
+    strings = _StringTable()
+    size = len(kb.rule_ids)
+    nbytes = (size + 7) // 8
+    sections = {}
+
+    def add(name, values):
+        sections[name] = values
+
+    add('symptoms', array.array('q', [
+        v for s in symptoms
+        for v in (s['id'], strings.add(s['code']), strings.add(s['name']), strings.add(s['description']))
+    ]))
+
+    damages = list(kb.damages.values())
+    add('damages', array.array('q', [
+        v for d in damages
+        for v in (d['id'], strings.add(d['code']), strings.add(d['name']), strings.add(d['description']))
+    ]))
+    for relation in ('causes', 'solutions'):
+        offsets, values = _csr([
+            [v for item in d[relation] for v in (item['id'], strings.add(item['description']))]
+            for d in damages
+        ])
+        add(f'{relation}.offsets', offsets)
+        add(relation, values)
+
+    add('rules.ids', array.array('q', kb.rule_ids))
+    add('rules.damages', array.array('q', kb.rule_damages))
+    symptom_groups = []
+    premise_groups = []
+    for facts in kb.rule_facts:
+        symptom_groups.append(sorted(f for f in facts if not isinstance(f, DamageFact)))
+        premise_groups.append(sorted(f.damage_id for f in facts if isinstance(f, DamageFact)))
+    offsets, values = _csr(symptom_groups)
+    add('rules.symptom_offsets', offsets)
+    add('rules.symptoms', values)
+    offsets, values = _csr(premise_groups)
+    add('rules.premise_offsets', offsets)
+    add('rules.premises', values)
+    add('rules.scopes', array.array('q', [
+        v for scope in kb.rule_scopes
+        for v in ((_GENERIC, 0) if scope is None else
+                  (_BRAND, strings.add(scope)) if isinstance(scope, str) else (_MOTORCYCLE, scope))
+    ]))
+    add('motorcycles', array.array('q', [
+        v for motorcycle_id, brand in sorted(kb.motorcycles.items()) for v in (motorcycle_id, strings.add(brand))
+    ]))
+    add('rules.unconditional', array.array('q', kb.unconditional))
+    add('rules.chained', array.array('q', sorted(kb.rule_premises)))
+
+    # Facts left without rules by a patched knowledge base are not written
+    facts = sorted(kb.postings, key=kb.fact_bits.get)
+    add('facts', array.array('q', [
+        v for f in facts
+        for v in ((1, f.damage_id) if isinstance(f, DamageFact) else (0, f))
+    ]))
+    offsets, values = _csr(kb.postings[f] for f in facts)
+    add('postings.offsets', offsets)
+    add('postings', values)
+    add('fact_rules', array.array('B', b''.join(_bitset_bytes(kb.fact_rules[f], size) for f in facts)))
+
+    add('length_slices', array.array('B', b''.join(_bitset_bytes(s, size) for s in kb.length_slices)))
+    length_sizes = sorted(kb.length_masks)
+    add('length_masks', array.array('B', b''.join(_bitset_bytes(kb.length_masks[n], size) for n in length_sizes)))
+    scopes = list(kb.scope_masks)
+    add('scope_masks', array.array('B', b''.join(_bitset_bytes(kb.scope_masks[s], size) for s in scopes)))
+
+    add('strings.offsets', strings.offsets)
+    add('strings.data', array.array('B', bytes(strings.data)))
+
+    # Lay the sections out after the header and manifest, 8-byte aligned.
+    # The manifest records absolute offsets, so its own length is fixed first.
+    manifest = {
+        'format': FORMAT_VERSION,
+        'rule_count': size,
+        'bitset_bytes': nbytes,
+        'length_slice_count': len(kb.length_slices),
+        'length_sizes': length_sizes,
+        'scopes': scopes,
+        'kb_version': kb.version,
+        'fingerprint': kb.fingerprint(),
+        'sections': {name: [0, values.typecode, len(values)] for name, values in sections.items()}
+    }
+    placeholder = json.dumps(manifest).encode()
+    # Offsets grow to at most 20 digits each
+    manifest_length = len(placeholder) + 20 * len(sections)
+    offset = _HEADER.size + manifest_length
+    for name, values in sections.items():
+        offset += -offset % _ALIGN
+        manifest['sections'][name][0] = offset
+        offset += len(values) * values.itemsize
+    encoded = json.dumps(manifest).encode().ljust(manifest_length)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.kb-snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, manifest_length))
+            f.write(encoded)
+            for name, values in sections.items():
+                f.write(b'\0' * (manifest['sections'][name][0] - f.tell()))
+                values.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class Snapshot:
+    """Read-only, memory-mapped view of a snapshot file."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, manifest_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a knowledge-base snapshot')
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot format {format_version} (expected {FORMAT_VERSION})')
+        self.manifest = json.loads(self._mmap[_HEADER.size:_HEADER.size + manifest_length])
+        self._view = memoryview(self._mmap)
+        self._string_offsets = self.array('strings.offsets')
+        self._string_data = self.array('strings.data')
+
+    def array(self, name):
+        offset, typecode, count = self.manifest['sections'][name]
+        itemsize = array.array(typecode).itemsize
+        return self._view[offset:offset + count * itemsize].cast(typecode)
+
+    def bitsets(self, name, count):
+        nbytes = self.manifest['bitset_bytes']
+        data = self.array(name)
+        return [int.from_bytes(data[i * nbytes:(i + 1) * nbytes], 'little') for i in range(count)]
+
+    def string(self, string_id):
+        if string_id < 0:
+            return None
+        return bytes(self._string_data[self._string_offsets[string_id]:self._string_offsets[string_id + 1]]).decode('utf-8')
+
+    def symptoms(self):
+        rows = self.array('symptoms')
+        return [
+            {
+                'id': rows[i],
+                'code': self.string(rows[i + 1]),
+                'name': self.string(rows[i + 2]),
+                'description': self.string(rows[i + 3])
+            }
+            for i in range(0, len(rows), 4)
+        ]
+
+    def damages(self):
+        return _DamageTable(self)
+
+class _DamageTable(Mapping):
+    """Damage payloads keyed by id, decoded from the snapshot on first access."""
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._rows = snapshot.array('damages')
+        self._related = {
+            relation: (snapshot.array(f'{relation}.offsets'), snapshot.array(relation))
+            for relation in ('causes', 'solutions')
+        }
+        self._index = {self._rows[i]: i // 4 for i in range(0, len(self._rows), 4)}
+        self._payloads = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, damage_id):
+        payload = self._payloads.get(damage_id)
+        if payload is None:
+            payload = self._payloads[damage_id] = self._decode(self._index[damage_id])
+        return payload
+
+    def _decode(self, index):
+        rows = self._rows
+        string = self._snapshot.string
+        i = index * 4
+        damage_id = rows[i]
+        payload = {
+            'id': damage_id,
+            'code': string(rows[i + 1]),
+            'name': string(rows[i + 2]),
+            'description': string(rows[i + 3])
+        }
+        for relation, (offsets, values) in self._related.items():
+            payload[relation] = [
+                {'id': values[j], 'damage_id': damage_id, 'description': string(values[j + 1])}
+                for j in range(offsets[index], offsets[index + 1], 2)
+            ]
+        return payload
+
+class _RuleFacts:
+    """Sequence view giving each rule's antecedent facts straight from the CSR arrays."""
+    def __init__(self, snapshot):
+        self._symptom_offsets = snapshot.array('rules.symptom_offsets')
+        self._symptoms = snapshot.array('rules.symptoms')
+        self._premise_offsets = snapshot.array('rules.premise_offsets')
+        self._premises = snapshot.array('rules.premises')
+
+    def __len__(self):
+        return len(self._symptom_offsets) - 1
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        symptoms = self._symptoms[self._symptom_offsets[position]:self._symptom_offsets[position + 1]]
+        premises = self._premises[self._premise_offsets[position]:self._premise_offsets[position + 1]]
+        return tuple(symptoms) + tuple(DamageFact(d) for d in premises)
+
+class _RuleScopes:
+    """Sequence view decoding each rule's scope key from the (kind, value) pairs."""
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._pairs = snapshot.array('rules.scopes')
+
+    def __len__(self):
+        return len(self._pairs) // 2
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        kind, value = self._pairs[2 * position], self._pairs[2 * position + 1]
+        if kind == _MOTORCYCLE:
+            return value
+        if kind == _BRAND:
+            return self._snapshot.string(value)
+        return None
+
+class _RuleMasks:
+    """Per-rule fact bitmasks, computed on access instead of at load time."""
+    def __init__(self, kb):
+        self._kb = kb
+
+    def __len__(self):
+        return len(self._kb.rule_facts)
+
+    def __getitem__(self, position):
+        mask = 0
+        for fact in self._kb.rule_facts[position]:
+            mask |= 1 << self._kb.fact_bits[fact]
+        return mask
+
+def load_knowledge_base(path, version=None):
+    """
+    Builds a KnowledgeBase from a snapshot without touching the database.
+    Rule arrays stay memory-mapped; only the per-fact bitsets and the
+    damage payloads are materialized. The knowledge base keeps the shared
+    version the snapshot was written at.
+
+    Returns None, without loading anything, when version is given and the
+    snapshot was written at another one.
+    """
+    snapshot = Snapshot(path)
+    manifest = snapshot.manifest
+    if version is not None and manifest.get('kb_version') != version:
+        return None
+
+    kb = KnowledgeBase.__new__(KnowledgeBase)
+    kb.version = manifest.get('kb_version', 0)
+    kb._network = None
+    kb._fingerprint = manifest.get('fingerprint')
+    kb._partitions = {}
+    kb._views = {}
+    kb.snapshot = snapshot
+    kb.damages = snapshot.damages()
+    kb.rule_ids = snapshot.array('rules.ids')
+    kb.rule_damages = snapshot.array('rules.damages')
+    kb.rule_facts = _RuleFacts(snapshot)
+    kb.rule_scopes = _RuleScopes(snapshot)
+    motorcycles = snapshot.array('motorcycles')
+    kb.motorcycles = {
+        motorcycles[i]: snapshot.string(motorcycles[i + 1]) for i in range(0, len(motorcycles), 2)
+    }
+    kb.unconditional = list(snapshot.array('rules.unconditional'))
+
+    premise_offsets = snapshot.array('rules.premise_offsets')
+    premises = snapshot.array('rules.premises')
+    kb.rule_premises = {
+        position: set(premises[premise_offsets[position]:premise_offsets[position + 1]])
+        for position in snapshot.array('rules.chained')
+    }
+
+    fact_rows = snapshot.array('facts')
+    facts = [
+        DamageFact(fact_rows[i + 1]) if fact_rows[i] else fact_rows[i + 1]
+        for i in range(0, len(fact_rows), 2)
+    ]
+    kb.fact_bits = {fact: bit for bit, fact in enumerate(facts)}
+    posting_offsets = snapshot.array('postings.offsets')
+    postings = snapshot.array('postings')
+    kb.postings = {
+        fact: postings[posting_offsets[bit]:posting_offsets[bit + 1]] for bit, fact in enumerate(facts)
+    }
+
+    kb.length_slices = snapshot.bitsets('length_slices', manifest['length_slice_count'])
+    kb.length_masks = dict(zip(
+        manifest['length_sizes'],
+        snapshot.bitsets('length_masks', len(manifest['length_sizes']))
+    ))
+    # JSON keeps motorcycle scopes as ints and brand scopes as strings
+    kb.scope_masks = dict(zip(manifest['scopes'], snapshot.bitsets('scope_masks', len(manifest['scopes']))))
+    kb.rule_masks = _RuleMasks(kb)
+    kb._index(dict(zip(facts, snapshot.bitsets('fact_rules', len(facts)))))
+    return kb
+
+def snapshot_version(path):
+    """Returns the knowledge-base version of the snapshot at path, or None when there is none."""
+    try:
+        return Snapshot(path).manifest.get('kb_version', 0)
+    except (FileNotFoundError, ValueError, struct.error):
+        return None
+
+@contextmanager
+def _export_lock(path):
+    """Holds an exclusive lock on a sidecar file so exports of one path run one at a time."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f'{path}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def export_snapshot(path, kb=None):
+    """
+    Writes a snapshot of kb, or of the current database state (inside an
+    app context). Concurrent exports of one path are serialized, and the
+    file is left alone when it already holds a newer knowledge-base
+    version, so a slow exporter cannot publish an older knowledge base
+    last.
+
+    Returns:
+        KnowledgeBase: The exported knowledge base
+    """
+    if kb is None:
+        kb = KnowledgeBase.load(db.session, read_kb_version(db.session))
+    symptoms = [s.to_dict() for s in Symptom.query.order_by(Symptom.id)]
+    with _export_lock(path):
+        published = snapshot_version(path)
+        if published is None or published <= kb.version:
+            write_snapshot(path, kb, symptoms)
+    return kb
+
+@kb_cli.command('snapshot')
+@click.argument('path', required=False)
+def snapshot_command(path):
+    """Export the knowledge base to a binary snapshot (default: KB_SNAPSHOT_PATH)."""
+    from flask import current_app
+    path = path or current_app.config.get('KB_SNAPSHOT_PATH')
+    if not path:
+        raise click.UsageError('Pass a PATH or set KB_SNAPSHOT_PATH')
+    kb = export_snapshot(path)
+    click.echo(f'Wrote {len(kb.rule_ids)} rules and {len(kb.damages)} damages to {path} '
+               f'({os.path.getsize(path)} bytes)')
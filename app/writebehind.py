@@ -0,0 +1,326 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from . import db
+from .models import Consultation, ConsultationSymptom
+from . import analytics
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of one process are serialized
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+def _transient(exc):
+    """True when a write failed because the database is unreachable rather than because of the records."""
+    if isinstance(exc, (OperationalError, InterfaceError, PoolTimeoutError)):
+        return True
+    return isinstance(exc, DBAPIError) and exc.connection_invalidated
+
+@contextmanager
+def _file_lock(path, blocking=True):
+    """
+    Holds an exclusive lock on a sidecar file, which serializes the
+    processes sharing a spill path. Yields False instead of waiting when
+    blocking is off and another process holds the lock.
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class ConsultationWriter:
+    """
+    Write-behind logger for consultations created by /api/diagnose.
+
+    Requests hand a fully formed record (with a pre-allocated id) to a
+    bounded in-process queue and return immediately. A background thread
+    drains the queue in grouped bulk transactions. When the queue stays
+    full for put_timeout seconds (the database is not keeping up) or the
+    database is unavailable, records are appended to a local spill file.
+    That file is replayed when the writer starts and periodically
+    afterwards. A batch rejected for any other reason is retried one
+    record at a time, and records that still fail are moved to a
+    quarantine file so they cannot hold up the rest.
+
+    Worker processes share the spill file. Appends and the rename that
+    hands it to a replay hold <spill_path>.lock, and one process at a time
+    replays (<spill_path>.replay.lock), so spills never wait on a replay.
+    """
+    def __init__(self, app, queue_size=10000, batch_size=500, flush_interval=0.5,
+                 put_timeout=0.05, spill_path=None, quarantine_path=None, ids=None,
+                 replay_interval=30):
+        """
+        Args:
+            ids (IdAllocator): Allocator shared with the process's other consultation inserts
+        """
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.replay_interval = replay_interval
+        self.spill_path = spill_path or os.path.join(app.instance_path, 'consultation-spill.ndjson')
+        self.quarantine_path = quarantine_path or self.spill_path + '.quarantine'
+        self.ids = ids if ids is not None else app.extensions['consultation_ids']
+        self.queued = 0
+        self.written = 0
+        self.spilled = 0
+        self.quarantined = 0
+        self.failed_batches = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='consultation-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def submit(self, user_id, motorcycle_id, damage_id, symptom_ids):
+        """Queues one consultation and returns its id."""
+        record = self._record(user_id, motorcycle_id, damage_id, symptom_ids)
+        try:
+            self._queue.put(record, timeout=self.put_timeout)
+            self.queued += 1
+        except queue.Full:
+            self._spill([record])
+        return record['id']
+
+    def submit_nowait(self, user_id, motorcycle_id, damage_id, symptom_ids):
+        """
+        Queues one consultation without blocking and returns its id, or
+        None when the queue is full (submit then waits and spills).
+        """
+        record = self._record(user_id, motorcycle_id, damage_id, symptom_ids)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            return None
+        self.queued += 1
+        return record['id']
+
+    def _record(self, user_id, motorcycle_id, damage_id, symptom_ids):
+        return {
+            'id': self.ids.next_id(),
+            'user_id': user_id,
+            'motorcycle_id': motorcycle_id,
+            'damage_id': damage_id,
+            'consultation_date': datetime.utcnow().isoformat(),
+            'symptom_ids': list(symptom_ids)
+        }
+
+    def shutdown(self, timeout=10):
+        """Stops accepting work and flushes everything still queued."""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'queued': self.queued,
+            'written': self.written,
+            'spilled': self.spilled,
+            'quarantined': self.quarantined,
+            'failed_batches': self.failed_batches
+        }
+
+    def _run(self):
+        last_replay = float('-inf')  # Replay whatever an earlier process spilled first
+
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                if time.monotonic() - last_replay > self.replay_interval:
+                    last_replay = time.monotonic()
+                    self._replay()
+
+                batch = self._take_batch()
+                if batch:
+                    pending = self._write(batch)
+                    if pending:
+                        self._spill(pending)
+            except Exception:
+                # A dead thread would leave every later request to spill; log and keep draining
+                logger.exception('Consultation writer iteration failed')
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, records, skip_existing=False):
+        """
+        Writes records in one transaction, falling back to one transaction
+        per record when the batch is rejected. Returns the records that
+        could not be written because the database is unavailable; records
+        the database rejects on their own are quarantined.
+        """
+        try:
+            self._insert(records, skip_existing)
+            return []
+        except Exception as exc:
+            self.failed_batches += 1
+            if _transient(exc):
+                logger.exception('Write-behind batch of %d consultations failed; spilling', len(records))
+                return records
+            logger.exception('Write-behind batch of %d consultations rejected; retrying one at a time', len(records))
+
+        pending = []
+        for record in records:
+            try:
+                self._insert([record], skip_existing)
+            except Exception as exc:
+                if _transient(exc):
+                    pending.append(record)
+                else:
+                    logger.error('Quarantining consultation %s: %s', record.get('id') if isinstance(record, dict) else None, exc)
+                    self._quarantine(record, exc)
+        return pending
+
+    def _insert(self, records, skip_existing):
+        with self.app.app_context():
+            try:
+                if skip_existing:
+                    ids = [r['id'] for r in records]
+                    existing = set(db.session.execute(
+                        select(Consultation.id).where(Consultation.id.in_(ids))
+                    ).scalars())
+                    records = [r for r in records if r['id'] not in existing]
+                    if not records:
+                        return
+
+                rollups = analytics.ConsultationRollups(self.app.extensions.get('rollup_buffer'))
+                consultations = []
+                symptoms = []
+                for r in records:
+                    date = datetime.fromisoformat(r['consultation_date'])
+                    consultations.append({
+                        'id': r['id'],
+                        'user_id': r['user_id'],
+                        'motorcycle_id': r['motorcycle_id'],
+                        'damage_id': r['damage_id'],
+                        'consultation_date': date
+                    })
+                    symptoms.extend({'consultation_id': r['id'], 'symptom_id': s} for s in r['symptom_ids'])
+                    rollups.add(r['id'], date, r['motorcycle_id'], r['damage_id'], r['symptom_ids'])
+
+                db.session.execute(insert(Consultation), consultations)
+                if symptoms:
+                    db.session.execute(insert(ConsultationSymptom), symptoms)
+                rollups.flush()
+                db.session.commit()
+                self.written += len(records)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _spill(self, records):
+        with self._spill_lock, _file_lock(self.spill_path + '.lock'):
+            with open(self.spill_path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.spilled += len(records)
+
+    def _quarantine(self, record, exc):
+        entry = {'record': record, 'error': str(exc), 'quarantined_at': datetime.utcnow().isoformat()}
+        with self._spill_lock, _file_lock(self.spill_path + '.lock'):
+            with open(self.quarantine_path, 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.quarantined += 1
+
+    def _replay(self):
+        """Re-inserts spilled records; ones already written are skipped by id."""
+        replay_path = self.spill_path + '.replay'
+        with _file_lock(replay_path + '.lock', blocking=False) as locked:
+            if not locked:
+                return  # Another process is replaying
+
+            with self._spill_lock, _file_lock(self.spill_path + '.lock'):
+                if not os.path.exists(replay_path):
+                    if not os.path.exists(self.spill_path) or not os.path.getsize(self.spill_path):
+                        return
+                    os.replace(self.spill_path, replay_path)
+
+            records = []
+            with open(replay_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError as exc:
+                        self._quarantine(line.rstrip('\n'), exc)
+
+            for start in range(0, len(records), self.batch_size):
+                end = start + self.batch_size
+                pending = self._write(records[start:end], skip_existing=True)
+                if pending:
+                    # Database still unavailable; keep only what is left for the next attempt
+                    self._rewrite(replay_path, pending + records[end:])
+                    return
+            os.remove(replay_path)
+
+    def _rewrite(self, path, records):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+def init_write_behind(app):
+    """Starts the consultation writer when CONSULTATION_WRITE_BEHIND is enabled."""
+    if not app.config.get('CONSULTATION_WRITE_BEHIND'):
+        return None
+
+    os.makedirs(app.instance_path, exist_ok=True)
+    writer = ConsultationWriter(
+        app,
+        queue_size=app.config['WRITE_BEHIND_QUEUE_SIZE'],
+        batch_size=app.config['WRITE_BEHIND_BATCH_SIZE'],
+        flush_interval=app.config['WRITE_BEHIND_FLUSH_INTERVAL'],
+        spill_path=app.config.get('WRITE_BEHIND_SPILL_PATH')
+    )
+    writer.start()
+    app.extensions['consultation_writer'] = writer
+    return writer
@@ -0,0 +1,15 @@
+"""
+ASGI entry point:
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+Same preloading as wsgi.py. The read paths and /api/diagnose run as
+coroutines on an async database driver (aiomysql for MySQL); the remaining
+routes are served by the Flask app on ASGI_THREADS threads per worker.
+"""
+from app import preload
+from app.asgi import create_asgi_app
+from app.config import ProductionConfig
+
+app = create_asgi_app(ProductionConfig)
+preload(app.flask_app)
@@ -0,0 +1,135 @@
+"""
+Benchmarks the HTTP API on SQLite with synthetic knowledge bases.
+
+For each size the app is created on a fresh SQLite file and the
+endpoints are driven through the Flask test client, recording latency
+and SQL statements per request. With --concurrency N the same app is
+also served by a threaded WSGI server and /api/diagnose is hit by N
+client threads over real HTTP.
+
+    python -m benchmarks.bench_api --sizes 10,1000 --requests 300 \\
+        --concurrency 8 --output benchmarks/results/api.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from werkzeug.serving import make_server
+from app import create_app, db
+from app.config import Config
+from app.routes import expert_system
+from .database import populate
+from .synthetic import generate_queries
+from . import report as reporting
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+def drive(client, counter, requests, call):
+    timings = []
+    queries = []
+    start = time.perf_counter()
+    for i in range(requests):
+        before = counter.count
+        t = time.perf_counter()
+        response = call(client, i)
+        timings.append(time.perf_counter() - t)
+        queries.append(counter.count - before)
+        assert response.status_code < 400, response.get_data(as_text=True)
+    return reporting.summarize(timings, time.perf_counter() - start, queries)
+
+def load_test(app, requests, concurrency, queries):
+    """Serves app with a threaded server and posts /api/diagnose from concurrency threads."""
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}/api/diagnose'
+
+    def one(i):
+        body = json.dumps({'motorcycle_id': 1, 'symptom_ids': queries[i % len(queries)]}).encode()
+        req = urllib.request.Request(url, body, {'Content-Type': 'application/json'})
+        t = time.perf_counter()
+        with urllib.request.urlopen(req) as response:
+            response.read()
+        return time.perf_counter() - t
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        timings = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    return reporting.summarize(timings, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,1000,100000', help='comma-separated rule counts')
+    parser.add_argument('--symptoms', type=int, default=2000)
+    parser.add_argument('--min-symptoms', type=int, default=1)
+    parser.add_argument('--max-symptoms', type=int, default=5)
+    parser.add_argument('--consultations', type=int, default=2000, help='history rows per size')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=0, help='HTTP load-test client threads (0 to skip)')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    report = reporting.new_report('api', **vars(args))
+    workdir = tempfile.mkdtemp(prefix='mes-bench-')
+
+    for size in [int(s) for s in args.sizes.split(',')]:
+        symptom_count = min(args.symptoms, max(size, args.max_symptoms))
+
+        class BenchConfig(Config):
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(workdir, f'bench-{size}.db')}"
+            CONSULTATION_WRITE_BEHIND = False
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            rules = populate(size, symptom_count, args.min_symptoms, args.max_symptoms, args.consultations)
+            counter = QueryCounter(db.engine)
+        expert_system.invalidate()
+
+        client = app.test_client()
+        token = client.post('/api/login', json={'username': 'admin', 'password': 'admin123'}).get_json()['token']
+        auth = {'Authorization': f'Bearer {token}'}
+        queries = generate_queries(rules, symptom_count, args.requests)
+        rng = random.Random(size)
+
+        # Warm the compiled knowledge base and the token cache
+        client.post('/api/diagnose', json={'motorcycle_id': 1, 'symptom_ids': queries[0]})
+        client.get('/api/consultations', query_string={'limit': 1}, headers=auth)
+
+        results = report['results']
+        results[f'POST /api/diagnose/{size}'] = drive(client, counter, args.requests, lambda c, i: c.post(
+            '/api/diagnose', json={'motorcycle_id': rng.randint(1, 4), 'symptom_ids': queries[i]}))
+        results[f'POST /api/diagnose top_k=5/{size}'] = drive(client, counter, args.requests, lambda c, i: c.post(
+            '/api/diagnose', json={'motorcycle_id': 1, 'symptom_ids': queries[i], 'top_k': 5}))
+        results[f'GET /api/rules/{size}'] = drive(client, counter, min(args.requests, 20), lambda c, i: c.get('/api/rules'))
+        results[f'GET /api/consultations limit=50/{size}'] = drive(client, counter, args.requests, lambda c, i: c.get(
+            '/api/consultations', query_string={'limit': 50}, headers=auth))
+        if args.concurrency:
+            results[f'HTTP x{args.concurrency} /api/diagnose/{size}'] = load_test(
+                app, args.requests, args.concurrency, queries)
+
+    reporting.print_results(report)
+    if args.output:
+        reporting.save(report, args.output)
+    if args.baseline and reporting.compare(report, args.baseline):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
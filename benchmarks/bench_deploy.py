@@ -0,0 +1,256 @@
+"""
+Compares worker startup, cold-start behaviour and concurrent-request
+capacity of three gunicorn deployments, on a SQLite file standing in for
+MySQL:
+
+    dev         gunicorn main:app (no preload, default pool, create_all
+                and a knowledge-base compile in every worker)
+    production  gunicorn -c gunicorn.conf.py wsgi:app (preloaded app,
+                ProductionConfig pool, engine reset after fork)
+    asgi        gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker
+                asgi:app (same, with the async read and diagnose paths)
+
+Each deployment is booted. It is then hit with a burst of concurrent
+/api/diagnose requests while its workers are cold. With --slow-clients,
+that many clients are also trickling their request bodies for
+--slow-seconds, the way slow mobile connections do. A threaded worker
+spends a thread on each of them; an async worker does not. Reported per
+deployment:
+- boot time until the first response;
+- burst latency;
+- database connections held open by the workers (file descriptors on
+  the SQLite file);
+- worker PSS;
+- how long a knowledge-base write made through one worker takes to reach
+  every worker (a new symptom and a rule on it, probed with concurrent
+  diagnoses until all of them see the rule).
+
+Linux only (/proc).
+
+    python -m benchmarks.bench_deploy --rules 20000 --workers 4 --slow-clients 64 --output benchmarks/results/deploy.json
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from app import create_app, db
+from app.config import Config
+from .database import populate
+from .synthetic import generate_queries
+from . import report as reporting
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+def _db_connections(pid, db_path):
+    count = 0
+    for fd in os.listdir(f'/proc/{pid}/fd'):
+        try:
+            if os.readlink(f'/proc/{pid}/fd/{fd}') == db_path:
+                count += 1
+        except OSError:
+            pass
+    return count
+
+def _pss_kb(pid):
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1])
+    return 0
+
+def _slow_client(port, body, seconds, stop):
+    """Sends a /api/diagnose request whose body trickles in over seconds, then reads the response."""
+    with socket.create_connection(('127.0.0.1', port), timeout=seconds + 60) as sock:
+        sock.sendall((
+            'POST /api/diagnose HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+        ).encode())
+        delay = seconds / len(body)
+        for i in range(len(body)):
+            if stop.wait(delay):
+                return
+            sock.sendall(body[i:i + 1])
+        while sock.recv(65536):
+            pass
+
+def _post_json(url, body, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    request = urllib.request.Request(url, json.dumps(body).encode(), headers)
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())
+
+def _write_visible_ms(base, name, damage_id, probes, timeout=30.0):
+    """
+    Adds a symptom and a rule concluding damage_id on it through whichever
+    worker takes the requests, then diagnoses that symptom with probes
+    concurrent requests until every one of them returns the rule's
+    damage. Returns the milliseconds from the rule's creation until then.
+    """
+    token = _post_json(base + '/api/login', {'username': 'admin', 'password': 'admin123'})['token']
+    symptom = _post_json(base + '/api/symptoms', {'code': f'W{name}'[:10], 'name': f'Bench write {name}'}, token)
+    _post_json(base + '/api/rules', {'damage_id': damage_id, 'symptom_ids': [symptom['id']]}, token)
+    written = time.perf_counter()
+
+    def probe(_):
+        result = _post_json(base + '/api/diagnose', {'motorcycle_id': 1, 'symptom_ids': [symptom['id']]})
+        return (result['diagnosis'] or {}).get('id')
+
+    with ThreadPoolExecutor(probes) as pool:
+        while True:
+            if all(seen == damage_id for seen in pool.map(probe, range(probes))):
+                return (time.perf_counter() - written) * 1000
+            if time.perf_counter() - written > timeout:
+                raise RuntimeError(f'{name}: a rule written through one worker was not seen by all of them')
+            time.sleep(0.05)
+
+def run_deployment(name, command, env, port, db_path, queries, requests, concurrency, workers, damage_id,
+                   slow_clients=0, slow_seconds=5.0):
+    log = open(os.path.join(os.path.dirname(db_path), f'{name}.log'), 'w')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        while True:
+            try:
+                urllib.request.urlopen(base + '/', timeout=1).read()
+                break
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError(f'{name}: gunicorn exited with {process.returncode}')
+                time.sleep(0.02)
+        boot = time.perf_counter() - start
+        while len(_children(process.pid)) < workers:
+            time.sleep(0.02)
+
+        def one(i):
+            body = json.dumps({'motorcycle_id': 1, 'symptom_ids': queries[i % len(queries)]}).encode()
+            req = urllib.request.Request(base + '/api/diagnose', body, {'Content-Type': 'application/json'})
+            t = time.perf_counter()
+            with urllib.request.urlopen(req, timeout=120) as response:
+                response.read()
+            return time.perf_counter() - t
+
+        stop = threading.Event()
+        slow = [
+            threading.Thread(target=_slow_client, args=(
+                port, json.dumps({'motorcycle_id': 1, 'symptom_ids': queries[i % len(queries)]}).encode(),
+                slow_seconds, stop
+            ), daemon=True)
+            for i in range(slow_clients)
+        ]
+        for thread in slow:
+            thread.start()
+        if slow:
+            # Let every slow client connect and start its upload first
+            time.sleep(min(1.0, slow_seconds / 4))
+
+        burst_start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            timings = list(pool.map(one, range(requests)))
+        summary = reporting.summarize(timings, time.perf_counter() - burst_start)
+        stop.set()
+        for thread in slow:
+            thread.join()
+
+        write_visible = _write_visible_ms(base, name, damage_id, workers * 4)
+
+        worker_pids = _children(process.pid)
+        summary.update({
+            'write_visible_ms': write_visible,
+            'boot_ms': boot * 1000,
+            'max_ms': max(timings) * 1000,
+            'db_connections': sum(_db_connections(pid, db_path) for pid in worker_pids),
+            'worker_pss_mb': sum(_pss_kb(pid) for pid in worker_pids) / 1024
+        })
+        return summary
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(30)
+        log.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=20000)
+    parser.add_argument('--symptoms', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=400, help='requests in the cold burst')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--pool-size', type=int, default=2, help='DB_POOL_SIZE for the production and asgi runs')
+    parser.add_argument('--slow-clients', type=int, default=0, help='clients uploading slowly during the burst')
+    parser.add_argument('--slow-seconds', type=float, default=5.0, help='upload duration of each slow client')
+    parser.add_argument('--deployments', default='dev,production,asgi')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    report = reporting.new_report('deploy', **vars(args))
+    workdir = tempfile.mkdtemp(prefix='mes-deploy-')
+    db_path = os.path.join(workdir, 'deploy.db')
+    database_url = f'sqlite:///{db_path}'
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        rules = populate(args.rules, args.symptoms, consultations=0)
+        db.engine.dispose()
+    queries = generate_queries(rules, args.symptoms, args.requests)
+
+    env = dict(os.environ, DATABASE_URL=database_url, CONSULTATION_WRITE_BEHIND='0')
+    production_env = {
+        'GUNICORN_WORKERS': str(args.workers),
+        'GUNICORN_THREADS': str(args.threads),
+        'DB_POOL_SIZE': str(args.pool_size),
+        'DB_MAX_OVERFLOW': '0',
+        'KB_SNAPSHOT_PATH': os.path.join(workdir, 'kb.snapshot')
+    }
+    deployments = {
+        'dev': (['-w', str(args.workers), '--threads', str(args.threads), 'main:app'], {}),
+        'production': (['-c', 'gunicorn.conf.py', 'wsgi:app'], production_env),
+        # Same thread count for the routes that stay synchronous
+        'asgi': (['-c', 'gunicorn.conf.py', '-k', 'uvicorn.workers.UvicornWorker', 'asgi:app'],
+                 dict(production_env, ASGI_THREADS=str(args.threads)))
+    }
+    for name in args.deployments.split(','):
+        gunicorn_args, extra_env = deployments[name]
+        port = _free_port()
+        command = [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}'] + gunicorn_args
+        summary = run_deployment(
+            name, command, dict(env, GUNICORN_BIND=f'127.0.0.1:{port}', **extra_env), port, db_path,
+            queries, args.requests, args.concurrency, args.workers, rules[0][1], args.slow_clients, args.slow_seconds
+        )
+        report['results'][f'{name}/{args.rules}'] = summary
+        print(f"{name:<12} boot {summary['boot_ms']:8.0f}ms  burst p95 {summary['p95_ms']:8.0f}ms  "
+              f"max {summary['max_ms']:8.0f}ms  "
+              f"db connections {summary['db_connections']:3d}  worker PSS {summary['worker_pss_mb']:7.1f}MB  "
+              f"write visible {summary['write_visible_ms']:6.0f}ms")
+
+    reporting.print_results(report)
+    if args.output:
+        reporting.save(report, args.output)
+    if args.baseline and reporting.compare(report, args.baseline):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Micro-benchmarks ForwardChainingEngine matching in isolation (no database).
+
+    python -m benchmarks.bench_engine --sizes 10,1000,100000 \\
+        --output benchmarks/results/engine.json [--baseline old.json]
+
+With --models N, most rules are scoped to one of N motorcycle models and
+diagnose_scoped times diagnoses that only evaluate the generic partition
+plus one model's.
+"""
+import argparse
+import random
+import sys
+import time
+from app.expert_system import KnowledgeBase
+from .synthetic import generate_rules, generate_queries
+from . import report as reporting
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,1000,100000', help='comma-separated rule counts')
+    parser.add_argument('--symptoms', type=int, default=2000)
+    parser.add_argument('--min-symptoms', type=int, default=1, help='minimum symptoms per rule')
+    parser.add_argument('--max-symptoms', type=int, default=5, help='maximum symptoms per rule')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--models', type=int, default=0, help='motorcycle models to scope rules to')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    report = reporting.new_report('engine', **vars(args))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        symptom_count = min(args.symptoms, max(size, args.max_symptoms))
+        rules, damages = generate_rules(size, symptom_count, args.min_symptoms, args.max_symptoms, models=args.models)
+        queries = generate_queries(rules, symptom_count, args.queries)
+
+        start = time.perf_counter()
+        kb = KnowledgeBase(1, rules, damages)
+        report['results'][f'compile/{size}'] = reporting.summarize([time.perf_counter() - start])
+
+        # Incremental deltas (KnowledgeBase.patched) against the compile above
+        rule_id, damage_id, facts, scope = rules[len(rules) // 2]
+        deltas = (
+            ('patch_update', {'rules': [(rule_id, damage_id, facts[:1], scope)]}),
+            ('patch_delete', {'removed': [rule_id]}),
+            ('patch_append', {'rules': [(rules[-1][0] + 1, damage_id, facts, scope)]}),
+        )
+        for name, delta in deltas:
+            timings = []
+            for _ in range(5):
+                t = time.perf_counter()
+                kb.patched(2, **delta)
+                timings.append(time.perf_counter() - t)
+            report['results'][f'{name}/{size}'] = reporting.summarize(timings)
+
+        fns = [('diagnose', kb.diagnose), ('rank_top5', lambda q: kb.rank(q, 5))]
+        if args.models:
+            start = time.perf_counter()
+            for motorcycle_id in range(1, args.models + 1):
+                kb.scoped(motorcycle_id)
+            report['results'][f'partition/{size}'] = reporting.summarize([time.perf_counter() - start])
+            rng = random.Random(3)
+            fns.append(('diagnose_scoped', lambda q: kb.scoped(rng.randint(1, args.models)).diagnose(q)))
+        for name, fn in fns:
+            timings = []
+            start = time.perf_counter()
+            for symptom_ids in queries:
+                t = time.perf_counter()
+                fn(symptom_ids)
+                timings.append(time.perf_counter() - t)
+            report['results'][f'{name}/{size}'] = reporting.summarize(timings, time.perf_counter() - start)
+
+    reporting.print_results(report)
+    if args.output:
+        reporting.save(report, args.output)
+    if args.baseline and reporting.compare(report, args.baseline):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Compares rule matching strategies on a synthetic knowledge base.
+
+    python -m benchmarks.bench_matching --rules 50000 --symptoms 2000
+
+"legacy" is the original per-rule linear scan (without its database
+round-trips), "postings" checks per-rule masks for rules reached through
+the inverted index, and "bitset" is KnowledgeBase.first_match.
+"""
+import argparse
+import statistics
+import time
+from app.expert_system import KnowledgeBase
+from .synthetic import generate_rules, generate_queries
+
+def legacy_first_match(rules, symptom_ids):
+    for rule_id, damage_id, rule_symptom_ids, _ in rules:
+        if all(symptom_id in symptom_ids for symptom_id in rule_symptom_ids):
+            return rule_id
+    return None
+
+def postings_first_match(kb, symptom_ids):
+    observed = 0
+    for symptom_id in symptom_ids:
+        bit = kb.fact_bits.get(symptom_id)
+        if bit is not None:
+            observed |= 1 << bit
+
+    candidates = set(kb.unconditional)
+    for symptom_id in symptom_ids:
+        candidates.update(kb.postings.get(symptom_id, ()))
+
+    matches = [p for p in candidates if kb.rule_masks[p] & observed == kb.rule_masks[p]]
+    return kb.rule_ids[min(matches)] if matches else None
+
+def bitset_first_match(kb, symptom_ids):
+    position = kb.first_match(symptom_ids)
+    return kb.rule_ids[position] if position is not None else None
+
+def measure(fn, queries):
+    timings = []
+    results = []
+    for symptom_ids in queries:
+        start = time.perf_counter()
+        results.append(fn(symptom_ids))
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return results, {
+        'mean_us': statistics.fmean(timings),
+        'p50_us': timings[len(timings) // 2],
+        'p99_us': timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rules', type=int, default=50000)
+    parser.add_argument('--symptoms', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--legacy-queries', type=int, default=50, help='legacy scan is slow; use fewer queries')
+    args = parser.parse_args()
+
+    rules, damages = generate_rules(args.rules, args.symptoms)
+    queries = generate_queries(rules, args.symptoms, args.queries)
+
+    start = time.perf_counter()
+    kb = KnowledgeBase(1, rules, damages)
+    print(f'compiled {args.rules} rules over {args.symptoms} symptoms in {time.perf_counter() - start:.3f}s')
+
+    bitset_results, bitset_stats = measure(lambda q: bitset_first_match(kb, q), queries)
+    postings_results, postings_stats = measure(lambda q: postings_first_match(kb, q), queries)
+    legacy_results, legacy_stats = measure(lambda q: legacy_first_match(rules, q), queries[:args.legacy_queries])
+
+    assert bitset_results == postings_results
+    assert bitset_results[:args.legacy_queries] == legacy_results
+
+    for name, stats in (('legacy', legacy_stats), ('postings', postings_stats), ('bitset', bitset_stats)):
+        print(f"{name:>9}: mean {stats['mean_us']:10.1f}us  p50 {stats['p50_us']:10.1f}us  p99 {stats['p99_us']:10.1f}us")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmarks the symptom search index (GET /api/symptoms/search) in isolation.
+
+    python -m benchmarks.bench_search --sizes 500,5000 \\
+        --output benchmarks/results/search.json [--baseline old.json]
+
+"search" runs the queries in order, so words seen before reuse their
+cached matches as they would in a running worker. "search_cold" clears
+that cache before every query: each word is then looked up, including
+typo candidates, from scratch. Exits with status 1 when the p50 of
+"search" exceeds --target-ms at any size.
+"""
+import argparse
+import sys
+import time
+from app.search import SymptomIndex
+from .synthetic import generate_symptoms, generate_search_queries
+from . import report as reporting
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='500,5000', help='comma-separated symptom counts')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=20, help='page size')
+    parser.add_argument('--target-ms', type=float, default=1.0, help='p50 latency target for search')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    report = reporting.new_report('search', **vars(args))
+    missed = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        symptoms = generate_symptoms(size)
+        queries = generate_search_queries(symptoms, args.queries)
+
+        index = SymptomIndex()
+        start = time.perf_counter()
+        index.rebuild(symptoms, 1)
+        report['results'][f'build/{size}'] = reporting.summarize([time.perf_counter() - start])
+
+        for name, clear in (('search', False), ('search_cold', True)):
+            index._matched.clear()
+            timings = []
+            start = time.perf_counter()
+            for query in queries:
+                if clear:
+                    index._matched.clear()
+                t = time.perf_counter()
+                index.search(query, args.limit)
+                timings.append(time.perf_counter() - t)
+            report['results'][f'{name}/{size}'] = reporting.summarize(timings, time.perf_counter() - start)
+
+        timings = []
+        for version in range(1, 51):
+            symptom = dict(symptoms[version * 7 % size], name=symptoms[version % size]['name'])
+            t = time.perf_counter()
+            index.advance(version, version + 1, [symptom], [symptoms[version * 13 % size]['id']])
+            timings.append(time.perf_counter() - t)
+        report['results'][f'update/{size}'] = reporting.summarize(timings)
+
+        if report['results'][f'search/{size}']['p50_ms'] > args.target_ms:
+            missed.append(size)
+
+    reporting.print_results(report)
+    print(f"p50 target of {args.target_ms}ms {'missed at ' + ', '.join(map(str, missed)) + ' symptoms' if missed else 'met'}")
+    if args.output:
+        reporting.save(report, args.output)
+    if missed or (args.baseline and reporting.compare(report, args.baseline)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
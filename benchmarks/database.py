@@ -0,0 +1,61 @@
+"""Loads synthetic knowledge bases into a database for API benchmarks."""
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from app import db
+from app.expert_system import bump_kb_version
+from app.models import (
+    Motorcycle, Symptom, Damage, Cause, Solution, Rule, RuleSymptom, User,
+    Consultation, ConsultationSymptom
+)
+from .synthetic import generate_rules
+
+CHUNK = 10000
+
+def _bulk(model, rows):
+    for start in range(0, len(rows), CHUNK):
+        db.session.execute(insert(model), rows[start:start + CHUNK])
+
+def populate(rule_count, symptom_count, min_symptoms=1, max_symptoms=5, consultations=1000, seed=42):
+    """
+    Fills an empty schema with motorcycles, a synthetic knowledge base,
+    an admin user (admin/admin123) and random consultation history.
+    Must run inside an application context. Returns the generated rules.
+    """
+    rules, damages = generate_rules(rule_count, symptom_count, min_symptoms, max_symptoms, seed=seed)
+    rng = random.Random(seed)
+
+    _bulk(Motorcycle, [{'id': i, 'brand': 'Brand', 'model': f'Model {i}'} for i in range(1, 5)])
+    _bulk(Symptom, [{'id': i, 'code': f'G{i}', 'name': f'Gejala {i}'} for i in range(1, symptom_count + 1)])
+    _bulk(Damage, [{'id': d, 'code': p['code'], 'name': p['name']} for d, p in damages.items()])
+    _bulk(Cause, [{'damage_id': d, 'description': f'Penyebab {d}'} for d in damages])
+    _bulk(Solution, [{'damage_id': d, 'description': f'Solusi {d}'} for d in damages])
+    _bulk(Rule, [
+        {'id': rule_id, 'damage_id': damage_id, 'motorcycle_id': scope} for rule_id, damage_id, _, scope in rules
+    ])
+    _bulk(RuleSymptom, [
+        {'rule_id': rule_id, 'symptom_id': symptom_id}
+        for rule_id, _, symptom_ids, _ in rules for symptom_id in symptom_ids
+    ])
+    db.session.add(User(username='admin', password=generate_password_hash('admin123'), role='admin'))
+
+    now = datetime.utcnow()
+    history = []
+    history_symptoms = []
+    for consultation_id in range(1, consultations + 1):
+        history.append({
+            'id': consultation_id,
+            'user_id': 1,
+            'motorcycle_id': rng.randint(1, 4),
+            'damage_id': rng.choice(list(damages)),
+            'consultation_date': now - timedelta(minutes=consultation_id)
+        })
+        for symptom_id in rng.sample(range(1, symptom_count + 1), min(3, symptom_count)):
+            history_symptoms.append({'consultation_id': consultation_id, 'symptom_id': symptom_id})
+    _bulk(Consultation, history)
+    _bulk(ConsultationSymptom, history_symptoms)
+
+    bump_kb_version(db.session)
+    db.session.commit()
+    return rules
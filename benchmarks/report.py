@@ -0,0 +1,77 @@
+"""Latency summaries and JSON baselines shared by the benchmark scripts."""
+import json
+import os
+import platform
+import statistics
+import time
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def summarize(timings, elapsed=None, queries=None):
+    """
+    Args:
+        timings (list): Per-operation latencies in seconds
+        elapsed (float): Wall time for the whole run, for throughput
+        queries (list): Optional per-operation SQL statement counts
+    """
+    timings = sorted(timings)
+    elapsed = elapsed if elapsed is not None else sum(timings)
+    summary = {
+        'count': len(timings),
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'throughput_per_s': len(timings) / elapsed if elapsed else None
+    }
+    if queries is not None:
+        summary['queries_per_op'] = statistics.fmean(queries) if queries else 0
+    return summary
+
+def new_report(name, **params):
+    return {
+        'benchmark': name,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'params': params,
+        'results': {}
+    }
+
+def print_results(report):
+    for name, stats in report['results'].items():
+        line = (f"{name:<40} p50 {stats['p50_ms']:9.3f}ms  p95 {stats['p95_ms']:9.3f}ms  "
+                f"p99 {stats['p99_ms']:9.3f}ms  {stats['throughput_per_s'] or 0:10.1f}/s")
+        if 'queries_per_op' in stats:
+            line += f"  {stats['queries_per_op']:6.1f} q/op"
+        print(line)
+
+def save(report, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f'results written to {path}')
+
+def compare(report, baseline_path, threshold=0.10):
+    """
+    Prints p50/p95 changes against a saved baseline and returns the names of
+    results whose p95 regressed by more than threshold.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    for name, stats in report['results'].items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        p50 = stats['p50_ms'] / base['p50_ms'] - 1 if base['p50_ms'] else 0
+        p95 = stats['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0
+        flag = '  REGRESSION' if p95 > threshold else ''
+        print(f'{name:<40} p50 {p50:+7.1%}  p95 {p95:+7.1%}{flag}')
+        if p95 > threshold:
+            regressions.append(name)
+    return regressions
@@ -0,0 +1,95 @@
+"""Synthetic knowledge bases for benchmarking the expert system."""
+import random
+
+def generate_rules(rule_count, symptom_count, min_symptoms=1, max_symptoms=5, damage_count=None, seed=42,
+                   models=0, generic_share=0.25):
+    """
+    Returns (rules, damages) in the shape KnowledgeBase expects: a list of
+    (rule_id, damage_id, symptom_ids, scope) tuples and a damage id ->
+    payload dict. Symptom popularity is skewed so a few symptoms appear in
+    many rules, like real workshop data. With models, all but
+    generic_share of the rules are scoped to a motorcycle id in 1..models.
+    """
+    rng = random.Random(seed)
+    damage_count = damage_count or max(1, rule_count // 4)
+    symptom_ids = list(range(1, symptom_count + 1))
+    weights = [1.0 / (rank ** 0.8) for rank in range(1, symptom_count + 1)]
+
+    rules = []
+    for rule_id in range(1, rule_count + 1):
+        size = rng.randint(min_symptoms, max_symptoms)
+        antecedent = set()
+        while len(antecedent) < size:
+            antecedent.update(rng.choices(symptom_ids, weights, k=size - len(antecedent)))
+        scope = rng.randint(1, models) if models and rng.random() >= generic_share else None
+        rules.append((rule_id, rng.randint(1, damage_count), sorted(antecedent), scope))
+
+    damages = {
+        damage_id: {
+            'id': damage_id,
+            'code': f'K{damage_id}',
+            'name': f'Kerusakan {damage_id}',
+            'description': '',
+            'causes': [],
+            'solutions': []
+        }
+        for damage_id in range(1, damage_count + 1)
+    }
+    return rules, damages
+
+def generate_queries(rules, symptom_count, count, noise=3, seed=7):
+    """
+    Returns observed symptom lists. Half of them contain a real rule's
+    antecedent plus noise so the hit path is exercised as well as misses.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        observed = set(rng.sample(range(1, symptom_count + 1), noise))
+        if i % 2 == 0:
+            observed.update(rng.choice(rules)[2])
+        queries.append(sorted(observed))
+    return queries
+
+SYLLABLES = ('ba', 'bu', 'ka', 'ku', 'ta', 'te', 'ri', 'ra', 'ma', 'mo', 'ng', 'la', 'lu', 'sa', 'si',
+             'pe', 'pa', 'de', 'da', 'go', 'ge', 'ja', 'ha', 'wa', 'ya', 'nya', 'ngo', 'tor', 'rem', 'kan')
+
+def generate_symptoms(count, vocabulary=6000, seed=5):
+    """
+    Returns symptom dicts (id, code, name, description) written with words
+    built from Indonesian-like syllables. Word frequencies follow Zipf's
+    law, so a few words appear in a large share of the symptoms and many
+    words look alike, the hard case for ranking and typo matching.
+    """
+    rng = random.Random(seed)
+    words = sorted({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(vocabulary)})
+    weights = [1.0 / rank for rank in range(1, len(words) + 1)]
+
+    def phrase(low, high):
+        return ' '.join(rng.choices(words, weights, k=rng.randint(low, high)))
+
+    return [
+        {'id': symptom_id, 'code': f'G{symptom_id}', 'name': phrase(3, 6), 'description': phrase(8, 15)}
+        for symptom_id in range(1, count + 1)
+    ]
+
+def generate_search_queries(symptoms, count, seed=7):
+    """
+    Returns search strings of one to three words taken from symptom names.
+    About 30% end in a typeahead prefix and 20% in a word with two
+    neighbouring letters swapped.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        name = rng.choice(symptoms)['name'].split()
+        words = rng.sample(name, min(len(name), rng.randint(1, 3)))
+        word = words[-1]
+        kind = rng.random()
+        if kind < 0.3 and len(word) > 3:
+            words[-1] = word[:rng.randint(2, len(word) - 1)]
+        elif kind < 0.5 and len(word) > 4:
+            i = rng.randrange(len(word) - 1)
+            words[-1] = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+        queries.append(' '.join(words))
+    return queries
@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers periodically; the jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+preload_app = True
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+
+def post_fork(server, worker):
+    from app import after_fork
+    app = worker.app.wsgi()
+    # asgi:app wraps the Flask app
+    after_fork(getattr(app, 'flask_app', app))
@@ -1,6 +1,8 @@
+import os
 from app import create_app
 
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Development server only; production runs wsgi.py under gunicorn
+    app.run(debug=os.environ.get('FLASK_DEBUG', '1').lower() in ('1', 'true', 'yes'))
\ No newline at end of file
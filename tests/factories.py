@@ -0,0 +1,217 @@
+"""
+Random knowledge bases for the engine tests, together with reference
+implementations written directly from the rule definitions.
+"""
+from app.expert_system import DamageFact, KnowledgeBase
+
+BRANDS = ('honda', 'yamaha', 'suzuki')
+# Symptom and motorcycle counts of the knowledge bases random_delta edits
+SYMPTOMS = 20
+MODELS = 4
+
+def damage_payload(damage_id, name=None):
+    return {
+        'id': damage_id,
+        'code': f'K{damage_id}',
+        'name': name or f'Kerusakan {damage_id}',
+        'description': f'Deskripsi {damage_id}' if damage_id % 2 else None,
+        'causes': [{'id': damage_id * 10, 'damage_id': damage_id, 'description': f'Penyebab {damage_id}'}],
+        'solutions': [
+            {'id': damage_id * 10 + i, 'damage_id': damage_id, 'description': f'Solusi {damage_id}.{i}'}
+            for i in range(damage_id % 3)
+        ]
+    }
+
+def random_rule(rng, damage_count, symptom_count, models=0, chain_share=0.0):
+    """
+    Returns (damage_id, facts, scope). A few rules conclude a damage that
+    does not exist (those are not indexed) or have no premises at all.
+    """
+    damage_id = rng.randint(1, damage_count + 1)
+    facts = rng.sample(range(1, symptom_count + 1), rng.choice((0, 1, 1, 2, 2, 3, 4)))
+    if rng.random() < chain_share:
+        facts.extend(DamageFact(rng.randint(1, damage_count)) for _ in range(rng.randint(1, 2)))
+    roll = rng.random()
+    if models and roll < 0.4:
+        scope = rng.randint(1, models)
+    elif models and roll < 0.6:
+        scope = rng.choice(BRANDS)
+    else:
+        scope = None
+    return damage_id, facts, scope
+
+def random_knowledge_base(rng, rule_count=60, symptom_count=20, damage_count=12, models=0, chain_share=0.0):
+    """
+    Returns (rules, damages, motorcycles) as stored in the database: rule
+    id -> (damage_id, facts, scope), damage id -> payload and motorcycle
+    id -> brand key. Rule ids are sparse so later inserts land between them.
+    """
+    rule_ids = rng.sample(range(1, rule_count * 3), rule_count)
+    rules = {
+        rule_id: random_rule(rng, damage_count, symptom_count, models, chain_share)
+        for rule_id in rule_ids
+    }
+    damages = {damage_id: damage_payload(damage_id) for damage_id in range(1, damage_count + 1)}
+    motorcycles = {motorcycle_id: rng.choice(BRANDS) for motorcycle_id in range(1, models + 1)}
+    return rules, damages, motorcycles
+
+def compile_rules(version, rules, damages, motorcycles=None):
+    """Builds a KnowledgeBase from the database-shaped dicts, as load() does."""
+    return KnowledgeBase(version, rule_rows(rules), damages, motorcycles)
+
+def rule_rows(rules, rule_ids=None):
+    """(rule_id, damage_id, facts, scope) tuples in rule id order, as load_rules returns them."""
+    return [
+        (rule_id, *rules[rule_id]) for rule_id in sorted(rules if rule_ids is None else rule_ids)
+    ]
+
+def random_symptoms(rng, symptom_count, size=None):
+    return rng.sample(range(1, symptom_count + 1), size if size is not None else rng.randint(0, 6))
+
+def reference_fired(kb, symptom_ids):
+    """Rule positions that fire, by repeated subset tests up to a fixpoint."""
+    facts = set(symptom_ids)
+    while True:
+        fired = [p for p, antecedent in enumerate(kb.rule_facts) if set(antecedent) <= facts]
+        concluded = {DamageFact(kb.rule_damages[p]) for p in fired} - facts
+        if not concluded:
+            return fired, facts
+        facts |= concluded
+
+def reference_conclusion(kb, symptom_ids):
+    """The diagnosed damage id: the first fired rule whose damage no fired rule consumed."""
+    fired, _ = reference_fired(kb, symptom_ids)
+    if not fired:
+        return None
+    consumed = {
+        fact.damage_id for p in fired for fact in kb.rule_facts[p] if isinstance(fact, DamageFact)
+    }
+    for position in fired:
+        if kb.rule_damages[position] not in consumed:
+            return kb.rule_damages[position]
+    return kb.rule_damages[fired[0]]
+
+def reference_rank(kb, symptom_ids, top_k):
+    """(rule_id, certainty) of the best rule per damage, by certainty, hits, then rule order."""
+    _, facts = reference_fired(kb, symptom_ids)
+    scored = []
+    for position, antecedent in enumerate(kb.rule_facts):
+        antecedent = set(antecedent)
+        hits = len(antecedent & facts)
+        if antecedent and not hits:
+            continue
+        certainty = hits / len(antecedent) if antecedent else 1.0
+        scored.append((-certainty, -hits, position, certainty))
+
+    ranked = []
+    seen = set()
+    for _, _, position, certainty in sorted(scored):
+        damage_id = kb.rule_damages[position]
+        if damage_id not in seen:
+            seen.add(damage_id)
+            ranked.append((kb.rule_ids[position], round(certainty, 4)))
+    return ranked[:top_k]
+
+def index_state(kb):
+    """The matching structures of a KnowledgeBase, comparable across builds (fact bits aside)."""
+    return {
+        'rule_ids': list(kb.rule_ids),
+        'rule_damages': list(kb.rule_damages),
+        'rule_facts': [set(facts) for facts in kb.rule_facts],
+        'rule_scopes': list(kb.rule_scopes),
+        'fact_rules': dict(kb.fact_rules),
+        'postings': {fact: list(positions) for fact, positions in kb.postings.items()},
+        'length_slices': list(kb.length_slices),
+        'length_masks': dict(kb.length_masks),
+        'scope_masks': dict(kb.scope_masks),
+        'unconditional': list(kb.unconditional),
+        'rule_premises': dict(kb.rule_premises),
+        'all_rules': kb.all_rules,
+        'chained': kb.chained,
+        'rank_levels': list(kb.rank_levels)
+    }
+
+def mask_facts(kb, position):
+    """Decodes rule_masks[position] back into facts through fact_bits."""
+    facts = {bit: fact for fact, bit in kb.fact_bits.items()}
+    mask = kb.rule_masks[position]
+    return {facts[bit] for bit in range(mask.bit_length()) if mask >> bit & 1}
+
+def random_delta(rng, rules, damages, motorcycles):
+    """
+    Applies a random write to the database-shaped dicts and returns the
+    patched() arguments ForwardChainingEngine.refresh would pass for it.
+    """
+    rule_ids = set()
+    damage_delta = {}
+    motorcycle_delta = {}
+    damage_count = max(damages, default=0) + 2
+
+    for rule_id in rng.sample(sorted(rules), min(len(rules), rng.randint(0, 6))):
+        if rng.random() < 0.4:
+            del rules[rule_id]
+        else:
+            rules[rule_id] = random_rule(rng, damage_count, SYMPTOMS, MODELS, 0.3)
+        rule_ids.add(rule_id)
+    for _ in range(rng.randint(0, 6)):
+        rule_id = rng.randint(1, max(rules, default=0) + 20)
+        rules[rule_id] = random_rule(rng, damage_count, SYMPTOMS, MODELS, 0.3)
+        rule_ids.add(rule_id)
+
+    roll = rng.random()
+    if roll < 0.2 and damages:
+        # Deleting a damage deletes the rules concluding it first
+        damage_id = rng.choice(sorted(damages))
+        del damages[damage_id]
+        damage_delta[damage_id] = None
+        for rule_id in [r for r, (d, _, _) in rules.items() if d == damage_id]:
+            del rules[rule_id]
+            rule_ids.add(rule_id)
+    elif roll < 0.4:
+        # A new damage; rules that already concluded its id start being indexed
+        damage_id = rng.randint(1, damage_count + 1)
+        damages[damage_id] = damage_delta[damage_id] = damage_payload(damage_id)
+    elif roll < 0.6 and damages:
+        damage_id = rng.choice(sorted(damages))
+        damages[damage_id] = damage_delta[damage_id] = damage_payload(damage_id, f'Diubah {rng.random()}')
+
+    if rng.random() < 0.3:
+        motorcycle_id = rng.randint(1, MODELS + 1)
+        if motorcycle_id in motorcycles and rng.random() < 0.3:
+            del motorcycles[motorcycle_id]
+            motorcycle_delta[motorcycle_id] = None
+        else:
+            motorcycles[motorcycle_id] = motorcycle_delta[motorcycle_id] = rng.choice(BRANDS)
+
+    # As refresh(): reload the touched rules and those concluding a new damage
+    added = {d for d, payload in damage_delta.items() if payload is not None}
+    rule_ids.update(r for r, (d, _, _) in rules.items() if d in added)
+    loaded = rule_rows(rules, rule_ids & set(rules))
+    return loaded, rule_ids - set(rules), damage_delta, motorcycle_delta
+
+def assert_same_behaviour(patched, fresh, rng):
+    for _ in range(20):
+        symptom_ids = random_symptoms(rng, SYMPTOMS)
+        assert patched.match(symptom_ids) == fresh.match(symptom_ids)
+        assert patched.diagnose(symptom_ids) == fresh.diagnose(symptom_ids)
+        assert patched.rank(symptom_ids, 5) == fresh.rank(symptom_ids, 5)
+        for motorcycle_id in (None, *range(1, MODELS + 2)):
+            assert patched.scoped(motorcycle_id).diagnose(symptom_ids) == fresh.scoped(motorcycle_id).diagnose(symptom_ids)
+            assert patched.scoped(motorcycle_id).rank(symptom_ids, 3) == fresh.scoped(motorcycle_id).rank(symptom_ids, 3)
+
+def assert_patched_like_fresh(patched, fresh, rng):
+    assert index_state(patched) == index_state(fresh)
+    assert dict(patched.damages) == dict(fresh.damages)
+    assert patched.motorcycles == fresh.motorcycles
+    assert patched.fingerprint() == fresh.fingerprint()
+    for position in range(len(patched.rule_ids)):
+        assert mask_facts(patched, position) == set(patched.rule_facts[position])
+    # Partitions compiled before the patch were patched along with it
+    for scope, partition in patched._partitions.items():
+        assert index_state(partition) == index_state(fresh.partition(scope))
+        assert dict(partition.damages) == dict(fresh.damages)
+    assert_same_behaviour(patched, fresh, rng)
+
+def compile_partitions(kb):
+    for motorcycle_id in (None, *range(1, MODELS + 2)):
+        kb.scoped(motorcycle_id)
@@ -0,0 +1,167 @@
+import random
+import pytest
+from app.expert_system import DamageFact, KnowledgeBase, QuestionSession, _positions
+from .factories import (
+    compile_rules, damage_payload, random_knowledge_base, random_symptoms,
+    reference_conclusion, reference_fired, reference_rank
+)
+
+SEEDS = range(8)
+
+def knowledge_base(seed, chain_share=0.0, models=0):
+    rng = random.Random(seed)
+    rules, damages, motorcycles = random_knowledge_base(rng, models=models, chain_share=chain_share)
+    return rng, compile_rules(1, rules, damages, motorcycles)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_count_slices_hold_each_rules_hit_count(seed):
+    rng, kb = knowledge_base(seed, chain_share=0.3)
+    for _ in range(50):
+        facts = set(random_symptoms(rng, 20, rng.randint(0, 12)))
+        facts.update(DamageFact(rng.randint(1, 12)) for _ in range(rng.randint(0, 2)))
+        counter = kb._count_slices(facts)
+        for position, antecedent in enumerate(kb.rule_facts):
+            count = sum((counter_slice >> position & 1) << j for j, counter_slice in enumerate(counter))
+            assert count == len(set(antecedent) & facts)
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('chain_share', [0.0, 0.3])
+def test_matching_agrees_with_subset_tests(seed, chain_share):
+    rng, kb = knowledge_base(seed, chain_share)
+    assert kb.chained == (chain_share > 0)
+    for _ in range(100):
+        symptom_ids = random_symptoms(rng, 20)
+        assert kb.match(symptom_ids) == reference_fired(kb, symptom_ids)[0]
+        assert kb.conclude(symptom_ids) == reference_conclusion(kb, symptom_ids)
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('chain_share', [0.0, 0.3])
+def test_rank_orders_by_certainty_then_hits(seed, chain_share):
+    rng, kb = knowledge_base(seed, chain_share)
+    for _ in range(50):
+        symptom_ids = random_symptoms(rng, 20)
+        top_k = rng.randint(1, 8)
+        ranked = [(c['rule_id'], c['certainty']) for c in kb.rank(symptom_ids, top_k)]
+        assert ranked == reference_rank(kb, symptom_ids, top_k)
+
+def test_rules_without_a_known_damage_are_not_indexed():
+    kb = KnowledgeBase(1, [(1, 1, [1], None), (2, 99, [1], None)], {1: damage_payload(1)})
+    assert list(kb.rule_ids) == [1]
+    assert kb.diagnose([1])['id'] == 1
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('chain_share', [0.0, 0.3])
+def test_rete_session_fires_what_matching_fires(seed, chain_share):
+    rng, kb = knowledge_base(seed, chain_share)
+    network = kb.network()
+    for _ in range(30):
+        session = network.session()
+        assert sorted(session.fired) == kb.match([])
+        asserted = []
+        fired = set(session.fired)
+        for symptom_id in random_symptoms(rng, 20, rng.randint(1, 8)):
+            asserted.append(symptom_id)
+            new = session.assert_symptom(symptom_id)
+            assert not fired & set(new)
+            fired.update(new)
+            assert sorted(fired) == kb.match(asserted)
+        assert session.assert_symptom(asserted[-1]) == []
+
+def test_rete_session_chains_through_concluded_damages():
+    damages = {d: damage_payload(d) for d in (1, 2, 3)}
+    kb = KnowledgeBase(1, [
+        (1, 1, [1, 2], None),
+        (2, 2, [DamageFact(1), 3], None),
+        (3, 3, [DamageFact(2)], None)
+    ], damages)
+    session = kb.network().session()
+    assert session.assert_symptom(3) == []
+    assert session.assert_symptom(1) == []
+    assert session.assert_symptom(2) == [0, 1, 2]
+    assert [payload['id'] for payload in session.conclusions()] == [1, 2, 3]
+    # The last rule in the chain consumed nothing, so it is the diagnosis
+    assert kb.conclude([1, 2, 3]) == 3
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('chain_share', [0.0, 0.3])
+def test_scoped_views_agree_with_their_compiled_index(seed, chain_share):
+    rng, kb = knowledge_base(seed, chain_share, models=4)
+    for motorcycle_id in (None, 1, 2, 3, 4, 99, '1'):
+        scoped = kb.scoped(motorcycle_id)
+        compiled = scoped.compiled()
+        assert set(compiled.rule_ids) == {
+            kb.rule_ids[p] for scope in scoped.scopes for p in _positions(kb.scope_masks[scope])
+        }
+        for _ in range(30):
+            symptom_ids = random_symptoms(rng, 20)
+            assert scoped.conclude(symptom_ids) == compiled.conclude(symptom_ids)
+
+def test_specific_rules_win_over_generic_ones():
+    damages = {d: damage_payload(d) for d in (1, 2, 3)}
+    kb = KnowledgeBase(1, [
+        (1, 1, [1], None),
+        (2, 2, [1], 'honda'),
+        (3, 3, [1], 7)
+    ], damages, {7: 'honda', 8: 'honda', 9: 'yamaha'})
+    assert kb.scoped(7).conclude([1]) == 3
+    assert kb.scoped(8).conclude([1]) == 2
+    assert kb.scoped(9).conclude([1]) == 1
+    assert kb.scoped(None).conclude([1]) == 1
+    assert [c['rule_id'] for c in kb.scoped(7).rank([1], 3)] == [3, 2, 1]
+
+def ask_until_done(session, truth):
+    """Answers the session's questions from a set of present symptoms; returns the questions asked."""
+    asked = []
+    while True:
+        question = session.next_question()
+        if question is None:
+            return asked
+        symptom_id, hits, total = question
+        assert symptom_id not in asked
+        assert 0 < hits <= total
+        asked.append(symptom_id)
+        session.answer(symptom_id, symptom_id in truth)
+        expected = reference_conclusion(session.kb, session.confirmed)
+        diagnosis = session.diagnosis()
+        assert (diagnosis['id'] if diagnosis else None) == expected
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('chain_share', [0.0, 0.3])
+def test_question_session_reaches_the_full_diagnosis(seed, chain_share):
+    rng, kb = knowledge_base(seed, chain_share)
+    for _ in range(20):
+        truth = set(random_symptoms(rng, 20, rng.randint(0, 10)))
+        session = QuestionSession(kb)
+        ask_until_done(session, truth)
+        diagnosis = session.diagnosis()
+        assert (diagnosis['id'] if diagnosis else None) == kb.conclude(truth)
+
+def test_chained_question_session_keeps_rules_after_the_current_diagnosis():
+    damages = {d: damage_payload(d) for d in (1, 2, 3)}
+    kb = KnowledgeBase(1, [
+        (1, 1, [1], None),
+        (2, 3, [2], None),
+        (3, 2, [DamageFact(1), 3], None)
+    ], damages)
+    session = QuestionSession(kb, [1])
+    assert session.diagnosis()['id'] == 1
+    # Rule 3 comes after the diagnosis but consumes damage 1, so it stays open
+    assert session.candidates == 0b110
+    session.answer(2, False)
+    session.answer(3, True)
+    assert session.diagnosis()['id'] == 2
+    assert session.next_question() is None
+
+def test_question_session_replays_to_the_same_state():
+    rng, kb = knowledge_base(3, chain_share=0.3)
+    truth = set(random_symptoms(rng, 20, 8))
+    session = QuestionSession(kb)
+    ask_until_done(session, truth)
+
+    # The way SessionStore rebuilds a session in another worker
+    replayed = QuestionSession(kb, sorted(session.confirmed))
+    for symptom_id in sorted(session.denied):
+        replayed.answer(symptom_id, False)
+    assert replayed.candidates == session.candidates
+    assert replayed.diagnosis() == session.diagnosis()
+    assert replayed.next_question() == session.next_question()
@@ -0,0 +1,35 @@
+import random
+import pytest
+from .factories import (
+    MODELS, SYMPTOMS, assert_patched_like_fresh, compile_partitions, compile_rules, index_state,
+    random_delta, random_knowledge_base
+)
+
+@pytest.mark.parametrize('seed', range(12))
+def test_patched_equals_a_fresh_compile(seed):
+    rng = random.Random(seed)
+    rules, damages, motorcycles = random_knowledge_base(
+        rng, rule_count=40, symptom_count=SYMPTOMS, models=MODELS, chain_share=0.3
+    )
+    kb = compile_rules(1, rules, damages, motorcycles)
+
+    for version in range(2, 30):
+        if rng.random() < 0.7:
+            compile_partitions(kb)
+        before = index_state(kb), kb.fingerprint()
+        delta = random_delta(rng, rules, damages, motorcycles)
+        patched = kb.patched(version, *delta)
+
+        # Copy-on-write: the previous knowledge base is untouched
+        assert (index_state(kb), kb.fingerprint()) == before
+        assert_patched_like_fresh(patched, compile_rules(version, rules, damages, motorcycles), rng)
+        kb = patched
+
+def test_patch_removing_every_rule():
+    rng = random.Random(1)
+    rules, damages, motorcycles = random_knowledge_base(rng, rule_count=10, models=MODELS)
+    kb = compile_rules(1, rules, damages, motorcycles)
+    compile_partitions(kb)
+    patched = kb.patched(2, [], set(rules))
+    assert_patched_like_fresh(patched, compile_rules(2, {}, damages, motorcycles), rng)
+    assert patched.diagnose(list(range(1, SYMPTOMS + 1))) is None
@@ -0,0 +1,84 @@
+import random
+import pytest
+from app.snapshot import MAGIC, Snapshot, load_knowledge_base, snapshot_version, write_snapshot
+from .factories import (
+    MODELS, SYMPTOMS, assert_patched_like_fresh, compile_rules, index_state, mask_facts,
+    random_delta, random_knowledge_base, random_symptoms
+)
+
+SYMPTOM_ROWS = [
+    {'id': 1, 'code': 'G1', 'name': 'Motor Tidak Mau Bergerak', 'description': None},
+    {'id': 2, 'code': 'G2', 'name': 'Mesin Menyala', 'description': 'Bunyi kasar, tenaga é berkurang'}
+]
+
+def knowledge_base(seed, version=5):
+    rng = random.Random(seed)
+    rules, damages, motorcycles = random_knowledge_base(
+        rng, rule_count=50, symptom_count=SYMPTOMS, models=MODELS, chain_share=0.3
+    )
+    return rng, (rules, damages, motorcycles), compile_rules(version, rules, damages, motorcycles)
+
+@pytest.mark.parametrize('seed', range(6))
+def test_round_trip_keeps_the_index(tmp_path, seed):
+    rng, _, kb = knowledge_base(seed)
+    path = str(tmp_path / 'kb.snapshot')
+    write_snapshot(path, kb, SYMPTOM_ROWS)
+    loaded = load_knowledge_base(path, 5)
+
+    assert loaded.version == 5
+    assert index_state(loaded) == index_state(kb)
+    assert dict(loaded.damages) == kb.damages
+    assert loaded.motorcycles == kb.motorcycles
+    assert loaded.fingerprint() == kb.fingerprint()
+    for position in range(len(kb.rule_ids)):
+        assert mask_facts(loaded, position) == set(kb.rule_facts[position])
+    assert Snapshot(path).symptoms() == SYMPTOM_ROWS
+
+    for _ in range(50):
+        symptom_ids = random_symptoms(rng, SYMPTOMS)
+        assert loaded.diagnose(symptom_ids) == kb.diagnose(symptom_ids)
+        assert loaded.rank(symptom_ids, 5) == kb.rank(symptom_ids, 5)
+        for motorcycle_id in (None, *range(1, MODELS + 1)):
+            assert loaded.scoped(motorcycle_id).diagnose(symptom_ids) == kb.scoped(motorcycle_id).diagnose(symptom_ids)
+        truth = set(symptom_ids)
+        session = loaded.network().session()
+        for symptom_id in symptom_ids:
+            session.assert_symptom(symptom_id)
+        assert sorted(session.fired) == kb.match(truth)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_snapshot_loaded_knowledge_base_patches_like_a_compiled_one(tmp_path, seed):
+    rng, (rules, damages, motorcycles), kb = knowledge_base(seed)
+    path = str(tmp_path / 'kb.snapshot')
+    write_snapshot(path, kb, SYMPTOM_ROWS)
+    kb = load_knowledge_base(path)
+
+    for version in range(6, 16):
+        patched = kb.patched(version, *random_delta(rng, rules, damages, motorcycles))
+        assert_patched_like_fresh(patched, compile_rules(version, rules, damages, motorcycles), rng)
+        kb = patched
+
+    # A patched knowledge base (with facts left without rules) round-trips too
+    write_snapshot(path, kb, SYMPTOM_ROWS)
+    loaded = load_knowledge_base(path, kb.version)
+    assert index_state(loaded) == index_state(kb)
+    assert loaded.fingerprint() == kb.fingerprint()
+
+def test_only_the_expected_version_is_loaded(tmp_path):
+    _, _, kb = knowledge_base(0, version=7)
+    path = str(tmp_path / 'kb.snapshot')
+    assert snapshot_version(path) is None
+    write_snapshot(path, kb, SYMPTOM_ROWS)
+    assert snapshot_version(path) == 7
+    assert load_knowledge_base(path, 8) is None
+    assert load_knowledge_base(path, 7) is not None
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / 'kb.snapshot'
+    path.write_bytes(b'NOTASNAP' + bytes(64))
+    with pytest.raises(ValueError):
+        load_knowledge_base(str(path))
+    path.write_bytes(MAGIC + (999).to_bytes(4, 'little') + bytes(64))
+    with pytest.raises(ValueError):
+        load_knowledge_base(str(path))
+    assert snapshot_version(str(path)) is None
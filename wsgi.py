@@ -0,0 +1,13 @@
+"""
+Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is created once in the gunicorn master (preload_app) and workers
+are forked from it, so imports and the compiled knowledge base are
+shared copy-on-write instead of being rebuilt by every worker. Startup
+fails when the database lacks the kb_version table (see app.preload).
+"""
+from app import create_app, preload
+from app.config import ProductionConfig
+
+app = create_app(ProductionConfig)
+preload(app)